@@ -1,7 +1,7 @@
 """
 Set of functions for estimating the MT effect
 """
-from hcpasl.m0_mt_correction import load_json, update_json
+from hcpasl.manifest import read_manifest
 from hcpasl.initial_bookkeeping import create_dirs
 from fsl.data.image import Image
 import numpy as np
@@ -84,7 +84,7 @@ def estimate_mt(subject_dirs, rois=['wm', ], tr=8, method='separate'):
         for n1, subject_dir in enumerate(subject_dirs):
             print(subject_dir)
             # load subject's json
-            json_dict = load_json(subject_dir)
+            json_dict = read_manifest(subject_dir)
             # calculate mean per slice of masked in both calib images
             masked_names = (
                 json_dict[f'calib0_{tissue}_masked'],
@@ -169,7 +169,7 @@ def estimate_mt(subject_dirs, rois=['wm', ], tr=8, method='separate'):
         # scaling_factors = undo_st_correction(scaling_factors, tissue, tr)
 
         for subject_dir in subject_dirs:
-            json_dict = load_json(subject_dir)
+            json_dict = read_manifest(subject_dir)
             # load calibration image
             calib_img = Image(json_dict['calib0_img'])
             # create and save scaling factors image
@@ -6,15 +6,17 @@ and running fsl_anat on the structural image.
 
 from pathlib import Path
 import os
-from fsl.wrappers.misc import fslroi
 from fsl.wrappers.fsl_anat import fsl_anat
 from fsl.wrappers.flirt import applyxfm
 from fsl.wrappers.fnirt import applywarp
 from fsl.wrappers import fslmaths, LOAD, bet, fast
 from fsl.data.image import Image
 from fsl.data import atlases
-import json
 from hcpasl.initial_bookkeeping import create_dirs
+from hcpasl.manifest import Manifest
+from hcpasl.initial_bookkeeping import find_mbpcasl
+from hcpasl.study_index import indexed_path
+from hcpasl.nifti_stream import extract_volumes
 import subprocess
 
 PVE_NAMES = {
@@ -51,12 +53,11 @@ def setup_mtestimation(subject_dir, rois=['wm',]):
     create_dirs([asl_dir, calib0_dir, calib1_dir])
 
     # obtain calibration images from ASL sequence
-    mbpcasl_dir = list((subject_dir / f'{subject_name}_V1_B/scans').glob('**/*mbPCASLhr'))[0]
-    mbpcasl = mbpcasl_dir / f'resources/NIFTI/files/{subject_name}_V1_B_mbPCASLhr_PA.nii.gz'
+    mbpcasl = find_mbpcasl(subject_dir)
     calib0_name = calib0_dir / 'calib0.nii.gz'
     calib1_name = calib1_dir / 'calib1.nii.gz'
-    fslroi(str(mbpcasl), calib0_name, 88, 1)
-    fslroi(str(mbpcasl), calib1_name, 89, 1)
+    extract_volumes(mbpcasl, [(calib0_name, 88, 1), (calib1_name, 89, 1)],
+                    gzip_index=asl_dir / 'mbPCASL.gzidx')
 
     # initialise dict
     json_name = asl_dir / 'ASL.json'
@@ -70,9 +71,12 @@ def setup_mtestimation(subject_dir, rois=['wm',]):
     }
 
     # structural directory
-    t1_dir = list((subject_dir / f'{subject_name}_V1_A/scans').glob('**/*T1w'))[0]
-    struc_dir = t1_dir / 'resources/NIFTI/files'
-    struc_name = list(struc_dir.glob(f'**/{subject_name}_*.nii.gz'))[0]
+    struc_dir = indexed_path(subject_dir, 't1w_files')
+    struc_name = indexed_path(subject_dir, 't1w_scan')
+    if struc_dir is None or struc_name is None:
+        t1_dir = list((subject_dir / f'{subject_name}_V1_A/scans').glob('**/*T1w'))[0]
+        struc_dir = t1_dir / 'resources/NIFTI/files'
+        struc_name = list(struc_dir.glob(f'**/{subject_name}_*.nii.gz'))[0]
     fsl_anat_dir = struc_dir / 'ASL/struc'
     calib0struct_dir = struc_dir / 'ASL/Calib/Calib0'
     calib1struct_dir = struc_dir / 'ASL/Calib/Calib1'
@@ -191,6 +195,6 @@ def setup_mtestimation(subject_dir, rois=['wm',]):
             important_dict.update(new_dict)
 
     # save json
-    with open(json_name, 'w') as fp:
-        json.dump(important_dict, fp, sort_keys=True, indent=4)
+    with Manifest(json_name, create=True) as manifest:
+        manifest.update(important_dict)
     return (subject_dir, 0)
\ No newline at end of file
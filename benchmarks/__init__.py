@@ -0,0 +1,8 @@
+"""
+Benchmarks of the pipeline's in-Python processing, run on
+synthetic data with the dimensions of HCP ASL data so that they
+don't need real subjects or FSL.
+
+Run them with `python -m benchmarks`; see `benchmarks/__main__.py`
+for the options.
+"""
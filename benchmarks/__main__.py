@@ -0,0 +1,107 @@
+"""
+Run the benchmark suite, append the results to the history file
+and compare them with the previous run with the same settings.
+
+    python -m benchmarks [names ...] [--scale 0.5] [--repeats 3]
+
+Exits with a non-zero status if `--check` is given and any
+benchmark regressed by more than the threshold.
+"""
+
+from .harness import (run_benchmarks, make_record, load_history, append_history,
+                      previous_record, compare_records)
+from .kernels import BENCHMARKS
+import argparse
+import sys
+
+def _format(value):
+    return "-" if value is None else f"{value:.3f}"
+
+def main():
+    names = [benchmark.name for benchmark in BENCHMARKS]
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="Benchmarks to run, from: " + ", ".join(names) 
+            + ". Default is all of them."
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Factor by which to scale the spatial dimensions of the "
+            + "phantoms, e.g. 0.5 for a quick run. Default is 1, the "
+            + "dimensions of HCP data."
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of timed runs of each benchmark. Default is 3."
+    )
+    parser.add_argument(
+        "--history",
+        default="benchmark_history.jsonl",
+        help="File to which the results are appended, one json "
+            + "record per run. Default is benchmark_history.jsonl."
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="Don't save the results to the history file."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fractional increase over the previous run above which "
+            + "a benchmark is flagged as a regression. Default is 0.1."
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with a non-zero status if any benchmark regressed."
+    )
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    unknown = [name for name in args.names if name not in names]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    benchmarks = [b for b in BENCHMARKS if not args.names or b.name in args.names]
+    results = run_benchmarks(benchmarks, args.scale, args.repeats)
+    record = make_record(results, {'scale': args.scale, 'repeats': args.repeats})
+    old_record = previous_record(load_history(args.history), record)
+    if not args.no_history:
+        append_history(args.history, record)
+
+    regressed = False
+    width = max(len(name) for name in results)
+    if old_record is None:
+        print(f"\n{'benchmark':<{width}}  {'best_s':>10}  {'peak_mb':>10}")
+        for name, result in results.items():
+            if 'skipped' in result:
+                print(f"{name:<{width}}  skipped")
+            else:
+                print(f"{name:<{width}}  {_format(result['best_s']):>10}  "
+                      + f"{_format(result['peak_mb']):>10}")
+    else:
+        print(f"\nCompared with commit {old_record['commit']} ({old_record['date']}):")
+        print(f"{'benchmark':<{width}}  {'metric':<8}  {'old':>10}  {'new':>10}  {'change':>8}")
+        for name, metric, old, new, flagged in compare_records(old_record, record,
+                                                             args.threshold):
+            if old and new is not None:
+                change = f"{100 * (new - old) / old:+.1f}%"
+            else:
+                change = "-"
+            flag = "  REGRESSION" if flagged else ""
+            print(f"{name:<{width}}  {metric:<8}  {_format(old):>10}  "
+                  + f"{_format(new):>10}  {change:>8}{flag}")
+            regressed |= flagged
+    if args.check and regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
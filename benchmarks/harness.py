@@ -0,0 +1,176 @@
+"""
+Timing and memory measurement of benchmarks, and the history of
+benchmark results.
+
+Each benchmark is run a number of times to time it and once more
+with tracemalloc tracing to measure the peak memory allocated by
+Python and numpy, so that the tracing doesn't slow down the timed
+runs. The results of each run of the suite are appended as a line
+of json to a history file along with the commit they were run on,
+so that results can be compared between commits.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+import subprocess
+import tracemalloc
+import platform
+import time
+import json
+
+import numpy as np
+
+# a benchmark. `setup` is called with the phantom scale and
+# returns a tuple of `(kernel, make_args)`, where `make_args()`
+# returns the arguments for a single call of `kernel`. `setup`
+# raises ImportError if the benchmark's dependencies are missing.
+Benchmark = namedtuple('Benchmark', ['name', 'setup'])
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+def git_commit():
+    """
+    Return the hash of the repository's current commit and whether
+    there are uncommitted changes, or (None, None) if it isn't
+    available.
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode().strip()
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=REPO_DIR, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status)
+
+def measure(kernel, make_args, repeats=3):
+    """
+    Time `repeats` calls of `kernel` and measure the peak memory
+    allocated during one further call.
+
+    Returns a dictionary of the times of each call, in seconds,
+    and the peak memory, in MB.
+    """
+    times = []
+    for _ in range(repeats):
+        args = make_args()
+        start = time.perf_counter()
+        kernel(*args)
+        times.append(time.perf_counter() - start)
+        del args
+    args = make_args()
+    tracemalloc.start()
+    try:
+        kernel(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'times_s': times,
+        'best_s': min(times),
+        'mean_s': sum(times) / len(times),
+        'peak_mb': peak / 2**20
+    }
+
+def run_benchmarks(benchmarks, scale=1.0, repeats=3):
+    """
+    Run each of `benchmarks` on phantoms scaled by `scale`.
+
+    Returns a dictionary mapping each benchmark's name to its
+    results. Benchmarks whose dependencies are missing are
+    recorded as skipped rather than failing the suite.
+    """
+    results = {}
+    for benchmark in benchmarks:
+        print(f'Running {benchmark.name}...', flush=True)
+        try:
+            kernel, make_args = benchmark.setup(scale)
+        except ImportError as e:
+            print(f'Skipping {benchmark.name}: {e}')
+            results[benchmark.name] = {'skipped': str(e)}
+            continue
+        with np.errstate(all='ignore'):
+            results[benchmark.name] = measure(kernel, make_args, repeats)
+    return results
+
+def make_record(results, config):
+    """
+    Return the history record of a run of a suite, given its
+    results and the dictionary of settings it was run with,
+    `config`, e.g. the phantom scale.
+    """
+    commit, dirty = git_commit()
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'config': config,
+        'results': results
+    }
+
+def load_history(history_name):
+    """
+    Return the list of records in the history file
+    `history_name`, oldest first.
+    """
+    history_name = Path(history_name)
+    if not history_name.exists():
+        return []
+    with open(history_name, 'r') as infile:
+        return [json.loads(line) for line in infile if line.strip()]
+
+def append_history(history_name, record):
+    """
+    Append `record` to the history file `history_name`.
+    """
+    history_name = Path(history_name)
+    history_name.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_name, 'a') as outfile:
+        outfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+def previous_record(history, record):
+    """
+    Return the most recent record in `history` run with the same
+    settings as `record`, or None.
+    """
+    for old_record in reversed(history):
+        if old_record.get('config') == record['config']:
+            return old_record
+    return None
+
+# minimum baseline values of each compared metric below which
+# changes are put down to noise
+MIN_VALUES = {
+    'best_s': 0.01,
+    'peak_mb': 1.0
+}
+
+def compare_records(old_record, new_record, threshold=0.1):
+    """
+    Compare the best time and peak memory of each benchmark in
+    `new_record` with `old_record`.
+
+    Returns a list of `(name, metric, old, new, regressed)` tuples
+    where `regressed` is True if the value increased by more than
+    the fraction `threshold`. Values missing from either record
+    are None.
+    """
+    rows = []
+    for name, new in new_record['results'].items():
+        old = old_record['results'].get(name, {})
+        for metric, min_value in MIN_VALUES.items():
+            old_value, new_value = old.get(metric), new.get(metric)
+            regressed = (old_value is not None and new_value is not None
+                         and old_value >= min_value
+                         and new_value > old_value * (1 + threshold))
+            rows.append((name, metric, old_value, new_value, regressed))
+    return rows
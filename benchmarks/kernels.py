@@ -0,0 +1,156 @@
+"""
+Benchmarks of the numpy kernels in the pipeline.
+
+Each benchmark imports the code it measures when it is set up so
+that a missing dependency, e.g. pyfab when importing hcpasl, only
+skips the benchmarks needing it.
+"""
+
+from .harness import Benchmark
+from . import phantoms
+
+def _slicetiming_correction(scale):
+    import atexit
+    import shutil
+    import tempfile
+    from pathlib import Path
+    from fsl.data.image import Image
+    from hcpasl.asl_correction import _slicetiming_correction
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)
+    asl_img = Image(phantoms.asl_series(shape))
+    t1_img = Image(phantoms.t1_map(shape[:3]))
+    out_dir = Path(tempfile.mkdtemp(prefix='hcpasl_benchmark_'))
+    atexit.register(shutil.rmtree, out_dir, True)
+    def make_args():
+        return (asl_img, t1_img, phantoms.TIS, phantoms.RPTS, 0.059, 10, shape[2],
+                out_dir / 'tis_stcorr.nii.gz', out_dir / 'st_scaling_factors.nii.gz')
+    return _slicetiming_correction, make_args
+
+def _tag_control_differencing(scale):
+    from hcpasl.asl_differencing import _tag_control_betas
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)
+    series = phantoms.asl_series(shape)
+    factors = phantoms.scaling_factors(shape)
+    return _tag_control_betas, lambda: (series, factors)
+
+def _sum_array_blocks(scale):
+    import numpy as np
+    from hcpasl.extract_fs_pvs import _sum_array_blocks
+    # supersampled by a factor of 2, as in extract_fs_pvs
+    shape = [2 * dim for dim in phantoms.scale_shape(phantoms.REF_SHAPE, scale)]
+    array = np.random.default_rng(0).random((*shape, 3), dtype=np.float32)
+    return _sum_array_blocks, lambda: (array, [2, 2, 2, 1])
+
+def _stack_images(scale):
+    from hcpasl.extract_fs_pvs import stack_images
+    maps = phantoms.pv_maps(phantoms.scale_shape(phantoms.REF_SHAPE, scale))
+    # stack_images pops the maps it uses so needs a fresh dict each call
+    return stack_images, lambda: (dict(maps), )
+
+def _label_pvs(scale):
+    from hcpasl.extract_fs_pvs import _label_pvs
+    labels = phantoms.aparc_aseg(phantoms.scale_shape(phantoms.T1W_SHAPE, scale))
+    return _label_pvs, lambda: (labels, )
+
+def _extract_volumes(scale):
+    import atexit
+    import shutil
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from pathlib import Path
+    from hcpasl.nifti_stream import extract_volumes
+    # the mbPCASL sequence: the ASL series followed by 4 calibration volumes
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)
+    series = phantoms.asl_series(shape)
+    mbpcasl = np.concatenate((series, series[..., :4]), axis=3)
+    out_dir = Path(tempfile.mkdtemp(prefix='hcpasl_benchmark_'))
+    atexit.register(shutil.rmtree, out_dir, True)
+    src_name = out_dir / 'mbpcasl.nii.gz'
+    nb.save(nb.Nifti1Image(mbpcasl, np.eye(4)), str(src_name))
+    outputs = [(out_dir / 'tis.nii.gz', 0, shape[3]), 
+               (out_dir / 'calib0.nii.gz', shape[3] + 2, 1),
+               (out_dir / 'calib1.nii.gz', shape[3] + 3, 1)]
+    return extract_volumes, lambda: (src_name, outputs)
+
+def _bias_mt_correction(scale):
+    import atexit
+    import shutil
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from pathlib import Path
+    from hcpasl.voxelwise import voxelwise
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)
+    out_dir = Path(tempfile.mkdtemp(prefix='hcpasl_benchmark_'))
+    atexit.register(shutil.rmtree, out_dir, True)
+    names = {}
+    for name, data in (('asl', phantoms.asl_series(shape)), 
+                       ('bias', phantoms.scaling_factors((*shape[:3], 1))),
+                       ('mt', phantoms.scaling_factors((*shape[:3], 1))[..., 0])):
+        names[name] = out_dir / f'{name}.nii.gz'
+        nb.save(nb.Nifti1Image(data, np.eye(4)), str(names[name]))
+    def kernel(asl_name, bias_name, mt_name, out_name):
+        voxelwise(asl_name).div(bias_name).mul(mt_name).run(out_name)
+    return kernel, lambda: (names['asl'], names['bias'], names['mt'], 
+                            out_dir / 'mtcorr.nii.gz')
+
+def _resample_series(scale):
+    import atexit
+    import shutil
+    import tempfile
+    import numpy as np
+    from pathlib import Path
+    from fsl.data.image import Image
+    from hcpasl.resample import resample_series
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)
+    t1_img = Image(phantoms.t1_map(shape[:3]), xform=np.diag([2.5, 2.5, 2.5, 1]))
+    # small rotations and translations, like mcflirt's motion estimates
+    rng = np.random.default_rng(0)
+    transforms = np.tile(np.eye(4), (shape[3], 1, 1))
+    for transform in transforms:
+        angle = rng.normal(0, 0.01)
+        transform[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+        transform[:3, 3] = rng.normal(0, 0.5, 3)
+    out_dir = Path(tempfile.mkdtemp(prefix='hcpasl_benchmark_'))
+    atexit.register(shutil.rmtree, out_dir, True)
+    return resample_series, lambda: (t1_img, transforms, t1_img, out_dir / 't1_reg.nii.gz')
+
+def _median_filter(scale):
+    from hcpasl.spatial_filter import median_filter
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)[:3]
+    t1 = phantoms.t1_map(shape)
+    mask = phantoms.brain_mask(shape)
+    return median_filter, lambda: (t1, 3, mask)
+
+def _fit_perfusion(scale):
+    import numpy as np
+    from hcpasl.perfusion import fit_perfusion, kinetic_curve
+    shape = phantoms.scale_shape(phantoms.REF_SHAPE, scale)
+    mask = phantoms.brain_mask(shape)
+    # differenced data with a perfusion of 1 and an arrival time of 1.3s
+    slice_offsets = 0.059 * (np.arange(shape[2]) % 10)
+    times = np.repeat(phantoms.TIS, phantoms.RPTS) + slice_offsets[:, np.newaxis]
+    signal = np.where(mask[..., np.newaxis], kinetic_curve(times, 1.3, 1.3, 1.5), 0)
+    rng = np.random.default_rng(0)
+    data = (signal + rng.normal(0, 0.05, signal.shape)).astype(np.float32)
+    return fit_perfusion, lambda: (data, phantoms.TIS, phantoms.RPTS, 1.5, 0.059, 10, mask)
+
+def _fit_linear_model(scale):
+    from MTEstimation.estimate_MT import fit_linear_model
+    slice_means = phantoms.slice_means()
+    return fit_linear_model, lambda: (slice_means, )
+
+BENCHMARKS = [
+    Benchmark('slicetiming_correction', _slicetiming_correction),
+    Benchmark('tag_control_differencing', _tag_control_differencing),
+    Benchmark('sum_array_blocks', _sum_array_blocks),
+    Benchmark('stack_images', _stack_images),
+    Benchmark('label_pvs', _label_pvs),
+    Benchmark('extract_volumes', _extract_volumes),
+    Benchmark('bias_mt_correction', _bias_mt_correction),
+    Benchmark('resample_series', _resample_series),
+    Benchmark('median_filter', _median_filter),
+    Benchmark('fit_perfusion', _fit_perfusion),
+    Benchmark('fit_linear_model', _fit_linear_model),
+]
@@ -0,0 +1,192 @@
+"""
+Synthetic phantoms with the dimensions of HCP ASL data.
+
+The phantoms are built from nested ellipsoids standing in for the
+brain, its white matter and ventricles so that their values are
+plausible, e.g. masks aren't empty and partial volumes sum to
+one, but no attempt is made to model real anatomy.
+"""
+
+import numpy as np
+
+# dimensions of the HCP data
+ASL_SHAPE = (86, 86, 60, 86)
+T1W_SHAPE = (260, 311, 260)
+# ASL-gridded T1w space, i.e. T1w space with 2.5mm voxels
+REF_SHAPE = (73, 88, 73)
+# sequence parameters
+TIS = [1.7, 2.2, 2.7, 3.2, 3.7]
+RPTS = [6, 6, 6, 10, 15]
+
+def scale_shape(shape, scale, n_dims=3):
+    """
+    Scale the first `n_dims` dimensions of `shape` by `scale`,
+    e.g. to make smaller phantoms for quick runs. The slices of
+    the ASL data are grouped into bands so shouldn't be scaled.
+    """
+    scaled = [max(1, int(round(dim * scale))) for dim in shape[:n_dims]]
+    return (*scaled, *shape[n_dims:])
+
+def _radius(shape, centre=(0.5, 0.5, 0.5), radii=(0.4, 0.45, 0.4)):
+    """
+    Return an array of `shape` (3D) of each voxel's normalised
+    distance from `centre` of an ellipsoid with semi-axes
+    `radii`, both given as fractions of the field of view. The
+    ellipsoid's surface is at radius 1.
+    """
+    axes = [
+        ((np.arange(n, dtype=np.float32) + 0.5) / n - c) / r
+        for n, c, r in zip(shape, centre, radii)
+    ]
+    x, y, z = np.ix_(*axes)
+    return np.sqrt(x**2 + y**2 + z**2)
+
+def brain_mask(shape):
+    """
+    Ellipsoidal brain mask of `shape`.
+    """
+    return _radius(shape[:3]) < 1
+
+def t1_map(shape=ASL_SHAPE[:3], seed=0):
+    """
+    Tissue T1 map, in seconds, as estimated by the satrecov model:
+    around 1.3s in the brain and 0.5s outside it.
+    """
+    rng = np.random.default_rng(seed)
+    r = _radius(shape)
+    t1 = np.where(r < 1, 1.0 + 0.3 * r, 0.5).astype(np.float32)
+    t1 += rng.normal(0, 0.02, shape).astype(np.float32)
+    return t1
+
+def asl_series(shape=ASL_SHAPE, seed=0):
+    """
+    Tag-control ASL series, starting with a tag image, whose
+    control images follow a saturation recovery curve over the
+    sequence's TIs and whose tag images have 1% less signal.
+    """
+    rng = np.random.default_rng(seed)
+    m0 = np.where(brain_mask(shape), 1000, 50).astype(np.float32)
+    t1 = t1_map(shape[:3], seed)
+    tis = np.repeat(TIS, 2 * np.array(RPTS))[:shape[3]]
+    series = np.empty(shape, dtype=np.float32)
+    for n, ti in enumerate(tis):
+        signal = m0 * (1 - np.exp(-ti / t1))
+        if n % 2 == 0:
+            signal *= 0.99
+        series[..., n] = signal
+    series += rng.normal(0, 5, shape).astype(np.float32)
+    return series
+
+def scaling_factors(shape=ASL_SHAPE, seed=0):
+    """
+    Combined MT and slice-timing correction scaling factors,
+    close to 1 and varying smoothly through the slices.
+    """
+    rng = np.random.default_rng(seed)
+    slices = np.linspace(1.0, 1.2, shape[2], dtype=np.float32)
+    factors = np.broadcast_to(slices.reshape(1, 1, -1, 1), shape).copy()
+    factors += rng.normal(0, 0.01, shape).astype(np.float32)
+    return factors
+
+# label of each subcortical structure on the left and right, and
+# the centre of the structure relative to the brain
+SUBCORTICAL_LABELS = {
+    (9, 48): (0.44, 0.5, 0.5),      # thalamus
+    (11, 50): (0.42, 0.58, 0.55),   # caudate
+    (12, 51): (0.36, 0.56, 0.5),    # putamen
+    (13, 52): (0.38, 0.54, 0.47),   # pallidum
+    (17, 53): (0.36, 0.45, 0.4),    # hippocampus
+    (18, 54): (0.36, 0.52, 0.38),   # amygdala
+    (26, 58): (0.45, 0.6, 0.47),    # accumbens
+}
+
+def aparc_aseg(shape=T1W_SHAPE):
+    """
+    FreeSurfer aparc+aseg style label volume: a cortical ribbon
+    split into 35 parcels per hemisphere, white matter,
+    ventricles, subcortical structures, cerebellum, brainstem
+    and corpus callosum.
+    """
+    r = _radius(shape)
+    # left hemisphere is x < 0.5
+    left = (np.arange(shape[0]) < shape[0] // 2).reshape(-1, 1, 1)
+    labels = np.zeros(shape, dtype=np.int32)
+
+    # cortex, parcellated by angle around the centre
+    angles = np.arctan2(
+        np.arange(shape[1], dtype=np.float32).reshape(1, -1, 1) - shape[1] / 2,
+        np.arange(shape[2], dtype=np.float32).reshape(1, 1, -1) - shape[2] / 2
+    )
+    parcels = ((angles + np.pi) / (2 * np.pi) * 35).astype(np.int32) % 35 + 1
+    cortex = (r >= 0.85) & (r < 1)
+    labels = np.where(cortex, np.where(left, 1000, 2000) + parcels, labels)
+    # white matter, with some hypointensities
+    labels = np.where(r < 0.85, np.where(left, 2, 41), labels)
+    labels[(r > 0.8) & (r < 0.81)] = 77
+    # corpus callosum at the midline
+    callosum = _radius(shape, radii=(0.02, 0.2, 0.05), centre=(0.5, 0.5, 0.62)) < 1
+    for n, label in enumerate(range(251, 256)):
+        section = np.zeros(shape, dtype=bool)
+        section[:, n * shape[1] // 5:(n + 1) * shape[1] // 5] = True
+        labels[callosum & section] = label
+    # ventricles
+    for centre, label in (((0.45, 0.5, 0.55), 4), ((0.55, 0.5, 0.55), 43)):
+        ventricle = _radius(shape, centre=centre, radii=(0.03, 0.12, 0.05)) < 1
+        labels[ventricle] = label
+    # subcortical structures
+    for (left_label, right_label), centre in SUBCORTICAL_LABELS.items():
+        for label, x in ((left_label, centre[0]), (right_label, 1 - centre[0])):
+            structure = _radius(shape, centre=(x, *centre[1:]), radii=(0.03, 0.04, 0.03)) < 1
+            labels[structure] = label
+    # cerebellum and brainstem
+    for centre, label in (((0.4, 0.3, 0.2), 8), ((0.6, 0.3, 0.2), 47)):
+        cerebellum = _radius(shape, centre=centre, radii=(0.1, 0.1, 0.08)) < 1
+        labels[cerebellum] = label
+    labels[_radius(shape, centre=(0.5, 0.4, 0.15), radii=(0.05, 0.05, 0.15)) < 1] = 16
+    return labels.astype(np.int32)
+
+def _ramp(x, start, width):
+    """
+    Linear ramp from 0 at `start` to 1 at `start` + `width`.
+    """
+    return np.clip((x - start) / width, 0, 1).astype(np.float32)
+
+def pv_maps(shape=REF_SHAPE):
+    """
+    Partial volume estimates in the form expected by
+    `extract_fs_pvs.stack_images`: cortical and volumetric
+    GM/WM/non-brain maps, each set summing to 1 in every voxel,
+    and a partial volume map for each subcortical structure.
+    """
+    r = _radius(shape)
+    maps = {}
+    # cortical estimates: WM inside, a GM ribbon, then non-brain
+    maps['cortex_WM'] = 1 - _ramp(r, 0.8, 0.05)
+    maps['cortex_nonbrain'] = _ramp(r, 0.92, 0.05)
+    maps['cortex_GM'] = 1 - maps['cortex_WM'] - maps['cortex_nonbrain']
+    # volumetric estimates, with ventricles of pure CSF
+    ventricles = np.zeros(shape, dtype=bool)
+    for x in (0.45, 0.55):
+        ventricles |= _radius(shape, centre=(x, 0.5, 0.55), radii=(0.03, 0.12, 0.05)) < 1
+    vol_wm = 1 - _ramp(r, 0.78, 0.05)
+    vol_gm = np.minimum(1 - vol_wm, 1 - _ramp(r, 0.9, 0.05))
+    maps['vol_WM'] = np.where(ventricles, 0, vol_wm).astype(np.float32)
+    maps['vol_GM'] = np.where(ventricles, 0, vol_gm).astype(np.float32)
+    maps['vol_CSF'] = 1 - maps['vol_WM'] - maps['vol_GM']
+    # subcortical structures
+    names = ('Thal', 'Caud', 'Puta', 'Pall', 'Hipp', 'Amyg', 'Accu')
+    for name, centre in zip(names, SUBCORTICAL_LABELS.values()):
+        for side, x in (('L', centre[0]), ('R', 1 - centre[0])):
+            d = _radius(shape, centre=(x, *centre[1:]), radii=(0.03, 0.04, 0.03))
+            maps[f'{side}_{name}'] = np.clip(1.5 - d, 0, 1).astype(np.float32)
+    return maps
+
+def slice_means(seed=0):
+    """
+    Mean calibration image signal in each of the 60 slices,
+    decreasing linearly within each band of 10 slices as seen
+    with the MT effect.
+    """
+    rng = np.random.default_rng(seed)
+    within_band = np.tile(np.arange(10), 6)
+    return 800 - 10 * within_band + rng.normal(0, 2, 60)
@@ -0,0 +1,252 @@
+"""
+End-to-end benchmark of the pipeline on synthetic subjects, with
+the FSL, Workbench and Fabber executables replaced by the
+stand-ins in `stub_tools.py`.
+
+The stand-ins take a configurable, fixed time, so the benchmark
+measures the time the pipeline spends outside the external tools:
+scheduling, reading and writing images and its own Python code.
+
+    python -m benchmarks.pipeline [--subjects 2] [--scale 0.5] [--delay 0.1]
+                                  [--intermediate-format nii]
+
+The Python dependencies of the pipeline (fslpy, pyfab, regtricks,
+toblerone) must still be installed.
+"""
+
+from .harness import make_record, load_history, append_history, previous_record, compare_records
+from .subject import make_subject, make_mt_factors
+from .stub_tools import install_stubs
+from pathlib import Path
+import tempfile
+import argparse
+import shutil
+import time
+import json
+import sys
+import os
+
+def _set_environment(stub_dir, delay, delays, log_name):
+    """
+    Point FSL and the pipeline's subprocesses at the stand-ins.
+    """
+    os.environ['FSLDIR'] = str(stub_dir)
+    os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
+    os.environ['PATH'] = str(stub_dir / 'bin') + os.pathsep + os.environ['PATH']
+    os.environ['HCPASL_STUB_DELAY'] = str(delay)
+    os.environ['HCPASL_STUB_DELAYS'] = json.dumps(delays or {})
+    os.environ['HCPASL_STUB_LOG'] = str(log_name)
+    os.environ.pop('FSLDEVDIR', None)
+    # fslpy reads $FSLDIR when it's first imported
+    from fsl.utils.platform import platform as fslplatform
+    fslplatform.fsldir = str(stub_dir)
+    fslplatform.fsldevdir = None
+
+def _tool_summary(log_name):
+    """
+    Return the number of calls of each stand-in and the time they
+    took, in seconds, from the log `log_name`.
+    """
+    summary = {}
+    if Path(log_name).exists():
+        with open(log_name, 'r') as infile:
+            for line in infile:
+                entry = json.loads(line)
+                tool = summary.setdefault(entry['tool'], {'calls': 0, 'seconds': 0.0})
+                tool['calls'] += 1
+                tool['seconds'] += entry['seconds']
+    return summary
+
+def _stage_times(subject_dirs):
+    """
+    Return the wall-clock time of each stage, summed over the
+    subjects, from the subjects' profiling reports.
+    """
+    from hcpasl.profiling import summarise_report
+    times = {}
+    for subject_dir in subject_dirs:
+        report_name = Path(subject_dir) / 'ASL/profile.json'
+        if not report_name.exists():
+            continue
+        with open(report_name, 'r') as infile:
+            summary = summarise_report(json.load(infile))
+        for step, metrics in summary.items():
+            if '/' not in step:
+                times[step] = times.get(step, 0.0) + metrics['wall_s']
+    return times
+
+def run_pipeline_benchmark(study_dir, n_subjects=1, scale=0.5, delay=0.0, delays=None,
+                           workers=1, threads=None, **kwargs):
+    """
+    Generate `n_subjects` synthetic subjects in `study_dir` and run
+    the pipeline on them with the stand-in executables.
+
+    Inputs:
+        - `study_dir` = pathlib.Path of an empty directory in
+            which to create the subjects and stand-ins
+        - `n_subjects` = number of subjects to process
+        - `scale` = scale of the synthetic data, see
+            `subject.make_subject`
+        - `delay` = time taken by each stand-in, in seconds
+        - `delays` = dictionary of the times taken by individual
+            stand-ins, overriding `delay`
+        - `workers`, `threads` = as for `process_subjects`
+    Any further keyword arguments are passed on to
+    `process_subject`.
+
+    Returns a dictionary of results: the total wall-clock time,
+    the calls of and time spent in each stand-in and the time of
+    each stage.
+    """
+    stub_dir = study_dir / '_stubs'
+    log_name = study_dir / '_stubs/calls.jsonl'
+    install_stubs(stub_dir / 'bin')
+    _set_environment(stub_dir, delay, delays, log_name)
+    # imported after setting up the environment so that fslpy finds the stand-ins
+    from scripts.run_pipeline import process_subject, process_subjects, _limit_threads
+
+    print(f'Generating {n_subjects} synthetic subjects in {study_dir}.')
+    mt_factors = make_mt_factors(study_dir / 'mt_scaling_factors.nii.gz', scale)
+    subject_dirs = [make_subject(study_dir, f'HCA{n:07d}', scale, seed=n)
+                    for n in range(n_subjects)]
+
+    start = time.perf_counter()
+    if n_subjects == 1:
+        _limit_threads(threads or os.cpu_count() or 1)
+        process_subject(subject_dirs[0], mt_factors, **kwargs)
+    else:
+        results = process_subjects(subject_dirs, mt_factors, workers,
+                                   threads or 1, **kwargs)
+        failed = [subject for subject, error in results.items() if error]
+        if failed:
+            raise RuntimeError(f'Pipeline failed for {", ".join(map(str, failed))}.')
+    wall = time.perf_counter() - start
+
+    tools = _tool_summary(log_name)
+    tool_seconds = sum(tool['seconds'] for tool in tools.values())
+    results = {
+        'total': {
+            'best_s': wall,
+            'tool_calls': sum(tool['calls'] for tool in tools.values()),
+            'tool_s': tool_seconds
+        }
+    }
+    for stage, seconds in _stage_times(subject_dirs).items():
+        results[stage] = {'best_s': seconds}
+    results['tools'] = tools
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.pipeline")
+    parser.add_argument(
+        "--subjects",
+        type=int,
+        default=1,
+        help="Number of synthetic subjects to process. Default is 1."
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.5,
+        help="Scale of the synthetic data relative to HCP data. "
+            + "Default is 0.5."
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0.0,
+        help="Time, in seconds, taken by each stand-in executable. "
+            + "Default is 0."
+    )
+    parser.add_argument(
+        "--delays",
+        type=json.loads,
+        help="Json dictionary of the times taken by individual stand-ins, "
+            + "e.g. '{\"topup\": 5, \"oxford_asl\": 10}'."
+    )
+    parser.add_argument(
+        "-n",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of subjects to process concurrently. Default is 1."
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads used by each subject."
+    )
+    parser.add_argument(
+        "--intermediate-format",
+        choices=('nii.gz', 'nii'),
+        default="nii.gz",
+        help="Format of the pipeline's intermediate images. Default is "
+            + "nii.gz."
+    )
+    parser.add_argument(
+        "--study-dir",
+        help="Empty directory in which to create the subjects. Default "
+            + "is a temporary directory which is removed afterwards."
+    )
+    parser.add_argument(
+        "--history",
+        default="pipeline_benchmark_history.jsonl",
+        help="File to which the results are appended. Default is "
+            + "pipeline_benchmark_history.jsonl."
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="Don't save the results to the history file."
+    )
+    args = parser.parse_args()
+
+    if args.study_dir:
+        study_dir = Path(args.study_dir).resolve()
+        study_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        study_dir = Path(tempfile.mkdtemp(prefix='hcpasl_benchmark_'))
+    try:
+        results = run_pipeline_benchmark(
+            study_dir, args.subjects, args.scale, args.delay, args.delays,
+            args.workers, args.threads, intermediate_format=args.intermediate_format
+        )
+    except ImportError as e:
+        print(f'Skipping the pipeline benchmark: {e}')
+        sys.exit(1)
+    finally:
+        if not args.study_dir:
+            shutil.rmtree(study_dir, ignore_errors=True)
+
+    config = {
+        'subjects': args.subjects,
+        'scale': args.scale,
+        'delay': args.delay,
+        'delays': args.delays,
+        'workers': args.workers,
+        'threads': args.threads
+    }
+    # only recorded when not the default so earlier records still match
+    if args.intermediate_format != 'nii.gz':
+        config['intermediate_format'] = args.intermediate_format
+    record = make_record(results, config)
+    old_record = previous_record(load_history(args.history), record)
+    if not args.no_history:
+        append_history(args.history, record)
+
+    total = results['total']
+    print(f"\nTotal time: {total['best_s']:.2f}s, {total['tool_calls']} tool calls "
+          + f"taking {total['tool_s']:.2f}s in total.")
+    for tool, summary in sorted(results['tools'].items()):
+        print(f"    {tool:<20} {summary['calls']:>4} calls  {summary['seconds']:>8.2f}s")
+    if old_record is not None:
+        print(f"\nCompared with commit {old_record['commit']} ({old_record['date']}):")
+        for name, metric, old, new, flagged in compare_records(old_record, record):
+            if metric != 'best_s' or new is None:
+                continue
+            change = f"{100 * (new - old) / old:+.1f}%" if old else "-"
+            flag = "  REGRESSION" if flagged else ""
+            print(f"    {name:<28} {old or 0:>8.2f}s  {new:>8.2f}s  {change:>8}{flag}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+"""
+Stand-ins for the FSL, Workbench and Fabber executables called by
+the pipeline, for benchmarking the pipeline without installing
+them.
+
+Every tool is handled by this one script, which is called as
+
+    python stub_tools.py <tool> <tool's arguments>
+
+by the wrapper scripts created by `install_stubs`. Each stand-in
+parses the arguments the pipeline passes to the real tool, sleeps
+for a configurable delay and writes outputs with the names and
+dimensions the real tool would, filled with simple functions of
+the inputs rather than real results.
+
+Delays, in seconds, are read from the environment:
+    - `HCPASL_STUB_DELAY` = delay of every tool (default 0)
+    - `HCPASL_STUB_DELAYS` = json dictionary of delays of
+        individual tools, overriding the above
+If `HCPASL_STUB_LOG` is set, the tool, its arguments and the time
+it took are appended to that file as a line of json.
+
+Only numpy and nibabel are needed, so this module doesn't import
+anything from the rest of the repository.
+"""
+
+from pathlib import Path
+import subprocess
+import shutil
+import time
+import json
+import sys
+import os
+
+import numpy as np
+import nibabel as nb
+
+def _with_ext(name):
+    """
+    Return `name` with its NIfTI extension, if any, replaced by
+    the extension of FSLOUTPUTTYPE, as FSL tools do.
+    """
+    name = str(name)
+    for old_ext in ('.nii.gz', '.nii'):
+        if name.endswith(old_ext):
+            name = name[:-len(old_ext)]
+            break
+    ext = '.nii' if os.environ.get('FSLOUTPUTTYPE') == 'NIFTI' else '.nii.gz'
+    return name + ext
+
+def _find(name):
+    """
+    Return the existing image `name`, which may be given without
+    its extension.
+    """
+    name = str(name)
+    for candidate in (name, name + '.nii.gz', name + '.nii'):
+        if os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError(f'Image {name} not found.')
+
+def _load(name):
+    img = nb.load(_find(name))
+    return np.asanyarray(img.dataobj, dtype=np.float32), img.affine
+
+def _save(data, affine, name, keep_ext=False):
+    """
+    Save `data` to the image `name`, with the extension of
+    FSLOUTPUTTYPE unless `keep_ext` is True, e.g. for tools
+    which aren't part of FSL or modify an image in place.
+    """
+    name = str(name) if keep_ext else _with_ext(name)
+    Path(name).parent.mkdir(parents=True, exist_ok=True)
+    nb.save(nb.Nifti1Image(np.asarray(data, dtype=np.float32), affine), name)
+
+def _resample(data, shape):
+    """
+    Nearest-neighbour resampling of the spatial dimensions of
+    `data` to `shape`, keeping any further dimensions.
+    """
+    indices = [
+        np.minimum((np.arange(n) * data.shape[d] / n).astype(int), data.shape[d] - 1)
+        for d, n in enumerate(shape[:3])
+    ]
+    if data.ndim == 4:
+        indices.append(np.arange(data.shape[3]))
+    return data[np.ix_(*indices)]
+
+def _options(args):
+    """
+    Split command-line arguments into a dictionary of options
+    and a list of positional arguments. Options can be given as
+    `--name=value`, `--name value` or `-n value`; options
+    followed by another option or nothing are flags.
+    """
+    options, positional = {}, []
+    n = 0
+    while n < len(args):
+        arg = args[n]
+        if arg.startswith('-') and len(arg) > 1 and not _is_number(arg):
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+            elif n + 1 < len(args) and (not args[n + 1].startswith('-') or _is_number(args[n + 1])):
+                key, value = arg, args[n + 1]
+                n += 1
+            else:
+                key, value = arg, True
+            options[key.lstrip('-')] = value
+        else:
+            positional.append(arg)
+        n += 1
+    return options, positional
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def _save_matrix(matrix, name):
+    Path(name).parent.mkdir(parents=True, exist_ok=True)
+    np.savetxt(name, matrix, fmt='%.6f')
+
+# the stand-ins. each is called with the tool's arguments.
+
+def fslroi(args):
+    data, affine = _load(args[0])
+    tmin, tsize = int(args[-2]), int(args[-1])
+    _save(data[..., tmin:tmin + tsize], affine, args[1])
+
+def _dilate(data, width):
+    # maximum over a box of `width` voxels in each spatial dimension
+    radius = width // 2
+    padded = np.pad(data, [(radius, radius)] * 3 + [(0, 0)] * (data.ndim - 3))
+    out = data.copy()
+    for dx in range(width):
+        for dy in range(width):
+            for dz in range(width):
+                shifted = padded[dx:dx + data.shape[0], dy:dy + data.shape[1], 
+                                 dz:dz + data.shape[2]]
+                out = np.maximum(out, shifted)
+    return out
+
+def fslmaths(args):
+    data, affine = _load(args[0])
+    kernel_width = 3
+    n = 1
+    while n < len(args) - 1:
+        op = args[n]
+        if op in ('-div', '-mul', '-add', '-sub', '-thr', '-uthr'):
+            value = args[n + 1]
+            other = float(value) if _is_number(value) else _load(value)[0]
+            if not np.isscalar(other) and other.ndim < data.ndim:
+                other = other[..., np.newaxis]
+            elif not np.isscalar(other) and other.ndim > data.ndim:
+                data = data[..., np.newaxis]
+            with np.errstate(all='ignore'):
+                if op == '-div':
+                    data = np.where(other != 0, data / other, 0)
+                elif op == '-mul':
+                    data = data * other
+                elif op == '-add':
+                    data = data + other
+                elif op == '-sub':
+                    data = data - other
+                elif op == '-thr':
+                    data = np.where(data < other, 0, data)
+                else:
+                    data = np.where(data > other, 0, data)
+            n += 2
+        elif op == '-mas':
+            mask = _load(args[n + 1])[0] > 0
+            mask = mask.reshape(mask.shape[:3] + (1, ) * (data.ndim - 3))
+            data = data * mask
+            n += 2
+        elif op == '-kernel':
+            kernel_width = int(float(args[n + 2]))
+            n += 3
+        elif op == '-dilF':
+            data = _dilate(data, kernel_width)
+            n += 1
+        elif op == '-bin':
+            data = (data > 0).astype(np.float32)
+            n += 1
+        elif op == '-Tmean':
+            data = data.mean(axis=3) if data.ndim == 4 else data
+            n += 1
+        elif op in ('-fillh', '-fmedian'):
+            n += 1
+        elif op == '-odt':
+            n += 2
+        else:
+            raise ValueError(f'Unsupported fslmaths operation {op}')
+    _save(data, affine, args[-1])
+
+def bet(args):
+    data, affine = _load(args[0])
+    options, _ = _options(args[2:])
+    mask = data > data.mean()
+    _save(data * mask, affine, args[1])
+    if 'm' in options:
+        out = args[1].replace('.nii.gz', '').replace('.nii', '')
+        _save(mask, affine, out + '_mask')
+
+def fast(args):
+    # the input is always last, possibly after a flag
+    options, _ = _options(args[:-1])
+    data, affine = _load(args[-1])
+    base = options['o'] if 'o' in options else options['out']
+    _save(np.ones_like(data), affine, base + '_bias')
+    _save((data > data.mean()).astype(np.float32), affine, base + '_seg')
+
+def asl_file(args):
+    options, _ = _options(args)
+    data, affine = _load(options['data'])
+    # volumes are numbered from 1, so the even ones are the second of each pair
+    _save(data[..., 1::2], affine, options['out'] + '_even')
+    _save(data[..., 0::2], affine, options['out'] + '_odd')
+
+# parameters of each Fabber model whose mean maps are written
+FABBER_PARAMS = {
+    'satrecov': ('M0t', 'T1t', 'A'),
+    'aslrest': ('ftiss', 'delttiss')
+}
+
+def fabber(args):
+    options, _ = _options(args)
+    if 'f' in options:
+        # options file, one option per line
+        with open(options['f'], 'r') as infile:
+            lines = [line.strip() for line in infile if line.strip()]
+        options.update(_options(['--' + line.lstrip('-') for line in lines])[0])
+    if 'listmodels' in options:
+        print('\n'.join(FABBER_PARAMS))
+        return
+    if 'version' in options:
+        print('stub')
+        return
+    params = FABBER_PARAMS.get(options.get('model'), ('ftiss', ))
+    if 'listparams' in options or 'listoutputs' in options:
+        print('\n'.join(params))
+        return
+    data, affine = _load(options['data'])
+    out_dir = Path(options['output'])
+    out_dir.mkdir(parents=True, exist_ok=True)
+    spatial = data[..., 0]
+    mask = _load(options['mask'])[0] > 0 if 'mask' in options else np.ones(spatial.shape, bool)
+    if 'pvgm' in options:
+        spatial = spatial * _load(options['pvgm'])[0]
+    for n, param in enumerate(params):
+        value = 1.3 if param == 'T1t' else spatial * (n + 1) / len(params)
+        _save(np.broadcast_to(value, spatial.shape) * mask, affine, out_dir / f'mean_{param}')
+        _save(np.full(spatial.shape, 0.1) * mask, affine, out_dir / f'std_{param}')
+    if 'save-mvn' in options:
+        n_mvn = len(params) * (len(params) + 1) // 2 + len(params) + 1
+        _save(np.zeros((*spatial.shape, n_mvn)), affine, out_dir / 'finalMVN')
+    with open(out_dir / 'paramnames.txt', 'w') as outfile:
+        outfile.write('\n'.join(params) + '\n')
+    with open(out_dir / 'logfile', 'w') as outfile:
+        outfile.write('Stub Fabber run\n')
+
+def mcflirt(args):
+    options, _ = _options(args)
+    data, affine = _load(options['in'])
+    out = options.get('out', options['in'] + '_mcf')
+    _save(data, affine, out)
+    if 'mats' in options:
+        mat_dir = Path(f'{out}.mat')
+        mat_dir.mkdir(parents=True, exist_ok=True)
+        for n in range(data.shape[3] if data.ndim == 4 else 1):
+            _save_matrix(np.eye(4), mat_dir / f'MAT_{n:04d}')
+
+def flirt(args):
+    options, _ = _options(args)
+    data, _ = _load(options['in'])
+    ref, affine = _load(options['ref'])
+    if 'out' in options:
+        _save(_resample(data, ref.shape), affine, options['out'])
+    if 'omat' in options:
+        _save_matrix(np.eye(4), options['omat'])
+
+def applyxfm4D(args):
+    data, _ = _load(args[0])
+    ref, affine = _load(args[1])
+    _save(_resample(data, ref.shape), affine, args[2])
+
+def fslmerge(args):
+    images = [_load(name) for name in args[2:]]
+    volumes = [data if data.ndim == 4 else data[..., np.newaxis] for data, _ in images]
+    _save(np.concatenate(volumes, axis=3), images[0][1], args[1])
+
+def topup(args):
+    options, _ = _options(args)
+    data, affine = _load(options['imain'])
+    _save(np.zeros(data.shape[:3]), affine, options['fout'])
+    _save(data, affine, options['iout'])
+    _save(np.zeros(data.shape[:3]), affine, options['out'] + '_fieldcoef')
+    np.savetxt(options['out'] + '_movpar.txt', np.zeros((data.shape[3], 6)))
+
+def asl_reg(args):
+    options, _ = _options(args)
+    out_dir = Path(options['o'])
+    struct, affine = _load(options['s'])
+    _save_matrix(np.eye(4), out_dir / 'asl2struct.mat')
+    _save_matrix(np.eye(4), out_dir / 'struct2asl.mat')
+    if 'finalonly' in options:
+        _save(np.zeros((*struct.shape[:3], 3)), affine, out_dir / 'asl2struct_warp')
+
+def convert_xfm(args):
+    options, positional = _options(args)
+    if 'inverse' in options:
+        source = options['inverse'] if options['inverse'] is not True else positional[-1]
+        matrix = np.linalg.inv(np.loadtxt(source))
+    elif 'concat' in options:
+        matrix = np.loadtxt(options['concat']) @ np.loadtxt(positional[-1])
+    else:
+        matrix = np.loadtxt(positional[-1])
+    _save_matrix(matrix, options['omat'])
+
+def fslcpgeom(args):
+    _, affine = _load(args[0])
+    data, _ = _load(args[1])
+    _save(data, affine, _find(args[1]), keep_ext=True)
+
+def imcp(args):
+    source = _find(args[0])
+    dest = args[1]
+    if not (dest.endswith('.nii.gz') or dest.endswith('.nii')):
+        dest += '.nii.gz' if source.endswith('.nii.gz') else '.nii'
+    shutil.copyfile(source, dest)
+
+def convertwarp(args):
+    options, _ = _options(args)
+    ref, affine = _load(options.get('ref', options.get('r')))
+    _save(np.zeros((*ref.shape[:3], 3)), affine, options.get('out', options.get('o')))
+
+def fnirtfileutils(args):
+    options, _ = _options(args)
+    warp, affine = _load(options['i'])
+    if 'j' in options:
+        _save(np.ones(warp.shape[:3]), affine, options['j'])
+    if 'o' in options:
+        _save(warp, affine, options['o'])
+
+def applywarp(args):
+    options, _ = _options(args)
+    data, _ = _load(options.get('in', options.get('i')))
+    ref, affine = _load(options.get('ref', options.get('r')))
+    _save(_resample(data, ref.shape), affine, options.get('out', options.get('o')))
+
+def gradient_unwarp(args):
+    # gradient_unwarp.py writes to the working directory
+    data, affine = _load(args[0])
+    _save(data, affine, args[1], keep_ext=True)
+    _save(np.zeros((*data.shape[:3], 3)), affine, 'fullWarp_abs.nii.gz', keep_ext=True)
+
+def _fabber_asl():
+    """
+    The fabber_asl oxford_asl runs, preferring the one in
+    $FSLDEVDIR/bin to the one in $FSLDIR/bin.
+    """
+    for root in (os.environ.get('FSLDEVDIR'), os.environ.get('FSLDIR')):
+        if root and os.path.isfile(os.path.join(root, 'bin', 'fabber_asl')):
+            return os.path.join(root, 'bin', 'fabber_asl')
+    return 'fabber_asl'
+
+def _basil(options, mask_name, out_dir):
+    """
+    Run fabber_asl as basil does, once without and, with
+    --pvcorr, once with the partial volume estimates, returning
+    the perfusion and arrival time means and variances of each.
+    """
+    steps = [('', 'step1', [])]
+    if 'pvcorr' in options:
+        steps.append(('pvcorr', 'step2', [f"pvgm={options['pvgm']}", 
+                                          f"pvwm={options['pvwm']}"]))
+    method = 'vb' if options.get('spatial') == 'off' else 'spatialvb'
+    fits = []
+    for sub_dir, step, extra in steps:
+        optfile = out_dir / f'{step}_options.txt'
+        optfile.parent.mkdir(parents=True, exist_ok=True)
+        optfile.write_text('\n'.join(['model=aslrest', f'method={method}', 'save-mvn', 
+                                      f'mask={mask_name}', *extra]) + '\n')
+        subprocess.run([_fabber_asl(), f"--data={options['i']}", 
+                        f'--output={out_dir / step}', '-f', str(optfile)], check=True)
+        results = {}
+        for param, name in (('ftiss', 'perfusion'), ('delttiss', 'arrival')):
+            results[name] = _load(out_dir / step / f'mean_{param}')[0]
+            results[f'{name}_var'] = _load(out_dir / step / f'std_{param}')[0]**2
+        fits.append((sub_dir, results))
+    return fits
+
+def oxford_asl(args):
+    options, _ = _options(args)
+    data, affine = _load(options['i'])
+    out_dir = Path(options['o'])
+    mask_name = options.get('m')
+    if mask_name is None:
+        mask_name = out_dir / 'mask'
+        _save(np.ones(data.shape[:3]), affine, mask_name)
+    mask = _load(mask_name)[0] > 0
+    fits = _basil(options, _find(mask_name), out_dir / 'basil')
+    # a single M0 from the calibration image within the whole mask
+    m0 = float(np.mean(_load(options['c'])[0][mask])) if 'c' in options else None
+    spaces = [('native_space', None, affine)]
+    if 's' in options:
+        struct, struct_affine = _load(options['s'])
+        spaces.append(('struct_space', struct.shape, struct_affine))
+    for space, shape, space_affine in spaces:
+        for sub_dir, results in fits:
+            outputs = dict(results)
+            if sub_dir == 'pvcorr':
+                outputs['perfusion_wm'] = results['perfusion'] / 2
+                outputs['perfusion_wm_var'] = results['perfusion_var'] / 4
+            if m0 is not None:
+                for name in [name for name in outputs if name.startswith('perfusion')]:
+                    scale = m0**2 if name.endswith('_var') else m0
+                    outputs[f'{name}_calib'] = outputs[name] / scale
+            for name, values in outputs.items():
+                values = values if shape is None else _resample(values, shape)
+                _save(values, space_affine, out_dir / space / sub_dir / name)
+    if m0 is not None:
+        (out_dir / 'calib').mkdir(parents=True, exist_ok=True)
+        np.savetxt(out_dir / 'calib/M0.txt', [m0])
+    with open(out_dir / 'logfile', 'w') as outfile:
+        outfile.write('Stub oxford_asl run\n')
+
+def asl_calib(args):
+    options, _ = _options(args)
+    calib, _ = _load(options['c'])
+    out_dir = Path(options['o'])
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if 'bmask' in options:
+        mask, _ = _load(options['bmask'])
+        calib = calib[mask.reshape(calib.shape) > 0]
+    np.savetxt(out_dir / 'M0.txt', [float(np.mean(calib))])
+
+def wb_command(args):
+    if args[0] != '-volume-to-surface-mapping':
+        raise ValueError(f'Unsupported wb_command operation {args[0]}')
+    data, _ = _load(args[1])
+    n_vertices = nb.load(args[2]).darrays[0].data.shape[0]
+    values = np.resize(data.ravel(), n_vertices).astype(np.float32)
+    func = nb.gifti.GiftiImage(darrays=[nb.gifti.GiftiDataArray(values)])
+    nb.save(func, args[3])
+
+TOOLS = {
+    'fslroi': fslroi,
+    'fslmaths': fslmaths,
+    'bet': bet,
+    'fast': fast,
+    'asl_file': asl_file,
+    'fabber': fabber,
+    'fabber_asl': fabber,
+    'mcflirt': mcflirt,
+    'flirt': flirt,
+    'applyxfm4D': applyxfm4D,
+    'fslmerge': fslmerge,
+    'topup': topup,
+    'asl_reg': asl_reg,
+    'convert_xfm': convert_xfm,
+    'fslcpgeom': fslcpgeom,
+    'imcp': imcp,
+    'convertwarp': convertwarp,
+    'fnirtfileutils': fnirtfileutils,
+    'applywarp': applywarp,
+    'gradient_unwarp.py': gradient_unwarp,
+    'oxford_asl': oxford_asl,
+    'asl_calib': asl_calib,
+    'wb_command': wb_command,
+}
+
+def tool_delay(tool):
+    """
+    Return the delay of `tool` set in the environment, in seconds.
+    """
+    delays = json.loads(os.environ.get('HCPASL_STUB_DELAYS', '{}'))
+    return float(delays.get(tool, os.environ.get('HCPASL_STUB_DELAY', 0)))
+
+def install_stubs(bin_dir):
+    """
+    Create an executable wrapper in `bin_dir` for each tool which
+    runs its stand-in with the current Python interpreter.
+    """
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    script = Path(__file__).resolve()
+    for tool in TOOLS:
+        wrapper = bin_dir / tool
+        with open(wrapper, 'w') as outfile:
+            outfile.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" {tool} "$@"\n')
+        wrapper.chmod(0o755)
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    start = time.time()
+    time.sleep(tool_delay(tool))
+    TOOLS[tool](args)
+    log_name = os.environ.get('HCPASL_STUB_LOG')
+    if log_name:
+        entry = {'tool': tool, 'args': args, 'start': start, 'seconds': time.time() - start}
+        with open(log_name, 'a') as outfile:
+            outfile.write(json.dumps(entry) + '\n')
+
+if __name__ == '__main__':
+    main()
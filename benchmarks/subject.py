@@ -0,0 +1,157 @@
+"""
+Generator of synthetic subject directories laid out like the HCP
+data the pipeline expects, for running the whole pipeline with the
+stand-in executables in `stub_tools.py`.
+
+A generated subject contains:
+    - the mbPCASL sequence, with the ASL series followed by the
+        calibration images, in
+        `{subject}_V1_B/scans/*mbPCASLhr/resources/NIFTI/files`
+    - a pair of spin echo field maps in the same session
+    - the T1w images and aparc+aseg segmentation in `T1w`
+    - white, pial and midthickness surfaces of both hemispheres
+        in `T1w/fsaverage_LR32k`
+along with an MT correction scaling factors image shared by all
+subjects in the study.
+"""
+
+from . import phantoms
+from pathlib import Path
+import numpy as np
+import nibabel as nb
+
+ASL_VOXEL = 2.5
+T1W_VOXEL = 0.7
+
+def _affine(shape, voxel):
+    """
+    Return an affine with voxels of size `voxel` and the world
+    origin at the centre of the field of view.
+    """
+    affine = np.diag([voxel, voxel, voxel, 1.0])
+    affine[:3, 3] = -voxel * (np.array(shape[:3]) - 1) / 2
+    return affine
+
+def _save(data, affine, name):
+    name = Path(name)
+    name.parent.mkdir(parents=True, exist_ok=True)
+    nb.save(nb.Nifti1Image(data, affine), str(name))
+
+def icosphere(subdivisions):
+    """
+    Return the vertices and triangles of a unit sphere made by
+    subdividing the faces of an icosahedron `subdivisions` times.
+    """
+    t = (1 + np.sqrt(5)) / 2
+    vertices = [
+        (-1, t, 0), (1, t, 0), (-1, -t, 0), (1, -t, 0),
+        (0, -1, t), (0, 1, t), (0, -1, -t), (0, 1, -t),
+        (t, 0, -1), (t, 0, 1), (-t, 0, -1), (-t, 0, 1)
+    ]
+    vertices = [np.array(v) / np.linalg.norm(v) for v in vertices]
+    faces = [
+        (0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+        (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+        (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+        (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)
+    ]
+    for _ in range(subdivisions):
+        midpoints = {}
+        def midpoint(a, b):
+            key = (min(a, b), max(a, b))
+            if key not in midpoints:
+                v = vertices[a] + vertices[b]
+                vertices.append(v / np.linalg.norm(v))
+                midpoints[key] = len(vertices) - 1
+            return midpoints[key]
+        new_faces = []
+        for a, b, c in faces:
+            ab, bc, ca = midpoint(a, b), midpoint(b, c), midpoint(c, a)
+            new_faces += [(a, ab, ca), (b, bc, ab), (c, ca, bc), (ab, bc, ca)]
+        faces = new_faces
+    return np.array(vertices, dtype=np.float32), np.array(faces, dtype=np.int32)
+
+def _save_surface(vertices, triangles, name):
+    name = Path(name)
+    name.parent.mkdir(parents=True, exist_ok=True)
+    surface = nb.gifti.GiftiImage(darrays=[
+        nb.gifti.GiftiDataArray(vertices, intent='NIFTI_INTENT_POINTSET',
+                                datatype='NIFTI_TYPE_FLOAT32'),
+        nb.gifti.GiftiDataArray(triangles, intent='NIFTI_INTENT_TRIANGLE',
+                                datatype='NIFTI_TYPE_INT32')
+    ])
+    nb.save(surface, str(name))
+
+def make_mt_factors(name, scale=1.0):
+    """
+    Save an MT correction scaling factors image for ASL data
+    scaled by `scale` to `name`.
+    """
+    shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)[:3]
+    factors = phantoms.scaling_factors((*shape, 1))[..., 0]
+    _save(factors, _affine(shape, ASL_VOXEL / scale), name)
+    return Path(name)
+
+def make_subject(study_dir, subject='HCA0000000', scale=1.0, subdivisions=5, seed=0):
+    """
+    Create a synthetic subject directory `subject` in `study_dir`.
+
+    Inputs:
+        - `study_dir` = directory in which to create the subject
+        - `subject` = name of the subject
+        - `scale` = factor by which to scale the in-plane
+            dimensions of the ASL data and all dimensions of the
+            structural data, keeping the same field of view.
+            Default is 1, the dimensions of HCP data.
+        - `subdivisions` = number of subdivisions of the
+            icosahedra making up the surfaces. Default of 5 gives
+            10242 vertices per surface.
+        - `seed` = seed of the random noise in the images
+
+    Returns the pathlib.Path of the subject's directory.
+    """
+    subject_dir = Path(study_dir) / subject
+    session_dir = subject_dir / f'{subject}_V1_B/scans'
+    files = 'resources/NIFTI/files'
+
+    # mbPCASL sequence: ASL series, 2 unused volumes, then 2 calibration images
+    asl_shape = phantoms.scale_shape(phantoms.ASL_SHAPE, scale, n_dims=2)
+    asl_affine = _affine(asl_shape, ASL_VOXEL / scale)
+    series = phantoms.asl_series(asl_shape, seed)
+    m0 = np.where(phantoms.brain_mask(asl_shape), 1000, 50).astype(np.float32)
+    extra = np.repeat(m0[..., np.newaxis], 4, axis=3)
+    mbpcasl = np.concatenate((series, extra), axis=3)
+    _save(mbpcasl, asl_affine,
+          session_dir / f'1-mbPCASLhr/{files}/{subject}_V1_B_mbPCASLhr_PA.nii.gz')
+
+    # spin echo field maps, PA then AP
+    for n, direction in ((2, 'PA'), (3, 'AP')):
+        _save(m0[..., np.newaxis], asl_affine,
+              session_dir / f'{n}-FieldMap_SE_EPI/{files}/'
+              f'{subject}_V1_B_PCASLhr_SpinEchoFieldMap_{direction}.nii.gz')
+
+    # structural images
+    t1w_dir = subject_dir / 'T1w'
+    t1w_shape = phantoms.scale_shape(phantoms.T1W_SHAPE, scale)
+    t1w_affine = _affine(t1w_shape, T1W_VOXEL / scale)
+    labels = phantoms.aparc_aseg(t1w_shape)
+    t1w = np.where(labels > 0, 600, 0).astype(np.float32)
+    t1w[(labels == 2) | (labels == 41)] = 900
+    _save(t1w, t1w_affine, t1w_dir / 'T1w_acpc_dc.nii.gz')
+    _save(t1w, t1w_affine, t1w_dir / 'T1w_acpc_dc_restore.nii.gz')
+    _save(t1w, t1w_affine, t1w_dir / 'T1w_acpc_dc_restore_brain.nii.gz')
+    _save(labels, t1w_affine, t1w_dir / 'aparc+aseg.nii.gz')
+
+    # surfaces: an ellipsoid per hemisphere, with the white surface
+    # inside the midthickness inside the pial
+    sphere, triangles = icosphere(subdivisions)
+    fov = np.array(t1w_shape) * T1W_VOXEL / scale
+    radii = np.array([0.18, 0.4, 0.35]) * fov
+    for side, sign in (('L', -1), ('R', 1)):
+        centre = np.array([sign * 0.2 * fov[0], 0, 0])
+        for surf, size in (('white', 0.85), ('midthickness', 0.925), ('pial', 1.0)):
+            _save_surface(
+                (centre + size * radii * sphere).astype(np.float32), triangles,
+                t1w_dir / f'fsaverage_LR32k/{subject}_V1_MR.{side}.{surf}.32k_fs_LR.surf.gii'
+            )
+    return subject_dir
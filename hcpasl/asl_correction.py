@@ -30,23 +30,35 @@ Corrections to be applied include:
 """
 
 from .initial_bookkeeping import create_dirs
-from .m0_mt_correction import load_json, update_json
-from fsl.wrappers import fslmaths, LOAD
-from fsl.wrappers.flirt import mcflirt, applyxfm, applyxfm4D
+from .manifest import Manifest
+from .profiling import profiled, profile_step
+from .image_format import intermediate_name, image_stem, fsl_env
+from .image_cache import load_image, save_image
+from .voxelwise import voxelwise
+from .nifti_stream import image_source, open_output
+from .satrecov import satrecov_engine, native_saturation_recovery
+from .fabber_parallel import run_fabber_parallel
+from .resample import resample_series
+from .transforms import TransformSeries
+from .spatial_filter import median_filter
+from fsl.wrappers import LOAD
 from fsl.data.image import Image
 from fabber import Fabber, percent_progress
 import sys
 from pathlib import Path
 import shutil
 import subprocess
+import os
 import numpy as np
-def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
+def _satrecov_worker(control_img, satrecov_dir, tis, rpts, ibf, spatial, mask_name=None):
     """
     Runs fabber's saturation recovery model on the given sequence 
     of control images.
 
     Inputs:
-        - `control_name` = name of control sequence
+        - `control_img` = fsl.data.image.Image of the control 
+            sequence, whose data is passed to Fabber in memory, 
+            or written once for the non-spatial run's workers
         - `satrecov_dir` = parent directory for the satrecov 
             results. Results from this will be stored either 
             in {`satrecov_dir`}/spatial or 
@@ -56,11 +68,16 @@ def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
         - `rpts` = list of repeats for each TI in the sequence
         - `ibf` = input format of the sequence
         - `spatial` = Boolean for whether to run fabber in 
-            spatial (True) or non-spatial (False) mode
+            spatial (True) or non-spatial (False) mode. The 
+            non-spatial run is split between worker processes 
+            by `fabber_parallel.run_fabber_parallel`.
+        - `mask_name` = name of a brain mask to which the fit is 
+            restricted (optional). Voxels outside the mask are 
+            zero in the results.
     """
     # set options for Fabber run, generic to spatial and non-spatial runs
     options = {
-        'data': str(control_name),
+        'data': control_img.data,
         'overwrite': True,
         'noise': 'white',
         'ibf': ibf,
@@ -82,6 +99,8 @@ def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
         'rpt5': rpts[4],
         'fixa': True
     }
+    if mask_name is not None:
+        options['mask'] = str(mask_name)
     # spatial or non-spatial specific options
     spatial_dir = satrecov_dir / 'spatial'
     nospatial_dir = satrecov_dir / 'nospatial'
@@ -100,6 +119,11 @@ def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
             'save-mvn': True
         }
     options.update(extra_options)
+    if not spatial:
+        # voxels are fitted independently so split them between workers
+        with profile_step('satrecov_nospatial'):
+            run_fabber_parallel(options, control_img)
+        return
     # run Fabber
     fab = Fabber()
     run = fab.run(options, progress_cb=percent_progress(sys.stdout))# Basic interaction with the run output
@@ -108,39 +132,45 @@ def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
     for name, data in run.data.items():
         print("%s: %s" % (name, data.shape))
     print("Run finished at: %s" % run.timestamp_str)
-    # Write full contents out to a directory
-    # load control image to get header for saving
-    control_img = Image(str(control_name))
+    # Write full contents out to a directory, using the control image's header
     run.write_to_dir(out_dir, ref_nii=control_img)
 
 def _split_tag_control(asl_name, ntis, iaf, ibf, rpts):
     """
     Given and ASL time series, `asl_name`, and the sequence details, 
-    split the series into 2 files, even and odd. Save these with the 
-    base of `asl_name`_even.nii.gz for example.
+    split the series into its control and tag images, as 
+    `asl_file --spairs` does.
+
+    The series' volumes are in pairs ordered by `iaf`, "tc" for 
+    tag-control or "ct" for control-tag, so the split images are 
+    strided views of the loaded series rather than copies, sharing 
+    its header, and aren't saved.
 
     Inputs:
         - `asl_name` = pathlib.Path object for the ASL series to be 
             split
+        - `iaf` = order of the tag and control images in each pair
+
+    Returns the control and tag images as fsl.data.image.Images.
     """
-    asl_base = asl_name.parent / asl_name.stem.split('.')[0]
-    # messy - is there a better way of filling in arguments?
-    cmd = [
-        'asl_file',
-        f'--data={str(asl_name)}',
-        f'--ntis={ntis}',
-        f'--iaf={iaf}',
-        f'--ibf={ibf}',
-        '--spairs',
-        f'--rpts={rpts[0]},{rpts[1]},{rpts[2]},{rpts[3]},{rpts[4]}',
-        f'--out={asl_base}'
-    ]
-    subprocess.run(cmd)
-    even_name = asl_name.parent / f'{asl_base}_even.nii.gz'
-    odd_name = asl_name.parent / f'{asl_base}_odd.nii.gz'
-    return even_name, odd_name
-
-def _saturation_recovery(asl_name, results_dir, ntis, iaf, ibf, tis, rpts):
+    if iaf not in ('tc', 'ct'):
+        raise ValueError(f'Unknown tag-control order {iaf}, expected "tc" or "ct".')
+    asl_img = load_image(asl_name)
+    n_volumes = 2 * sum(rpts)
+    if asl_img.ndim != 4 or asl_img.shape[3] != n_volumes:
+        raise ValueError(f'ASL series of shape {asl_img.shape} does not have the '
+                         + f'{n_volumes} volumes of {ntis} TIs with repeats {rpts}.')
+    data = asl_img.data
+    tag_first = iaf == 'tc'
+    control_img = Image(data[..., 1::2] if tag_first else data[..., 0::2],
+                        header=asl_img.header)
+    tag_img = Image(data[..., 0::2] if tag_first else data[..., 1::2],
+                    header=asl_img.header)
+    return control_img, tag_img
+
+@profiled
+def _saturation_recovery(asl_name, results_dir, ntis, iaf, ibf, tis, rpts,
+                         slicedt=0.059, sliceband=10, mask_name=None):
     """
     Wrapper function for Fabber's `satrecov` model.
 
@@ -153,41 +183,81 @@ def _saturation_recovery(asl_name, results_dir, ntis, iaf, ibf, tis, rpts):
         - once with spatial mode off
         - once with spatial mode on, initialised from the 
             prior run
+
+    If the native satrecov engine has been selected, the model 
+    is instead fitted by `satrecov.native_saturation_recovery` 
+    and the estimates are stored in `native`.
     
     Inputs:
         - `asl_name` = pathlib.Path object for the ASL series on 
             which the model will be estimated
         - `results_dir` = pathlib.Path object in which to store the 
             `nospatial` and `spatial` parameter estimates
+        - `mask_name` = name of a brain mask to which the fit is 
+            restricted (optional)
+
+    Returns the name of the T1t estimate.
     """
     # obtain control images of ASL series
-    control_name, tag_name = _split_tag_control(asl_name, ntis, iaf, ibf, rpts)
+    control_img, tag_img = _split_tag_control(asl_name, ntis, iaf, ibf, rpts)
+    if satrecov_engine() == 'native':
+        return native_saturation_recovery(control_img, results_dir / 'native', 
+                                          tis, rpts, slicedt, sliceband, mask_name)
     # satrecov nospatial
-    _satrecov_worker(control_name, results_dir, tis, rpts, ibf, spatial=False)
+    _satrecov_worker(control_img, results_dir, tis, rpts, ibf, spatial=False, mask_name=mask_name)
     # satrecov spatial
-    _satrecov_worker(control_name, results_dir, tis, rpts, ibf, spatial=True)
+    _satrecov_worker(control_img, results_dir, tis, rpts, ibf, spatial=True, mask_name=mask_name)
     t1_name = results_dir / 'spatial/mean_T1t.nii.gz'
     return t1_name
 
-def _fslmaths_med_filter_wrapper(image_name):
+@profiled
+def _median_filter(image_name, mask_name=None):
     """
-    Simple wrapper for fslmaths' median filter function. Applies 
-    the median filter to `image_name`. Derives and returns the 
-    name of the filtered image as {image_name}_filt.nii.gz.
+    Applies a 3x3x3 median filter to `image_name`, as 
+    `fslmaths -fmedian` does. Derives and returns the name of 
+    the filtered image as {image_name}_filt.nii.gz.
+
+    If `mask_name` is given, only voxels within the mask 
+    contribute to the medians and voxels outside the mask are 
+    zero, so that the filtered image has the same extent as the 
+    masked estimates.
     """
-    filtered_name = image_name.parent / f'{image_name.stem.split(".")[0]}_filt.nii.gz'
-    cmd = [
-        'fslmaths',
-        image_name,
-        '-fmedian',
-        filtered_name
-    ]
-    subprocess.run(cmd)
+    filtered_name = intermediate_name(image_name.parent, f'{image_stem(image_name)}_filt')
+    image = load_image(image_name)
+    mask = None if mask_name is None else load_image(mask_name).data
+    filtered = median_filter(image.data, mask=mask)
+    save_image(Image(filtered, header=image.header), filtered_name)
     return filtered_name
 
+def _t1_terms(t1_data, slice_offsets):
+    """
+    Return the terms of the slice-timing correction which only 
+    depend on the T1t map `t1_data`: a mask of the voxels with a 
+    T1t estimate, the T1t map with the other voxels set to 1 and 
+    exp{-n*slicedt/T1t} for the slice offset of each voxel.
+    """
+    t1_data = np.asarray(t1_data, dtype=np.float32)
+    fitted = t1_data > 0
+    t1_data = np.where(fitted, t1_data, np.float32(1))
+    slice_decay = np.exp(-slice_offsets / t1_data)
+    return fitted, t1_data, slice_decay
+
+def _st_factors(t1_terms, ti):
+    """
+    Slice-timing correction scaling factors at TI `ti` given the 
+    `t1_terms` of a T1t map, using 
+    exp{-(TI + n*slicedt)/T1t} = exp{-TI/T1t} * exp{-n*slicedt/T1t}.
+    """
+    fitted, t1_data, slice_decay = t1_terms
+    ti_decay = np.exp(np.float32(-ti) / t1_data)
+    factors = (1 - ti_decay) / (1 - ti_decay * slice_decay)
+    return np.where(fitted, factors, np.float32(1))
+
+@profiled
 def _slicetiming_correction(
     asl_name, t1_name, tis, rpts, 
-    slicedt, sliceband, n_slices
+    slicedt, sliceband, n_slices,
+    stcorr_name, factors_name
     ):
     """
     Performs rescaling of ASL series, `asl_name`, accounting for 
@@ -204,90 +274,95 @@ def _slicetiming_correction(
     at t = TI, i.e. scales the values as if they had been imaged 
     at the TI that was specified in the ASL sequence.
 
-    Returns the slice-timing corrected ASL series, `stcorr_img`, 
-    and the scaling factors used to perform the correction, 
-    `stcorr_factors_img` where:
+    Voxels with a T1t of zero, i.e. those outside the mask used 
+    to fit the satrecov model, are left unscaled.
+
+    `asl_name` and `t1_name` can be filenames or images already 
+    in memory. `t1_name` is either a single T1t map or a map for 
+    each volume of the series.
+
+    The series is corrected one TI at a time in float32 and the 
+    results are written as they are computed. As both passes of 
+    the correction read the same series, it is read through the 
+    image cache if it fits. For a single T1t 
+    map, the scaling factors of each TI are evaluated once and 
+    used for all of its repeats.
+
+    Saves the slice-timing corrected ASL series to `stcorr_name` 
+    and the scaling factors used to perform the correction to 
+    `factors_name` where:
         `stcorr_factors` = S(TI) / S(TI + n*slicedt)
         `stcorr_img` = `stcorr_factors` * `asl_name`
     """
-    # timing information for scan
-    # supposed measurement time of slice
-    tis_array = np.repeat(np.array(tis), 2*np.array(rpts)).reshape(1, 1, 1, -1)
-    # actual measurment time of slice
-    slice_numbers = np.tile(
-        np.arange(0, sliceband),
+    # time after the TI at which each slice is measured
+    slice_offsets = np.float32(slicedt) * np.tile(
+        np.arange(0, sliceband, dtype=np.float32),
         n_slices // sliceband
-    ).reshape(1, 1, -1, 1)
-    slice_times = tis_array + (slicedt * slice_numbers)
-    # load images
-    asl_img = Image(str(asl_name))
-    t1_img = Image(str(t1_name))
-    # check dimensions of t1 image to see if time series or not
-    if t1_img.ndim == 3:
-        t1_data = t1_img.data[..., np.newaxis]
-    elif t1_img.ndim == 4:
-        t1_data = t1_img.data
-    # multiply asl sequence by satrecov model evaluated at TI
-    numexp = - tis_array / t1_data
-    num = 1 - np.exp(numexp)
-    # divide asl sequence by satrecov model evaluated at actual slice-time
-    denexp = - slice_times / t1_data
-    den = 1 - np.exp(denexp)
-    # evaluate scaling factors
-    stcorr_factors = num / den
-    stcorr_factors_img = Image(stcorr_factors, header=asl_img.header)
-    # correct asl series
-    stcorr_data = asl_img.data * stcorr_factors
-    stcorr_img = Image(stcorr_data, header=asl_img.header)
-    return stcorr_img, stcorr_factors_img
-
-def _register_param(param_name, transform_dir, reffile, param_reg_name):
+    )
+    header, asl_data = image_source(asl_name, cache=True)
+    _, t1_data = image_source(t1_name)
+    shape = asl_data.shape
+    # a single T1t map, possibly stored as a 4D image of 1 volume
+    t1_terms = None
+    if len(t1_data.shape) == 3 or t1_data.shape[3] == 1:
+        t1_terms = _t1_terms(np.reshape(t1_data[...], t1_data.shape[:3]), slice_offsets)
+    elif t1_data.shape[3] != shape[3]:
+        raise ValueError(f'T1t estimates of shape {t1_data.shape} do not match the '
+                         + f'ASL series of shape {shape}.')
+
+    names = [stcorr_name, factors_name]
+    tmp_names = [Path(name).parent / f'.tmp.{Path(name).name}' for name in names]
+    files = [open_output(tmp_name, header, shape) for tmp_name in tmp_names]
+    try:
+        # the volumes of each TI, tag-control pairs of its repeats
+        stops = np.cumsum(2*np.array(rpts))
+        for ti, start, stop in zip(tis, stops - 2*np.array(rpts), stops):
+            if t1_terms is not None:
+                factors = _st_factors(t1_terms, ti)[..., np.newaxis]
+            else:
+                factors = np.stack([
+                    _st_factors(_t1_terms(t1_data[..., n], slice_offsets), ti)
+                    for n in range(start, stop)
+                ], axis=-1)
+            block = np.asarray(asl_data[..., start:stop], dtype=np.float32)
+            stcorr = block * factors
+            factors = np.broadcast_to(factors, block.shape)
+            for outfile, values in zip(files, (stcorr, factors)):
+                outfile.write(values.astype('<f4').tobytes(order='F'))
+    except BaseException:
+        for outfile in files:
+            outfile.close()
+        for tmp_name in tmp_names:
+            tmp_name.unlink(missing_ok=True)
+        raise
+    for outfile in files:
+        outfile.close()
+    for tmp_name, name in zip(tmp_names, names):
+        os.replace(tmp_name, name)
+    return stcorr_name, factors_name
+
+@profiled
+def _register_param(param_name, transforms, reffile, param_reg_name):
     """
     Given a parameter map, `param_name`, and a series of motion 
-    estimates, `transform_dir`, apply the motion estimates to 
+    estimates, `transforms`, apply the motion estimates to 
     the parameter map and obtain a time series of the map 
     in the frame described by the motion estimates.
 
     Inputs:
         - `param_name` = pathlib.Path object for the parameter 
             estimate
-        - `transform_dir` = pathlib.Path object for the 
-            directory containing mcflirt motion estimates
+        - `transforms` = `transforms.TransformSeries` of 
+            mcflirt motion estimates
         - `reffile` = filename for reference image in mcflirt 
             motion estimate
         - `param_reg_name` = name of output file
+
+    The parameter map is resampled in-process by each of the 
+    transformations, with trilinear interpolation as in 
+    `applyxfm`, and the time series written directly.
     """
-    # list of transformations in transform_dir
-    transforms = sorted(transform_dir.glob('**/*'))
-    out_names = []
-    for n, transform in enumerate(transforms):
-        # naming intermediate file
-        if n < 10:
-            out_n = param_reg_name.parent / f'{param_reg_name.stem.split(".")[0]}_000{n}.nii.gz'
-        else:
-            out_n = param_reg_name.parent / f'{param_reg_name.stem.split(".")[0]}_00{n}.nii.gz'
-        out_names.append(out_n)
-        applyxfm(str(param_name), str(reffile), str(transform), str(out_n))
-        cmd = [
-            "applyxfm4D",
-            str(param_name),
-            str(reffile),
-            str(out_n),
-            str(transform),
-            "-singlematrix"
-        ]
-        subprocess.run(cmd)
-    # merge registered parameter volumes into one time series
-    cmd = [
-        'fslmerge',
-        '-t',
-        str(param_reg_name),
-        *out_names
-    ]
-    subprocess.run(cmd)
-    # remove intermediate file names
-    for out_n in out_names:
-        out_n.unlink()
+    resample_series(param_name, transforms, reffile, param_reg_name)
 
 def hcp_asl_moco(subject_dir, mt_factors):
     """
@@ -319,28 +394,23 @@ def hcp_asl_moco(subject_dir, mt_factors):
     n_slices = 60
 
     # load json containing important file info
-    json_dict = load_json(subject_dir)
+    json_dict = Manifest.for_subject(subject_dir)
 
     # create directories for results
     tis_dir_name = Path(json_dict['TIs_dir'])
-    biascorr_dir_name = tis_dir_name / 'BiasCorr'
     mtcorr_dir_name = tis_dir_name / 'MTCorr'
     satrecov_dir_name = tis_dir_name / 'SatRecov'
     stcorr1_dir_name = tis_dir_name / 'STCorr/FirstPass'
     stcorr2_dir_name = tis_dir_name / 'STCorr/SecondPass'
     moco_dir_name = tis_dir_name / 'MoCo'
-    asln2m0_name = moco_dir_name / 'asln2m0.mat'
-    asln2asl0_name = moco_dir_name / 'asln2asl0.mat'
-    asl02asln_name = moco_dir_name / 'asl02asln.mat'
+    asln2m0_name = moco_dir_name / 'asln2m0.npy'
+    asln2asl0_name = moco_dir_name / 'asln2asl0.npy'
     create_dirs([
-        biascorr_dir_name, 
         mtcorr_dir_name, 
         satrecov_dir_name,
         stcorr1_dir_name,
         stcorr2_dir_name,
-        moco_dir_name,
-        asln2asl0_name,
-        asl02asln_name
+        moco_dir_name
     ])
 
     # bias-correction of original ASL series
@@ -349,66 +419,59 @@ def hcp_asl_moco(subject_dir, mt_factors):
     # possibly some rough registration from M0 to mean of ASL series
         # if doing the above, is it worth running BET on M0 images again
         # and changing f parameter so that the brain-mask is larger?
-    biascorr_name = biascorr_dir_name / 'tis_biascorr.nii.gz'
-    fslmaths(str(asl_name)).div(str(bias_name)).run(str(biascorr_name))
-    
-    # apply MT scaling factors to the bias-corrected ASL series
-    mtcorr_name = mtcorr_dir_name / 'tis_mtcorr.nii.gz'
-    fslmaths(str(biascorr_name)).mul(str(mt_factors)).run(str(mtcorr_name))
+    mtcorr_name = intermediate_name(mtcorr_dir_name, 'tis_mtcorr')
+    with profile_step('bias_mt_correction'):
+        # bias-correct and apply MT scaling factors to the ASL series in 
+        # one pass, only saving the MT-corrected series
+        voxelwise(asl_name).div(bias_name).mul(mt_factors).run(mtcorr_name)
 
     # estimate satrecov model on bias-corrected, MT-corrected ASL series
-    t1_name = _saturation_recovery(mtcorr_name, satrecov_dir_name, ntis, iaf, ibf, tis, rpts)
+    # only fitting the model within the brain mask of the calibration image
+    mask_name = json_dict['calib0_mask']
+    t1_name = _saturation_recovery(mtcorr_name, satrecov_dir_name, ntis, iaf, ibf, tis, rpts,
+                                   slicedt, sliceband, mask_name)
     # median filter the parameter estimates
-    t1_filt_name = _fslmaths_med_filter_wrapper(t1_name)
+    t1_filt_name = _median_filter(t1_name, mask_name)
     # perform initial slice-timing correction using estimated tissue params
-    stcorr_img, st_factors_img = _slicetiming_correction(mtcorr_name, t1_filt_name, tis, rpts, slicedt, sliceband, n_slices)
-    stcorr1_name = stcorr1_dir_name / 'tis_stcorr.nii.gz'
-    stcorr_img.save(stcorr1_name)
-    st_factors1_name = stcorr1_dir_name / 'st_scaling_factors.nii.gz'
-    st_factors_img.save(st_factors1_name)
+    stcorr1_name = intermediate_name(stcorr1_dir_name, 'tis_stcorr')
+    st_factors1_name = intermediate_name(stcorr1_dir_name, 'st_scaling_factors')
+    _slicetiming_correction(mtcorr_name, t1_filt_name, tis, rpts, slicedt, sliceband, n_slices,
+                            stcorr1_name, st_factors1_name)
 
     # motion estimation from ASL to M0 image
-    reg_name = moco_dir_name / 'initial_registration_TIs.nii.gz'
-    mcflirt(stcorr_img, reffile=json_dict['calib0_mc'], mats=True, out=str(reg_name))
-    # rename mcflirt matrices directory
-    orig_mcflirt = (moco_dir_name / 'initial_registration_TIs.nii.gz.mat')
-    if asln2m0_name.exists():
-        shutil.rmtree(asln2m0_name)
-    orig_mcflirt.rename(asln2m0_name)
+    reg_name = intermediate_name(moco_dir_name, 'initial_registration_TIs')
+    with profile_step('mcflirt'):
+        subprocess.run(["mcflirt", "-in", str(stcorr1_name), "-reffile", json_dict['calib0_mc'],
+                        "-mats", "-out", str(reg_name)], check=True, env=fsl_env())
+    # keep mcflirt's matrices in a single file rather than a directory
+    mcflirt_mats = reg_name.parent / f'{reg_name.name}.mat'
+    asln2m0 = TransformSeries.from_mat_dir(mcflirt_mats)
+    asln2m0.save(asln2m0_name)
+    shutil.rmtree(mcflirt_mats)
 
     # obtain motion estimates from ASLn to ASL0 (and their inverse)
-    # get list of registration matrices
-    asl2m0_list = sorted(asln2m0_name.glob('**/MAT*'))
-    m02asl0 = np.linalg.inv(np.loadtxt(asl2m0_list[0]))
-    for n, transformation in enumerate(asl2m0_list):
-        if n == 0:
-            forward_trans = np.eye(4)
-        else:
-            forward_trans = m02asl0 @ np.loadtxt(transformation)
-        inv_trans = np.linalg.inv(forward_trans)
-        np.savetxt(asln2asl0_name / transformation.stem, forward_trans)
-        np.savetxt(asl02asln_name / transformation.stem, inv_trans)
+    asln2asl0 = asln2m0.relative_to(0)
+    asln2asl0.save(asln2asl0_name)
 
     # apply inverse transformations to parameter estimates to align them with 
     # the individual frames of the ASL series
-    reg_t1_filt_name = t1_filt_name.parent / f'{t1_filt_name.stem.split(".")[0]}_reg.nii.gz'
-    _register_param(t1_filt_name, asl02asln_name, json_dict['calib0_mc'], reg_t1_filt_name)
+    reg_t1_filt_name = intermediate_name(t1_filt_name.parent, f'{image_stem(t1_filt_name)}_reg')
+    _register_param(t1_filt_name, asln2asl0.inverse(), json_dict['calib0_mc'], reg_t1_filt_name)
 
     # second slice-timing correction using registered parameter estimates
-    stcorr_img, st_factors_img = _slicetiming_correction(mtcorr_name, reg_t1_filt_name, tis, rpts, slicedt, sliceband, n_slices)
-
-    # save slice-time corrected image and slice-time correcting scaling factors
-    stcorr2_name = stcorr2_dir_name / 'tis_stcorr.nii.gz'
-    stcorr_img.save(stcorr2_name)
-    st_factors2_name = stcorr2_dir_name / 'st_scaling_factors.nii.gz'
-    st_factors_img.save(st_factors2_name)
+    # saving the slice-time corrected image and slice-time correcting scaling factors
+    stcorr2_name = intermediate_name(stcorr2_dir_name, 'tis_stcorr')
+    st_factors2_name = intermediate_name(stcorr2_dir_name, 'st_scaling_factors')
+    _slicetiming_correction(mtcorr_name, reg_t1_filt_name, tis, rpts, slicedt, sliceband, n_slices,
+                            stcorr2_name, st_factors2_name)
     # also obtain combined MT- and ST- correction scaling factors
-    combined_factors_name = stcorr2_dir_name / 'combined_scaling_factors.nii.gz'
-    fslmaths(st_factors2_name).mul(mt_factors).run(combined_factors_name)
+    combined_factors_name = intermediate_name(stcorr2_dir_name, 'combined_scaling_factors')
+    voxelwise(st_factors2_name).mul(mt_factors).run(combined_factors_name)
 
     # save locations of important files in the json
     important_names = {
         'ASL_stcorr': str(stcorr2_name),
         'scaling_factors': str(combined_factors_name)
     }
-    update_json(important_names, json_dict)
\ No newline at end of file
+    json_dict.update(important_names)
+    json_dict.flush()
\ No newline at end of file
@@ -8,55 +8,117 @@ tag-control subtraction, similar to the method described in
 arterial spin labeling perfusion images acquired with
 simultaneous multi‐slice EPI', Y. Suzuki, T.W. Okell, M.A. 
 Chappell, M.J.P. van Osch
+
+The series are read a few tag-control pairs of volumes at a time 
+in float32 and the parameter estimates written as they are 
+computed, so the series never have to be held in memory whole.
 """
 
 from .initial_bookkeeping import create_dirs
-from .m0_mt_correction import load_json, update_json
-from fsl.data.image import Image
+from .manifest import Manifest
+from .image_format import intermediate_name
+from .nifti_stream import image_source, open_output
+from .voxelwise import CHUNK_BYTES
 from pathlib import Path
-import subprocess
 import numpy as np
+import os
 
-def tag_control_differencing(subject_dir):
-    # load subject's json
-    json_dict = load_json(subject_dir)
-
-    # load motion- and distortion- corrected data, Y_moco
-    distcorr_dir = Path(json_dict['structasl']) / 'TIs/DistCorr'
-    Y_moco_name = distcorr_dir / 'tis_distcorr.nii.gz'
-    Y_moco = Image(str(Y_moco_name))
+def _tag_control_betas(Y_moco, S_st):
+    """
+    Estimate the perfusion and baseline signal GLM parameters 
+    from the motion-corrected ASL series, `Y_moco`, and the 
+    scaling factors applied to it, `S_st`, both numpy arrays 
+    of tag-control pairs of volumes.
 
-    # load registered scaling factors, S_st
-    sfs_name = distcorr_dir / 'combined_scaling_factors.nii.gz'
-    S_st = Image(str(sfs_name))
+    Voxels where the scaling factors of the tag and control 
+    images are such that `X_odd - X_even` is zero can't be 
+    estimated and are set to zero.
 
+    Returns the float32 arrays `B_perf` and `B_baseline`.
+    """
+    Y_moco = np.asarray(Y_moco, dtype=np.float32)
+    S_st = np.asarray(S_st, dtype=np.float32)
     # calculate X_perf = X_tc * S_st
-    X_tc = np.ones((1, 1, 1, 86)) * 0.5
+    X_tc = np.full((1, 1, 1, Y_moco.shape[3]), 0.5, dtype=np.float32)
     X_tc[0, 0, 0, 0::2] =  -0.5
-    X_perf = X_tc * S_st.data
+    X_perf = X_tc * S_st
 
     # split X_perf and Y_moco into even and odd indices
     X_odd = X_perf[:, :, :, 1::2]
     X_even = X_perf[:, :, :, 0::2]
-    Y_odd = Y_moco.data[:, :, :, 1::2]
-    Y_even = Y_moco.data[:, :, :, 0::2]
+    Y_odd = Y_moco[:, :, :, 1::2]
+    Y_even = Y_moco[:, :, :, 0::2]
 
     # calculate B_perf and B_baseline
-    B_perf = (Y_odd - Y_even) / (X_odd - X_even)
-    B_baseline = (X_odd*Y_even - X_even*Y_odd) / (X_odd - X_even)
+    X_diff = X_odd - X_even
+    valid = X_diff != 0
+    B_perf = np.divide(Y_odd - Y_even, X_diff, 
+                       out=np.zeros_like(X_diff), where=valid)
+    B_baseline = np.divide(X_odd*Y_even - X_even*Y_odd, X_diff, 
+                           out=np.zeros_like(X_diff), where=valid)
+    return B_perf, B_baseline
+
+def _stream_betas(Y_moco_name, S_st_name, B_perf_name, B_baseline_name):
+    """
+    Estimate the GLM parameters of `_tag_control_betas` a few 
+    tag-control pairs of volumes at a time, writing them to 
+    `B_perf_name` and `B_baseline_name` as they are computed, so 
+    that memory use doesn't grow with the size of the series.
+    """
+    header, Y_moco = image_source(Y_moco_name)
+    _, S_st = image_source(S_st_name)
+    shape = Y_moco.shape
+    if tuple(S_st.shape) != tuple(shape):
+        raise ValueError(f'Scaling factors of shape {S_st.shape} do not match the '
+                         + f'ASL series of shape {shape}.')
+    if len(shape) != 4 or shape[3] % 2:
+        raise ValueError(f'ASL series of shape {shape} is not a series of '
+                         + 'tag-control pairs.')
+    out_shape = (*shape[:3], shape[3] // 2)
+    # pairs of volumes per chunk, for both inputs
+    pair_bytes = 2 * 2 * 4 * int(np.prod(shape[:3]))
+    chunk_pairs = max(1, CHUNK_BYTES // pair_bytes)
+
+    names = [B_perf_name, B_baseline_name]
+    tmp_names = [Path(name).parent / f'.tmp.{Path(name).name}' for name in names]
+    files = [open_output(tmp_name, header, out_shape) for tmp_name in tmp_names]
+    try:
+        for start in range(0, shape[3], 2 * chunk_pairs):
+            volumes = slice(start, min(start + 2 * chunk_pairs, shape[3]))
+            betas = _tag_control_betas(Y_moco[..., volumes], S_st[..., volumes])
+            for outfile, values in zip(files, betas):
+                outfile.write(values.astype('<f4').tobytes(order='F'))
+    except BaseException:
+        for outfile in files:
+            outfile.close()
+        for tmp_name in tmp_names:
+            tmp_name.unlink(missing_ok=True)
+        raise
+    for outfile in files:
+        outfile.close()
+    for tmp_name, name in zip(tmp_names, names):
+        os.replace(tmp_name, name)
+
+def tag_control_differencing(subject_dir):
+    # load subject's json
+    json_dict = Manifest.for_subject(subject_dir)
+
+    # motion- and distortion- corrected data, Y_moco
+    Y_moco_name = json_dict['ASL_distcorr']
+
+    # registered scaling factors, S_st
+    sfs_name = json_dict['scaling_factors_distcorr']
 
-    # save both images
+    # calculate B_perf and B_baseline, saving both images
     beta_dir_name = Path(json_dict['structasl']) / 'TIs/Betas'
     create_dirs([beta_dir_name, ])
-    B_perf_name = beta_dir_name / 'beta_perf.nii.gz'
-    B_perf_img = Image(B_perf, header=Y_moco.header)
-    B_perf_img.save(B_perf_name)
-    B_baseline_name = beta_dir_name / 'beta_baseline.nii.gz'
-    B_baseline_img = Image(B_baseline, header=Y_moco.header)
-    B_baseline_img.save(B_baseline_name)
+    B_perf_name = intermediate_name(beta_dir_name, 'beta_perf')
+    B_baseline_name = intermediate_name(beta_dir_name, 'beta_baseline')
+    _stream_betas(Y_moco_name, sfs_name, B_perf_name, B_baseline_name)
 
     # add B_perf_name to the json as will be needed in oxford_asl
     important_names = {
         'beta_perf': str(B_perf_name)
     }
-    update_json(important_names, json_dict)
\ No newline at end of file
+    json_dict.update(important_names)
+    json_dict.flush()
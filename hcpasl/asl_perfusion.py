@@ -1,50 +1,170 @@
-from .m0_mt_correction import load_json, update_json
+"""
+Perfusion quantification of the differenced ASL data with
+oxford_asl.
+
+oxford_asl is run once over the whole brain mask, so that its own
+registration to the structural image and M0 calibration, which
+depend on the whole mask, are used for every result. With
+`--spatial=off` its Fabber runs fit every voxel independently, so
+each of them, with and without partial volume correction, is split
+into chunks of the mask fitted concurrently by
+`fabber_parallel.run_fabber_command_parallel`. This is done by a
+`fabber_asl` in place of Fabber's in `$FSLDEVDIR/bin`, which
+oxford_asl uses over the one in `$FSLDIR/bin`, as with
+`--fabberdir`. The chunks' results are merged before oxford_asl
+reads them, so they are the same as those of a single run.
+
+If the native perfusion engine has been selected, the kinetic
+model is instead fitted in Python by `perfusion.native_perfusion`
+and its results saved with the same names and layout.
+"""
+
+from .manifest import Manifest
 from .initial_bookkeeping import create_dirs
+from .image_cache import load_image
+from .resample import resample_image
+from .perfusion import perfusion_engine, native_perfusion
+from .scheduler import core_budget
 from pathlib import Path
 import subprocess
-import numpy as np
+import tempfile
+import shutil
+import sys
+import os
 
-def run_oxford_asl(subject_dir):
-    # load subject's json
-    json_dict = load_json(subject_dir)
+# sequence parameters
+TIS = [1.7, 2.2, 2.7, 3.2, 3.7]
+RPTS = [6, 6, 6, 10, 15]
+BOLUS = 1.5
+SLICEDT = 0.059
+SLICEBAND = 10
+# echo time of the calibration image, in ms
+TE = 19
 
-    # directory for oxford_asl results
-    structasl_dir = Path(json_dict['structasl'])
-    oxford_dir = structasl_dir / 'TIs/OxfordASL'
-    pvgm_name = structasl_dir / 'PVEs/pve_GM.nii.gz'
-    pvwm_name = structasl_dir / 'PVEs/pve_WM.nii.gz'
-    calib_name = structasl_dir / 'Calib/Calib0/DistCorr/calib0_dcorr.nii.gz'
-    brain_mask = structasl_dir / 'reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz'
-    cmd = [
+def _oxford_asl_options(json_dict, oxford_dir):
+    """
+    The oxford_asl options for the fit of the whole brain mask,
+    calibrated and registered to the structural image, with
+    results saved to `oxford_dir`.
+    """
+    return [
         "oxford_asl",
         f"-i {json_dict['beta_perf']}",
         f"-o {str(oxford_dir)}",
         "--casl",
         "--ibf=tis",
         "--iaf=diff",
-        "--tis=1.7,2.2,2.7,3.2,3.7",
-        "--rpts=6,6,6,10,15",
+        f"--tis={','.join(str(ti) for ti in TIS)}",
+        f"--rpts={','.join(str(rpt) for rpt in RPTS)}",
         "--fixbolus",
-        "--bolus=1.5",
+        f"--bolus={BOLUS}",
         "--pvcorr",
-        f"-c {str(calib_name)}",
+        f"-c {json_dict['calib0_dcorr']}",
         "--cmethod=single",
-        f"-m {str(brain_mask)}",
-        f"--pvgm={str(pvgm_name)}",
-        f"--pvwm={str(pvwm_name)}",
-        "--te=19",
+        f"-m {json_dict['brain_mask']}",
+        f"--pvgm={json_dict['pve_GM']}",
+        f"--pvwm={json_dict['pve_WM']}",
+        f"--te={TE}",
         "--debug",
         "--spatial=off",
-        "--slicedt=0.059",
+        f"--slicedt={SLICEDT}",
         f"-s {json_dict['T1w_acpc']}",
         f"--sbrain={json_dict['T1w_acpc_brain']}",
-        "--sliceband=10"
+        f"--sliceband={SLICEBAND}"
     ]
+
+def _run(cmd, env=None):
     print(" ".join(cmd))
-    subprocess.run(" ".join(cmd), shell=True)
+    subprocess.run(" ".join(cmd), shell=True, check=True, env=env)
+
+def _chunked_fabber_env(fabber_root, workers):
+    """
+    Create a `fabber_asl` in `fabber_root/bin` which splits each
+    run between `workers` concurrent runs of the Fabber executable
+    oxford_asl would otherwise use. Any other executables in the
+    current `$FSLDEVDIR/bin` are linked alongside it.
+
+    Returns the environment in which to run oxford_asl.
+    """
+    fsldevdir = os.environ.get('FSLDEVDIR')
+    bin_dir = fabber_root / 'bin'
+    bin_dir.mkdir(parents=True)
+    fabber = None
+    if fsldevdir and (Path(fsldevdir) / 'bin').is_dir():
+        for name in (Path(fsldevdir) / 'bin').iterdir():
+            if name.name == 'fabber_asl':
+                fabber = name
+            else:
+                (bin_dir / name.name).symlink_to(name)
+    if fabber is None:
+        fabber = Path(os.environ['FSLDIR']) / 'bin/fabber_asl'
+    # run the splitting with this package and the original FSLDEVDIR
+    package_root = Path(__file__).resolve().parent.parent
+    restore = f'export FSLDEVDIR="{fsldevdir}"' if fsldevdir else 'unset FSLDEVDIR'
+    wrapper = bin_dir / 'fabber_asl'
+    wrapper.write_text(
+        '#!/bin/sh\n'
+        + f'{restore}\n'
+        + f'export PYTHONPATH="{package_root}${{PYTHONPATH:+:$PYTHONPATH}}"\n'
+        + f'exec "{sys.executable}" -m hcpasl.fabber_parallel "{fabber}" {workers} "$@"\n'
+    )
+    wrapper.chmod(0o755)
+    return {**os.environ, 'FSLDEVDIR': str(fabber_root)}
+
+def _struct_space(native_dir, struct_dir, struct_name, transform):
+    """
+    Resample every image in `native_dir` and its subdirectories
+    to the structural image in-process by the FSL matrix
+    `transform`, saving them to the same place in `struct_dir`.
+    """
+    for native_name in sorted(native_dir.rglob('*.nii*')):
+        struct_out = struct_dir / native_name.relative_to(native_dir)
+        struct_out.parent.mkdir(parents=True, exist_ok=True)
+        resample_image(str(native_name), transform, struct_name, struct_out)
+
+def run_oxford_asl(subject_dir, workers=None):
+    """
+    Estimate perfusion and arrival time from `beta_perf` with
+    oxford_asl, or with the native perfusion engine if it has
+    been selected.
+
+    Inputs:
+        - `subject_dir` = directory of the subject's data
+        - `workers` = number of concurrent Fabber runs, or worker
+            processes of the native perfusion engine. Default is
+            the scheduler's core budget.
+    """
+    # load subject's json
+    json_dict = Manifest.for_subject(subject_dir)
+
+    # directory for oxford_asl results
+    structasl_dir = Path(json_dict['structasl'])
+    oxford_dir = structasl_dir / 'TIs/OxfordASL'
+    create_dirs([oxford_dir])
+    for results_dir in ('native_space', 'struct_space', 'calib'):
+        shutil.rmtree(oxford_dir / results_dir, ignore_errors=True)
+
+    if perfusion_engine() == 'native':
+        if 'pve_CSF' not in json_dict:
+            raise RuntimeError('The native perfusion engine needs the CSF partial volume '
+                               + 'estimates, pve_CSF, saved by the distortion correction '
+                               + 'stage. Re-run the pipeline from the distcorr stage.')
+        m0 = native_perfusion(json_dict['beta_perf'], json_dict['calib0_dcorr'],
+                              json_dict['brain_mask'], json_dict['pve_CSF'], oxford_dir,
+                              TIS, RPTS, BOLUS, SLICEDT, SLICEBAND, TE / 1000,
+                              json_dict['pve_GM'], json_dict['pve_WM'], workers)
+        with open(oxford_dir / 'logfile', 'w') as outfile:
+            outfile.write(f'Native perfusion fit with M0 of arterial blood {m0}\n')
+        # beta_perf is already aligned with the structural image
+        asl, struct = load_image(json_dict['beta_perf']), load_image(json_dict['T1w_acpc'])
+        transform = struct.getAffine('world', 'fsl') @ asl.getAffine('fsl', 'world')
+        _struct_space(oxford_dir / 'native_space', oxford_dir / 'struct_space',
+                      json_dict['T1w_acpc'], transform)
+    else:
+        with tempfile.TemporaryDirectory(prefix='.fabber_', dir=structasl_dir) as fabber_root:
+            env = _chunked_fabber_env(Path(fabber_root), workers or core_budget())
+            _run(_oxford_asl_options(json_dict, oxford_dir), env)
 
     # add oxford_asl directory to the json
-    important_names = {
-        "oxford_asl": str(oxford_dir)
-    }
-    update_json(important_names, json_dict)
\ No newline at end of file
+    json_dict["oxford_asl"] = str(oxford_dir)
+    json_dict.flush()
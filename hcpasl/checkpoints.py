@@ -0,0 +1,151 @@
+"""
+Functions for recording the completion of pipeline stages in a
+subject's ASL.json so that an interrupted or repeated run of the
+pipeline can skip stages which have already been completed.
+
+Each completed stage is recorded under the json's `checkpoints`
+field along with a digest of the contents of its input files and
+its parameters. A stage is only skipped if:
+    - its recorded digest matches the digest of its current
+        inputs and parameters
+    - all of its recorded outputs still exist
+    - all of the outputs the stage now has exist, e.g. after a
+        new output is added to a stage
+    - no earlier stage has been re-run in the same pipeline run
+"""
+
+from .manifest import Manifest, manifest_name
+from .profiling import profile_step
+from collections import namedtuple
+from pathlib import Path
+from datetime import datetime
+import hashlib
+import json
+
+# a pipeline stage. `run` is called with no arguments, while
+# `inputs` and `outputs` are called with the subject's manifest
+# (an empty dictionary if it doesn't yet exist) and return lists
+# of the files the stage reads and writes.
+Stage = namedtuple('Stage', ['name', 'run', 'inputs', 'outputs', 'params'])
+
+def file_hash(path, blocksize=2**20):
+    """
+    Return the SHA-1 hex digest of the contents of `path`.
+    Directories are hashed by the names and contents of the
+    files they contain, and missing paths hash to None.
+    """
+    path = Path(path)
+    if path.is_dir():
+        sha = hashlib.sha1()
+        for child in sorted(path.rglob('*')):
+            if child.is_file():
+                sha.update(str(child.relative_to(path)).encode())
+                sha.update(file_hash(child, blocksize).encode())
+        return sha.hexdigest()
+    if not path.exists():
+        return None
+    sha = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def stage_digest(inputs, params=None):
+    """
+    Digest of the contents of the files in `inputs` and the
+    json-serialisable dictionary `params`. The digest doesn't
+    depend on the location of the inputs so that it remains
+    valid if the subject's directory is moved.
+    """
+    contents = {
+        'inputs': [file_hash(name) if name else None for name in inputs],
+        'params': params or {}
+    }
+    encoded = json.dumps(contents, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest()
+
+def stage_complete(json_dict, name, digest):
+    """
+    Check whether stage `name` was completed with inputs and
+    parameters matching `digest` and its outputs still exist.
+    """
+    checkpoint = json_dict.get('checkpoints', {}).get(name)
+    if checkpoint is None or checkpoint['digest'] != digest:
+        return False
+    return all(Path(output).exists() for output in checkpoint['outputs'])
+
+def _outputs_exist(stage, json_dict):
+    """
+    Check whether the json records every output of `stage` and
+    they all exist.
+    """
+    try:
+        outputs = stage.outputs(json_dict)
+    except KeyError:
+        return False
+    return all(Path(output).exists() for output in outputs)
+
+def mark_stage_complete(manifest, name, digest, outputs):
+    """
+    Record the completion of stage `name` in the subject's
+    `Manifest`.
+    """
+    manifest.set(('checkpoints', name), {
+        'digest': digest,
+        'outputs': [str(output) for output in outputs],
+        'completed': datetime.now().isoformat(timespec='seconds')
+    })
+    manifest.flush()
+
+def invalidate_stages(manifest, names):
+    """
+    Remove the completion records of the stages in `names` from
+    the subject's `Manifest`.
+    """
+    checkpoints = manifest.get('checkpoints', {})
+    stale = [name for name in names if name in checkpoints]
+    for name in stale:
+        manifest.remove(('checkpoints', name))
+    if stale:
+        manifest.flush()
+
+def run_stages(subject_dir, stages, force_from=None):
+    """
+    Run the list of `stages` for the subject in `subject_dir`,
+    skipping those which have already been completed with the
+    same inputs. Once a stage has been run, all of the stages
+    after it are run too.
+
+    Inputs:
+        - `subject_dir` = pathlib.Path object specifying the
+            subject's base directory
+        - `stages` = list of `Stage`s in the order they should
+            be run
+        - `force_from` = name of a stage from which to re-run
+            the pipeline regardless of existing checkpoints
+            (optional)
+    """
+    names = [stage.name for stage in stages]
+    if force_from is not None and force_from not in names:
+        raise ValueError(f'Unknown stage {force_from}. Stages are: {", ".join(names)}.')
+    json_name = manifest_name(subject_dir)
+
+    rerun = False
+    for n, stage in enumerate(stages):
+        # the previous stage may have updated or replaced the manifest
+        manifest = Manifest(json_name) if json_name.exists() else {}
+        if stage.name == force_from:
+            rerun = True
+        digest = stage_digest(stage.inputs(manifest), stage.params)
+        if (not rerun and stage_complete(manifest, stage.name, digest)
+                and _outputs_exist(stage, manifest)):
+            print(f'Skipping {stage.name}: already completed with the same inputs.')
+            continue
+        # this stage and all later ones have to be recomputed
+        rerun = True
+        if manifest:
+            invalidate_stages(manifest, names[n:])
+        with profile_step(stage.name):
+            stage.run()
+        manifest = Manifest(json_name)
+        mark_stage_complete(manifest, stage.name, digest, stage.outputs(manifest))
@@ -94,7 +94,7 @@ def extract_fs_pvs(aparcseg, surf_dict, t1, asl, superfactor=2,
     ref_spc = t1_spc.resize_voxels(asl_spc.vox_size / t1_spc.vox_size)
     high_spc = ref_spc.resize_voxels(1/superfactor, 'ceil')
     aseg_spc = nib.load(aparcseg)
-    aseg = aseg_spc.dataobj
+    aseg = np.asanyarray(aseg_spc.dataobj)
     aseg_spc = rt.ImageSpace(aseg_spc)
 
     # Estimate cortical PVs 
@@ -105,27 +105,8 @@ def extract_fs_pvs(aparcseg, surf_dict, t1, asl, superfactor=2,
         cortex = estimate_cortex(ref=ref_path, struct2ref='I', 
             superfactor=1, cores=cores, **surf_dict)
 
-    # Extract PVs from aparcseg segmentation. Subcortical structures go into 
-    # a dict keyed according to their name, whereas general WM/GM are 
-    # grouped into the vol_pvs array
-    to_stack = {}
-    vol_pvs = np.zeros((aseg_spc.size.prod(), 3), dtype=np.float32)
-    for label in np.unique(aseg):
-        tissue = SUBCORT_LUT.get(label)
-        if not tissue: 
-            tissue = CTX_LUT(label)
-        if tissue: 
-            mask = (aseg == label) 
-            if tissue == "WM":
-                vol_pvs[mask.flatten(),1] = 1
-            elif tissue == "GM":
-                vol_pvs[mask.flatten(),0] = 1 
-            elif tissue == "CSF":
-                pass 
-            else: 
-                to_stack[tissue] = mask.astype(np.float32)
-        elif label not in IGNORE: 
-            print("Did not assign aseg/aparc label:", label)
+    # Extract PVs from aparcseg segmentation
+    vol_pvs, to_stack = _label_pvs(aseg)
 
     # Super-resolution resampling for the vol_pvs, a la applywarp. 
     # We use an identity transform as we don't actually want to shift the data 
@@ -171,6 +152,40 @@ def extract_fs_pvs(aparcseg, surf_dict, t1, asl, superfactor=2,
     return ref_spc.make_nifti(result.reshape((*ref_spc.size, 3))) 
 
 
+def _label_pvs(aseg):
+    """Extract PVs from the labels of a FS aparc+aseg segmentation. 
+    Subcortical structures go into a dict keyed according to their name, 
+    whereas general WM/GM are grouped into the vol_pvs array
+    Args:
+        aseg: array of aparc+aseg labels 
+    Returns: 
+        (vol_pvs, to_stack): array of size (voxels, 3) of binary GM/WM, 
+            dict of binary masks of subcortical structures 
+    """
+
+    aseg = np.asanyarray(aseg)
+    to_stack = {}
+    vol_pvs = np.zeros((aseg.size, 3), dtype=np.float32)
+    for label in np.unique(aseg):
+        tissue = SUBCORT_LUT.get(label)
+        if not tissue: 
+            tissue = CTX_LUT(label)
+        if tissue: 
+            mask = (aseg == label) 
+            if tissue == "WM":
+                vol_pvs[mask.flatten(),1] = 1
+            elif tissue == "GM":
+                vol_pvs[mask.flatten(),0] = 1 
+            elif tissue == "CSF":
+                pass 
+            else: 
+                to_stack[tissue] = mask.astype(np.float32)
+        elif label not in IGNORE: 
+            print("Did not assign aseg/aparc label:", label)
+
+    return vol_pvs, to_stack
+
+
 def _sum_array_blocks(array, factor):
     """Sum sub-arrays of a larger array, each of which is sized according to factor. 
     The array is split into smaller subarrays of size given by factor, each of which 
@@ -0,0 +1,288 @@
+"""
+A driver for running Fabber's non-spatial VB over blocks of voxels
+in parallel.
+
+Without a spatial prior every voxel is fitted independently, so
+the voxels in the mask can be split into blocks, one per worker
+process, each fitted by its own Fabber run with a mask of only
+its block. The blocks' outputs, including `finalMVN`, are then
+merged so that the results are the same as those of a single run
+and a spatial run can still `continue-from-mvn` from them.
+
+Each block's run still reads the whole of the data so that the
+voxels keep their positions, e.g. the slice numbers on which the
+`satrecov` model's slice timing depends. Data given as an array is
+written once to an uncompressed image which every run reads,
+rather than a copy of it being sent to each worker process.
+
+`run_fabber_command_parallel` does the same for a run of a Fabber
+executable, e.g. one of oxford_asl's `fabber_asl` runs, given its
+command-line arguments. Running this module as a script with the
+executable and the number of workers followed by the arguments
+does so in place of the executable.
+"""
+
+from .scheduler import core_budget
+from .image_cache import load_image
+from fsl.data.image import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+import nibabel as nb
+import numpy as np
+import subprocess
+import shutil
+import sys
+
+# fewest voxels worth fitting in a worker process of their own
+MIN_BLOCK_VOXELS = 5000
+
+def split_mask(mask, n_blocks):
+    """
+    Split the voxels of the 3D boolean `mask` into at most
+    `n_blocks` blocks of similar numbers of voxels. Voxels are
+    taken in slice order so each block is a slab of the mask.
+
+    Returns a list of 3D boolean masks, one per block.
+    """
+    voxels = np.flatnonzero(mask.ravel(order='F'))
+    blocks = []
+    for block_voxels in np.array_split(voxels, n_blocks):
+        if len(block_voxels) == 0:
+            continue
+        block = np.zeros(mask.size, dtype=bool)
+        block[block_voxels] = True
+        blocks.append(block.reshape(mask.shape, order='F'))
+    return blocks
+
+def _run_fabber(options, ref):
+    """
+    Run Fabber with `options`, writing its results to the
+    directory `options['output']` with the header of `ref`.
+    """
+    from fabber import Fabber
+    run = Fabber().run(options)
+    run.write_to_dir(options['output'], ref_nii=ref)
+
+def _reference(ref_img):
+    """
+    A small nibabel image with the header of `ref_img` to pass
+    to worker processes in place of the whole image.
+    """
+    return nb.Nifti1Image(np.zeros(ref_img.shape[:3], dtype=np.uint8), None, 
+                          header=ref_img.header)
+
+def merge_blocks(block_dirs, blocks, out_dir):
+    """
+    Merge the results of the runs in `block_dirs`, each of which
+    fitted the voxels of the matching mask in `blocks`, into
+    `out_dir`. Each image is taken from the run which fitted a
+    voxel. Other files are only kept if every run wrote the same,
+    e.g. `paramnames.txt`, since a per-run summary would only
+    describe the first run's voxels. The runs' log files are
+    concatenated and subdirectories are merged in the same way.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for first in sorted(block_dirs[0].iterdir()):
+        out_name = out_dir / first.name
+        if first.is_dir():
+            merge_blocks([block_dir / first.name for block_dir in block_dirs], 
+                         blocks, out_name)
+        elif first.name == 'logfile':
+            with open(out_name, 'w') as outfile:
+                for n, block_dir in enumerate(block_dirs):
+                    outfile.write(f'--- Block {n} ---\n')
+                    outfile.write((block_dir / first.name).read_text())
+        elif first.name.endswith(('.nii', '.nii.gz')):
+            first_img = Image(str(first))
+            merged = np.zeros(first_img.shape, dtype=first_img.dtype)
+            for block, block_dir in zip(blocks, block_dirs):
+                merged[block] = Image(str(block_dir / first.name)).data[block]
+            Image(merged, header=first_img.header).save(str(out_name))
+        elif all((block_dir / first.name).is_file()
+                 and (block_dir / first.name).read_bytes() == first.read_bytes()
+                 for block_dir in block_dirs[1:]):
+            shutil.copyfile(first, out_name)
+
+def run_fabber_parallel(options, ref_name, workers=None):
+    """
+    Run Fabber's non-spatial VB with `options`, splitting the
+    voxels to be fitted between worker processes.
+
+    Inputs:
+        - `options` = dictionary of Fabber options. `method`
+            must be 'vb' and `output` is the directory in which
+            the merged results are saved, as with a single run.
+            If `mask` is given, only the voxels within it are
+            fitted. `data` can be a filename or an array, which
+            is written to a temporary image for the workers.
+        - `ref_name` = filename or fsl.data.image.Image whose
+            header is used to save the results
+        - `workers` = number of worker processes. Default is the
+            scheduler's core budget.
+    """
+    if options.get('method') != 'vb':
+        raise ValueError('Only non-spatial Fabber runs can be split between workers.')
+    out_dir = Path(options['output'])
+    ref_img = load_image(ref_name)
+    if 'mask' in options:
+        mask = load_image(options['mask']).data > 0
+    else:
+        mask = np.ones(ref_img.shape[:3], dtype=bool)
+    n_blocks = min(workers or core_budget(), int(mask.sum()) // MIN_BLOCK_VOXELS)
+    if n_blocks <= 1:
+        _run_fabber(options, ref_img)
+        return
+
+    # a mask and results directory for each block
+    block_root = out_dir.parent / f'.{out_dir.name}_blocks'
+    block_root.mkdir(parents=True, exist_ok=True)
+    data = options.get('data')
+    if data is not None and not isinstance(data, (str, Path)):
+        data_name = block_root / 'data.nii'
+        Image(np.asarray(data), header=ref_img.header).save(str(data_name))
+        options = {**options, 'data': str(data_name)}
+    blocks = split_mask(mask, n_blocks)
+    block_dirs, block_options = [], []
+    for n, block in enumerate(blocks):
+        block_mask_name = block_root / f'mask{n}.nii.gz'
+        Image(block.astype(np.uint8), xform=ref_img.voxToWorldMat).save(str(block_mask_name))
+        block_dirs.append(block_root / f'block{n}')
+        block_options.append({**options, 'mask': str(block_mask_name),
+                              'output': str(block_dirs[-1])})
+    try:
+        with ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+            list(executor.map(_run_fabber, block_options, [_reference(ref_img)] * len(blocks)))
+        merge_blocks(block_dirs, blocks, out_dir)
+    finally:
+        shutil.rmtree(block_root, ignore_errors=True)
+
+# arguments naming a Fabber options file, followed by its name
+_OPTFILE_ARGS = ('-f', '-@')
+
+def _parse_option(arg):
+    """
+    Split a Fabber option, `--name=value` or `name=value` as in an
+    options file, into its name and value, which is True for a flag.
+    """
+    name, _, value = arg.lstrip('-').partition('=')
+    return name, value if value else True
+
+def _read_optfile(optfile):
+    """
+    Return the lines of the Fabber options file `optfile`, without
+    comments or blank lines.
+    """
+    with open(optfile, 'r') as infile:
+        lines = [line.split('#', 1)[0].strip() for line in infile]
+    return [line for line in lines if line]
+
+def _command_options(args):
+    """
+    Return a dictionary of the options given by the Fabber
+    command-line arguments `args`, including those in options
+    files, and the names of the options files.
+    """
+    options, optfiles = {}, []
+    args = iter(args)
+    for arg in args:
+        if arg in _OPTFILE_ARGS or arg.startswith('--optfile='):
+            optfile = next(args) if arg in _OPTFILE_ARGS else arg.split('=', 1)[1]
+            optfiles.append(optfile)
+            options.update(_parse_option(line) for line in _read_optfile(optfile))
+        else:
+            options.update([_parse_option(arg)])
+    return options, optfiles
+
+def _block_args(args, optfiles, block_root):
+    """
+    The arguments `args` without their mask, output directory or
+    `overwrite` flag, so that each block's run can be given its
+    own. Options files are replaced by copies in `block_root`
+    without these options.
+    """
+    def kept(arg):
+        return _parse_option(arg)[0] not in ('mask', 'output', 'overwrite')
+
+    block_args, args = [], iter(args)
+    for arg in args:
+        if arg in _OPTFILE_ARGS or arg.startswith('--optfile='):
+            optfile = next(args) if arg in _OPTFILE_ARGS else arg.split('=', 1)[1]
+            block_optfile = block_root / f'options{optfiles.index(optfile)}.txt'
+            block_optfile.write_text(
+                '\n'.join(filter(kept, _read_optfile(optfile))) + '\n')
+            if arg in _OPTFILE_ARGS:
+                block_args += [arg, str(block_optfile)]
+            else:
+                block_args.append(f'--optfile={block_optfile}')
+        elif kept(arg):
+            block_args.append(arg)
+    return block_args
+
+def _output_dir(options):
+    """
+    The directory the Fabber executable writes its results to,
+    with `+` appended while it already exists, unless the run
+    overwrites it.
+    """
+    out_dir = str(options['output'])
+    if not options.get('overwrite'):
+        while Path(out_dir).exists():
+            out_dir += '+'
+    return Path(out_dir)
+
+def run_fabber_command_parallel(fabber, args, workers=None):
+    """
+    Run the Fabber executable `fabber` with the command-line
+    arguments `args`, splitting the voxels to be fitted between
+    concurrent runs if the arguments are for non-spatial VB
+    within a mask. The runs' results are merged into the output
+    directory, as with a single run. Other runs, e.g. with a
+    spatial prior or listing a model's parameters, are passed on
+    to `fabber` as they are.
+
+    Inputs:
+        - `fabber` = name of the Fabber executable
+        - `args` = list of command-line arguments for `fabber`
+        - `workers` = number of concurrent runs. Default is the
+            scheduler's core budget.
+
+    Returns the exit status of `fabber`.
+    """
+    options, optfiles = _command_options(args)
+    if options.get('method') != 'vb' or 'output' not in options or 'mask' not in options:
+        return subprocess.run([fabber, *args]).returncode
+    mask_img = load_image(options['mask'])
+    mask = mask_img.data > 0
+    n_blocks = min(workers or core_budget(), int(mask.sum()) // MIN_BLOCK_VOXELS)
+    if n_blocks <= 1:
+        return subprocess.run([fabber, *args]).returncode
+
+    # a mask and results directory for each block
+    out_dir = _output_dir(options)
+    block_root = out_dir.parent / f'.{out_dir.name}_blocks'
+    block_root.mkdir(parents=True, exist_ok=True)
+    try:
+        block_args = _block_args(args, optfiles, block_root)
+        blocks = split_mask(mask, n_blocks)
+        block_dirs, block_cmds = [], []
+        for n, block in enumerate(blocks):
+            block_mask_name = block_root / f'mask{n}.nii.gz'
+            Image(block.astype(np.uint8), xform=mask_img.voxToWorldMat).save(str(block_mask_name))
+            block_dirs.append(block_root / f'block{n}')
+            block_cmds.append([fabber, *block_args, f'--mask={block_mask_name}',
+                               f'--output={block_dirs[-1]}'])
+        with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+            for result in executor.map(subprocess.run, block_cmds):
+                if result.returncode != 0:
+                    return result.returncode
+        merge_blocks(block_dirs, blocks, out_dir)
+    finally:
+        shutil.rmtree(block_root, ignore_errors=True)
+    return 0
+
+def main():
+    fabber, workers, args = sys.argv[1], int(sys.argv[2]), sys.argv[3:]
+    sys.exit(run_fabber_command_parallel(fabber, args, workers))
+
+if __name__ == '__main__':
+    main()
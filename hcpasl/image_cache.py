@@ -0,0 +1,142 @@
+"""
+An in-process cache of loaded images, so that images which are
+read by several steps of the pipeline, e.g. the MT-corrected ASL
+series used in both passes of the slice-timing correction, are
+only decoded from disk once.
+
+Images are cached by their path, modification time and size, so
+an image which is overwritten on disk is reloaded the next time
+it is requested. The least recently used images are dropped once
+the cached data exceeds a memory limit.
+
+The streaming readers of `nifti_stream.image_source` use an image's
+cached data if it has already been loaded, and can load images
+which will be read again, and fit within the limit, through the
+cache. Otherwise they read images from disk a chunk at a time,
+bypassing the cache.
+
+Cached images are shared between their users so must not be
+modified in place.
+"""
+
+from fsl.data.image import Image
+from collections import OrderedDict
+from pathlib import Path
+import threading
+
+# default limit on the memory used by cached image data, in bytes
+DEFAULT_CACHE_LIMIT = 4 * 2**30
+
+_CACHE = OrderedDict()
+_CACHE_LIMIT = DEFAULT_CACHE_LIMIT
+_CACHE_SIZE = 0
+_LOCK = threading.Lock()
+
+def _image_key(name):
+    """
+    Return the key of the image file `name` in the cache.
+    """
+    path = Path(name).resolve()
+    stat = path.stat()
+    return (str(path), stat.st_mtime_ns, stat.st_size)
+
+def _image_nbytes(img):
+    """
+    Return the memory used by the data of `img`, in bytes.
+    """
+    n_voxels = 1
+    for dim in img.shape:
+        n_voxels *= dim
+    return n_voxels * img.dtype.itemsize
+
+def _add(key, img):
+    """
+    Add `img` to the cache under `key`, dropping the least
+    recently used images to stay within the memory limit. Images
+    larger than the limit aren't cached.
+    """
+    global _CACHE_SIZE
+    nbytes = _image_nbytes(img)
+    if nbytes > _CACHE_LIMIT:
+        return
+    # drop any older versions of the same file
+    for old_key in [k for k in _CACHE if k[0] == key[0]]:
+        _CACHE_SIZE -= _CACHE.pop(old_key)[1]
+    while _CACHE and _CACHE_SIZE + nbytes > _CACHE_LIMIT:
+        _, (_, old_nbytes) = _CACHE.popitem(last=False)
+        _CACHE_SIZE -= old_nbytes
+    _CACHE[key] = (img, nbytes)
+    _CACHE_SIZE += nbytes
+
+def set_cache_limit(nbytes):
+    """
+    Set the limit on the memory used by cached image data, in
+    bytes. A limit of 0 disables the cache. If `nbytes` is None,
+    the default limit is used.
+    """
+    global _CACHE_LIMIT, _CACHE_SIZE
+    with _LOCK:
+        _CACHE_LIMIT = DEFAULT_CACHE_LIMIT if nbytes is None else nbytes
+        while _CACHE and _CACHE_SIZE > _CACHE_LIMIT:
+            _, (_, old_nbytes) = _CACHE.popitem(last=False)
+            _CACHE_SIZE -= old_nbytes
+
+def clear_cache():
+    """
+    Remove all images from the cache.
+    """
+    global _CACHE_SIZE
+    with _LOCK:
+        _CACHE.clear()
+        _CACHE_SIZE = 0
+
+def fits_in_cache(nbytes):
+    """
+    Check whether image data of `nbytes` bytes can be cached.
+    """
+    return 0 < nbytes <= _CACHE_LIMIT
+
+def cached_image(name):
+    """
+    Return the fsl.data.image.Image `name` if it is in the cache
+    and hasn't changed on disk since it was loaded, or None.
+    """
+    key = _image_key(name)
+    with _LOCK:
+        if key in _CACHE:
+            _CACHE.move_to_end(key)
+            return _CACHE[key][0]
+    return None
+
+def load_image(name):
+    """
+    Return the fsl.data.image.Image `name`, from the cache if it
+    has already been loaded and hasn't changed on disk since.
+
+    `name` can also be an Image, which is returned as is, so that
+    steps can be passed images in memory instead of filenames.
+    """
+    if isinstance(name, Image):
+        return name
+    img = cached_image(name)
+    if img is not None:
+        return img
+    key = _image_key(name)
+    img = Image(str(name))
+    # make sure the data is read now rather than on first use
+    img.data
+    with _LOCK:
+        _add(key, img)
+    return img
+
+def save_image(img, name):
+    """
+    Save the fsl.data.image.Image `img` to `name` and add it to
+    the cache, so that later steps loading `name` reuse `img`
+    rather than reading it back from disk.
+    """
+    img.save(str(name))
+    if _CACHE_LIMIT:
+        key = _image_key(name)
+        with _LOCK:
+            _add(key, img)
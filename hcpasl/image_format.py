@@ -0,0 +1,78 @@
+"""
+The format in which the pipeline writes its intermediate images.
+
+By default, every image the pipeline writes is a gzipped NIfTI.
+The intermediate images, i.e. those which are only read by later
+stages of the pipeline, can instead be written as uncompressed
+NIfTIs. These are much quicker to write and read, and can be
+memory-mapped by nibabel and fslpy, at the cost of more disk
+space. The final outputs of the pipeline, from oxford_asl
+onwards, are always gzipped.
+
+The format is set once per process with `set_intermediate_format`
+and the names of intermediate images are derived with
+`intermediate_name`. FSL tools writing intermediate images are run
+in the environment returned by `fsl_env`.
+"""
+
+from pathlib import Path
+import os
+
+# supported formats, mapped to their extension and the
+# equivalent value of FSLOUTPUTTYPE
+INTERMEDIATE_FORMATS = {
+    'nii.gz': ('.nii.gz', 'NIFTI_GZ'),
+    'nii': ('.nii', 'NIFTI')
+}
+FINAL_EXT = '.nii.gz'
+
+_INTERMEDIATE_FORMAT = 'nii.gz'
+
+def set_intermediate_format(fmt):
+    """
+    Set the format of the intermediate images written by the
+    pipeline, either 'nii.gz' or 'nii'. If `fmt` is None, the
+    default of 'nii.gz' is used.
+    """
+    global _INTERMEDIATE_FORMAT
+    fmt = fmt or 'nii.gz'
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError(f'Unknown image format {fmt}. Formats are: '
+                         + ', '.join(INTERMEDIATE_FORMATS) + '.')
+    _INTERMEDIATE_FORMAT = fmt
+
+def intermediate_ext():
+    """
+    Return the file extension of the intermediate images.
+    """
+    return INTERMEDIATE_FORMATS[_INTERMEDIATE_FORMAT][0]
+
+def image_stem(name):
+    """
+    Return the name of the image `name` without its directory
+    or NIfTI extension, e.g. 'tis' for 'TIs/tis.nii.gz'.
+    """
+    name = Path(name).name
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def intermediate_name(directory, stem):
+    """
+    Return the pathlib.Path of the intermediate image `stem` in
+    `directory`, with the extension of the intermediate format.
+    """
+    return Path(directory) / f'{stem}{intermediate_ext()}'
+
+def fsl_env():
+    """
+    Return a copy of the environment in which FSL tools write
+    images in the intermediate format. FSL tools replace the
+    extension of any output filename they're given with that of
+    FSLOUTPUTTYPE, so every FSL tool writing an intermediate
+    image must be run in this environment.
+    """
+    env = os.environ.copy()
+    env['FSLOUTPUTTYPE'] = INTERMEDIATE_FORMATS[_INTERMEDIATE_FORMAT][1]
+    return env
@@ -11,9 +11,11 @@ subject. These set-up tasks include:
 """
 
 from pathlib import Path
-from fsl.wrappers.misc import fslroi
 from fsl.wrappers.fsl_anat import fsl_anat
-import json
+from .image_format import intermediate_name
+from .manifest import Manifest
+from .study_index import indexed_path
+from .nifti_stream import extract_volumes
 
 def create_dirs(dir_list, parents=True, exist_ok=True):
     """
@@ -39,6 +41,28 @@ def create_dirs(dir_list, parents=True, exist_ok=True):
     for directory in dir_list:
         directory.mkdir(parents=parents, exist_ok=exist_ok)
 
+def find_mbpcasl(subject_dir):
+    """
+    Find the subject's mbPCASL sequence in their B session 
+    directory, using the study's index if there is one.
+
+    Input:
+        - `subject_dir` = a pathlib.Path object for the subject's
+            data directory
+    """
+    mbpcasl = indexed_path(subject_dir, 'mbpcasl')
+    if mbpcasl is not None:
+        return mbpcasl
+    subject_name = subject_dir.parts[-1]
+    b_dir = subject_dir / f'{subject_name}_V1_B'
+    try:
+        mbpcasl_dir = list(b_dir.glob('**/scans/*mbPCASLhr'))[0]
+    # if no files match this format, it throws an IndexError
+    except IndexError as e:
+        print(e)
+    mbpcasl = mbpcasl_dir / 'resources/NIFTI/files' / f'{subject_name}_V1_B_mbPCASLhr_PA.nii.gz'
+    return mbpcasl
+
 def initial_processing(subject_dir):
     """
     Perform initial processing for the subject directory provided.
@@ -76,23 +100,18 @@ def initial_processing(subject_dir):
     t1_brain_name = t1_dir / 'T1w_acpc_dc_restore_brain.nii.gz'
 
     # asl
-    b_dir = subject_dir / f'{subject_name}_V1_B'
-    try:
-        mbpcasl_dir = list(b_dir.glob('**/scans/*mbPCASLhr'))[0]
-    # if no files match this format, it throws an IndexError
-    except IndexError as e:
-        print(e)
-    mbpcasl = mbpcasl_dir / 'resources/NIFTI/files' / f'{subject_name}_V1_B_mbPCASLhr_PA.nii.gz'
+    mbpcasl = find_mbpcasl(subject_dir)
     
     # output names
-    tis_name = tis_dir / 'tis.nii.gz'
-    calib0_name = calib0_dir / 'calib0.nii.gz'
-    calib1_name = calib1_dir / 'calib1.nii.gz'
-    # get tis
-    fslroi(str(mbpcasl), tis_name, 0, 86)
-    # get calibration images
-    fslroi(str(mbpcasl), calib0_name, 88, 1)
-    fslroi(str(mbpcasl), calib1_name, 89, 1)
+    tis_name = intermediate_name(tis_dir, 'tis')
+    calib0_name = intermediate_name(calib0_dir, 'calib0')
+    calib1_name = intermediate_name(calib1_dir, 'calib1')
+    # get tis and calibration images in a single pass over the sequence
+    extract_volumes(mbpcasl, [
+        (tis_name, 0, 86),
+        (calib0_name, 88, 1),
+        (calib1_name, 89, 1)
+    ], gzip_index=asl_dir / 'mbPCASL.gzidx')
 
     # get surface names
     surfaces_dir = t1_dir / 'fsaverage_LR32k'
@@ -147,8 +166,7 @@ def initial_processing(subject_dir):
         R_white,
         json_name
     ]
-    names_dict = {}
-    for key, value in zip(fields, field_values):
-        names_dict[key] = str(value)
-    with open(json_name, 'w') as fp:
-        json.dump(names_dict, fp, sort_keys=True, indent=4)
\ No newline at end of file
+    # a new manifest replaces any from a previous run
+    with Manifest(json_name, create=True) as manifest:
+        for key, value in zip(fields, field_values):
+            manifest[key] = str(value)
\ No newline at end of file
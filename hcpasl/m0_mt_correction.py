@@ -3,43 +3,87 @@ This contains a range of functions required to correct for the
 Magnetisation Transfer effect visible in the HCP data.
 """
 
-import json
 from pathlib import Path
-from fsl.wrappers import fslmaths, LOAD, bet, fast
+from fsl.wrappers import LOAD, bet, fast
+from fsl.data.image import Image
 from .initial_bookkeeping import create_dirs
+from .profiling import profile_step
+from .scheduler import task, run_tasks
+from .image_format import intermediate_name, image_stem
+from .manifest import Manifest
+from .voxelwise import voxelwise
+from .spatial_filter import max_filter
+from functools import partial
 import subprocess
 
-def load_json(subject_dir):
+# dilation of the BET mask of the calibration image used to mask
+# the saturation recovery fit, as the width of a box kernel in voxels
+MASK_DILATION = 5
+
+def _calib_names(calib_name):
     """
-    Load json but with some error-checking to make sure it exists.
-    If it doesn't exist, instruct user to run the first part of 
-    the pipeline first.
+    Return a dictionary of the names of the bias field, 
+    bias-corrected and MT-corrected images and the brain mask 
+    derived from the calibration image `calib_name`, keyed as 
+    they are in the json.
+
+    The bias field is named by FAST itself so keeps FSL's default 
+    extension, while the other images are intermediates.
     """
-    json_name = subject_dir / 'ASL/ASL.json'
-    if json_name.exists():
-        with open(json_name, 'r') as infile:
-            json_dict = json.load(infile)
-    else:
-        raise Exception(f'File {json_name} does not exist.' + 
-                        'Please run initial_processing() first.')
-    return json_dict
+    calib_path = Path(calib_name)
+    calib_dir = calib_path.parent
+    calib_name_stem = image_stem(calib_path)
+    return {
+        f'{calib_name_stem}_bias' : calib_dir / f'FAST/{calib_name_stem}_bias.nii.gz',
+        f'{calib_name_stem}_bc' : intermediate_name(calib_dir / 'BiasCorr', f'{calib_name_stem}_restore'),
+        f'{calib_name_stem}_mc' : intermediate_name(calib_dir / 'MTCorr', f'{calib_name_stem}_mtcorr'),
+        f'{calib_name_stem}_mask' : intermediate_name(calib_dir / 'BET', f'{calib_name_stem}_brain_mask')
+    }
 
-def update_json(new_dict, old_dict):
+def _correct_calib(calib_name, mt_factors):
     """
-    Adds the key-value pairs in `new_dict` to the `old_dict` 
-    and save the resulting dictionary to the json found in 
-    `old_dict['json_name']`.
+    Bias-field and MT correct a single calibration image, 
+    `calib_name`, saving the results with the names given by 
+    `_calib_names`.
 
-    Inputs:
-        - `new_dict` = dictionary containing new key-value 
-            pairs to add to the json of important file 
-            names
-        - `old_dict` = dictionary to be updated, also 
-            has a field containing the location of the json.
+    The BET mask of the calibration image is dilated to give a 
+    generous brain mask, so that voxels at the edge of the brain 
+    are still included in the saturation recovery fit.
     """
-    old_dict.update(new_dict)
-    with open(Path(old_dict['json_name']), 'w') as fp:
-        json.dump(old_dict, fp, sort_keys=True, indent=4)
+    # get calib_dir and other info
+    calib_path = Path(calib_name)
+    calib_dir = calib_path.parent
+    calib_name_stem = image_stem(calib_path)
+    bias_name, biascorr_name, mtcorr_name, mask_name = _calib_names(calib_name).values()
+
+    # create directories to store results
+    bet_dir = calib_dir / 'BET'
+    fast_dir = calib_dir / 'FAST'
+    biascorr_dir = calib_dir / 'BiasCorr'
+    mtcorr_dir = calib_dir / 'MTCorr'
+    create_dirs([bet_dir, fast_dir, biascorr_dir, mtcorr_dir])
+
+    # run BET on m0 image, keeping a dilated copy of its mask
+    with profile_step(f'bet_{calib_name_stem}'):
+        betted_m0 = bet(calib_name, LOAD, mask=True)
+        bet_mask = Image(betted_m0['output_mask'])
+        Image(max_filter(bet_mask.data, MASK_DILATION), header=bet_mask.header).save(str(mask_name))
+
+    # estimate bias field on brain-extracted m0 image
+        # run FAST, storing results in directory
+    fast_base = fast_dir / calib_name_stem
+    with profile_step(f'fast_{calib_name_stem}'):
+        fast(
+            betted_m0['output'], # output of bet
+            out=str(fast_base), 
+            type=3, # image type, 3=PD image
+            b=True, # output estimated bias field
+            nopve=True # don't need pv estimates
+        )
+
+    # apply bias field to original m0 image (i.e. not BETted) and 
+    # mt_factors to the bias-corrected image in a single pass
+    voxelwise(calib_name).div(bias_name).save(biascorr_name).mul(mt_factors).run(mtcorr_name)
 
 def correct_M0(subject_dir, mt_factors):
     """
@@ -48,6 +92,8 @@ def correct_M0(subject_dir, mt_factors):
     performed include:
         - Bias-field correction
         - Magnetisation Transfer correction
+
+    The two calibration images are corrected concurrently.
     
     Inputs
         - `subject_dir` = pathlib.Path object specifying the 
@@ -57,49 +103,23 @@ def correct_M0(subject_dir, mt_factors):
             scaling factors
     """
     # load json containing info on where files are stored
-    json_dict = load_json(subject_dir)
+    manifest = Manifest.for_subject(subject_dir)
     
     # do for both m0 images for the subject, calib0 and calib1
-    calib_names = [json_dict['calib0_img'], json_dict['calib1_img']]
+    calib_names = [manifest['calib0_img'], manifest['calib1_img']]
+    tasks = []
+    important_names = {}
     for calib_name in calib_names:
-        # get calib_dir and other info
-        calib_path = Path(calib_name)
-        calib_dir = calib_path.parent
-        calib_name_stem = calib_path.stem.split('.')[0]
-
-        # run BET on m0 image
-        betted_m0 = bet(calib_name, LOAD)
-
-        # create directories to store results
-        fast_dir = calib_dir / 'FAST'
-        biascorr_dir = calib_dir / 'BiasCorr'
-        mtcorr_dir = calib_dir / 'MTCorr'
-        create_dirs([fast_dir, biascorr_dir, mtcorr_dir])
-
-        # estimate bias field on brain-extracted m0 image
-            # run FAST, storing results in directory
-        fast_base = fast_dir / calib_name_stem
-        fast(
-            betted_m0['output'], # output of bet
-            out=str(fast_base), 
-            type=3, # image type, 3=PD image
-            b=True, # output estimated bias field
-            nopve=True # don't need pv estimates
-        )
-        bias_name = fast_dir / f'{calib_name_stem}_bias.nii.gz'
-
-        # apply bias field to original m0 image (i.e. not BETted)
-        biascorr_name = biascorr_dir / f'{calib_name_stem}_restore.nii.gz'
-        fslmaths(calib_name).div(str(bias_name)).run(str(biascorr_name))
-
-        # apply mt_factors to bias-corrected m0 image
-        mtcorr_name = mtcorr_dir / f'{calib_name_stem}_mtcorr.nii.gz'
-        fslmaths(str(biascorr_name)).mul(str(mt_factors)).run(str(mtcorr_name))
+        names = _calib_names(calib_name)
+        tasks.append(task(
+            f'correct_{image_stem(calib_name)}',
+            partial(_correct_calib, calib_name, mt_factors),
+            inputs=[calib_name, mt_factors],
+            outputs=names.values()
+        ))
+        important_names.update({key: str(name) for key, name in names.items()})
+    run_tasks(tasks)
 
-        # add locations of above files to the json
-        important_names = {
-            f'{calib_name_stem}_bias' : str(bias_name),
-            f'{calib_name_stem}_bc' : str(biascorr_name),
-            f'{calib_name_stem}_mc' : str(mtcorr_name)
-        }
-        update_json(important_names, json_dict)
\ No newline at end of file
+    # add locations of above files to the json in a single write
+    manifest.update(important_names)
+    manifest.flush()
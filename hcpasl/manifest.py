@@ -0,0 +1,263 @@
+"""
+The subject's manifest, `ASL/ASL.json`, recording the locations of
+the files produced by each stage of the pipeline along with the
+stages' checkpoints.
+
+A `Manifest` keeps the changes made to it in memory until it is
+flushed, when only the entries which were changed are merged into
+the current contents of the file on disk. The file is replaced by
+an atomic rename, so readers never see a partially written
+manifest, and concurrent writers changing different entries, e.g.
+stages running concurrently, don't lose each other's updates.
+
+Writers in the same process are serialised by a lock. Writers in
+different processes, e.g. batch workers or separate runs sharing a
+subject directory, are only serialised if file locking is enabled
+with `set_file_locking`, as not all shared filesystems support it.
+"""
+
+from types import MappingProxyType
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import copy
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # file locking isn't available on Windows
+    fcntl = None
+
+MANIFEST_NAME = 'ASL/ASL.json'
+
+_FILE_LOCKING = False
+_LOCK = threading.Lock()
+_VIEWS = {}
+
+def set_file_locking(enabled):
+    """
+    Enable or disable locking of manifests on disk while they are
+    flushed, for when several processes may update the same
+    subject's manifest.
+    """
+    global _FILE_LOCKING
+    if enabled and fcntl is None:
+        raise RuntimeError('File locking is not supported on this platform.')
+    _FILE_LOCKING = bool(enabled)
+
+def manifest_name(subject_dir):
+    """
+    Return the pathlib.Path of the manifest of the subject in
+    `subject_dir`.
+    """
+    return Path(subject_dir) / MANIFEST_NAME
+
+@contextmanager
+def _locked(json_name):
+    """
+    Hold the in-process lock and, if enabled, an exclusive lock
+    on a hidden file alongside the manifest `json_name`.
+    """
+    with _LOCK:
+        if not _FILE_LOCKING:
+            yield
+            return
+        lock_name = json_name.parent / f'.{json_name.name}.lock'
+        with open(lock_name, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _read(json_name):
+    with open(json_name, 'r') as infile:
+        return json.load(infile)
+
+def _write(json_dict, json_name):
+    """
+    Save `json_dict` to `json_name` via an atomic rename.
+    """
+    tmp_name = json_name.parent / f'.{json_name.name}.{os.getpid()}.tmp'
+    with open(tmp_name, 'w') as fp:
+        json.dump(json_dict, fp, sort_keys=True, indent=4)
+    os.replace(tmp_name, json_name)
+
+def _set_path(json_dict, path, value):
+    for key in path[:-1]:
+        json_dict = json_dict.setdefault(key, {})
+    json_dict[path[-1]] = value
+
+def _pop_path(json_dict, path):
+    for key in path[:-1]:
+        json_dict = json_dict.get(key, {})
+    json_dict.pop(path[-1], None)
+
+def _get_path(json_dict, path):
+    for key in path:
+        json_dict = json_dict[key]
+    return json_dict
+
+class Manifest:
+    """
+    A subject's manifest with changes batched in memory until
+    `flush` is called.
+
+    Entries are read and set like a dictionary. Nested entries,
+    e.g. a single stage's checkpoint, can be set and removed with
+    `set` and `remove` given a tuple of keys, so that concurrent
+    writers can change different parts of the same entry.
+
+    Used as a context manager, the changes are flushed on exit
+    unless an exception was raised, in which case they're
+    discarded.
+    """
+
+    def __init__(self, json_name, create=False):
+        """
+        Inputs:
+            - `json_name` = pathlib.Path of the manifest
+            - `create` = start a new, empty manifest instead of
+                loading an existing one. The manifest on disk is
+                replaced when the new one is flushed.
+        """
+        self.json_name = Path(json_name)
+        self._changed = {}
+        self._replace = create
+        if create:
+            self._dict = {}
+        elif self.json_name.exists():
+            self._dict = _read(self.json_name)
+        else:
+            raise FileNotFoundError(f'File {self.json_name} does not exist. '
+                                    + 'Please run initial_processing() first.')
+
+    @classmethod
+    def for_subject(cls, subject_dir, create=False):
+        return cls(manifest_name(subject_dir), create)
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def get(self, key, default=None):
+        return self._dict.get(key, default)
+
+    def keys(self):
+        return self._dict.keys()
+
+    def items(self):
+        return self._dict.items()
+
+    def as_dict(self):
+        """
+        Return a copy of the manifest's contents, including
+        unflushed changes.
+        """
+        return copy.deepcopy(self._dict)
+
+    def __setitem__(self, key, value):
+        self.set((key, ), value)
+
+    def _mark(self, path, is_set):
+        # changes to nested entries are superseded by their parent's
+        for changed in [p for p in self._changed if p[:len(path)] == path]:
+            del self._changed[changed]
+        self._changed[path] = is_set
+
+    def set(self, path, value):
+        """
+        Set the entry at `path`, a key or tuple of keys into
+        nested entries, to `value`.
+        """
+        path = path if isinstance(path, tuple) else (path, )
+        _set_path(self._dict, path, value)
+        self._mark(path, True)
+
+    def remove(self, path):
+        """
+        Remove the entry at `path`, if it exists.
+        """
+        path = path if isinstance(path, tuple) else (path, )
+        _pop_path(self._dict, path)
+        self._mark(path, False)
+
+    def update(self, new_dict):
+        """
+        Set each of the top-level entries in `new_dict`.
+        """
+        for key, value in new_dict.items():
+            self.set((key, ), value)
+
+    @property
+    def dirty(self):
+        return self._replace or bool(self._changed)
+
+    def reload(self):
+        """
+        Re-read the manifest from disk, discarding unflushed
+        changes.
+        """
+        self._dict = _read(self.json_name)
+        self._changed = {}
+        self._replace = False
+
+    def flush(self):
+        """
+        Merge the changed entries into the manifest on disk and
+        reload the result, which includes any changes flushed by
+        other writers.
+        """
+        if not self.dirty:
+            return
+        self.json_name.parent.mkdir(parents=True, exist_ok=True)
+        with _locked(self.json_name):
+            if self._replace or not self.json_name.exists():
+                merged = self._dict
+            else:
+                merged = _read(self.json_name)
+                for path, is_set in self._changed.items():
+                    if is_set:
+                        _set_path(merged, path, copy.deepcopy(_get_path(self._dict, path)))
+                    else:
+                        _pop_path(merged, path)
+            _write(merged, self.json_name)
+        self._dict = merged
+        self._changed = {}
+        self._replace = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+def read_manifest(subject_dir):
+    """
+    Return a read-only view of the manifest of the subject in
+    `subject_dir`, for looking up file names.
+
+    The view is shared and only re-read when the file on disk
+    changes, so repeated lookups are cheap. Its nested entries
+    must not be modified.
+    """
+    json_name = manifest_name(subject_dir).resolve()
+    if not json_name.exists():
+        raise FileNotFoundError(f'File {json_name} does not exist. '
+                                + 'Please run initial_processing() first.')
+    stat = json_name.stat()
+    # flushes replace the file, so also compare the inode
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        cached = _VIEWS.get(json_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    view = MappingProxyType(_read(json_name))
+    with _LOCK:
+        _VIEWS[json_name] = (key, view)
+    return view
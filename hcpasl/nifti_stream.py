@@ -0,0 +1,228 @@
+"""
+Functions for extracting ranges of volumes from a 4D NIfTI, e.g.
+splitting the mbPCASL sequence into the ASL series and calibration
+images, without running `fslroi` once per output.
+
+The source is read once, in order, and each volume is copied
+straight to every output which contains it, so a gzipped source is
+only decompressed once however many outputs there are. Reading
+stops after the last volume needed.
+
+Data before the first needed volume still has to be decompressed
+to reach it. If `indexed_gzip` is installed, an index of seek
+points in the gzip stream can be saved alongside the outputs so
+that later extractions, e.g. of only the calibration images, seek
+straight to the volumes they need.
+"""
+
+from .image_cache import cached_image, fits_in_cache, load_image
+from nibabel.nifti1 import Nifti1Header
+from nibabel.nifti2 import Nifti2Header
+from fsl.data.image import Image
+from pathlib import Path
+import nibabel as nb
+import numpy as np
+import struct
+import gzip
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# bytes read from the source at a time when skipping data
+_CHUNK_SIZE = 2**24
+
+def _open(name, mode):
+    name = str(name)
+    if name.endswith('.gz'):
+        # the same compression level as nibabel, which is much
+        # quicker than the default and barely larger
+        return gzip.open(name, mode, compresslevel=1) if 'w' in mode else gzip.open(name, mode)
+    return open(name, mode)
+
+def _source_stamp(name):
+    """
+    The size and modification time of `name`, saved alongside a
+    gzip index to check that the index still belongs to it.
+    """
+    stat = Path(name).stat()
+    return f'{stat.st_size} {stat.st_mtime_ns}\n'
+
+def _stamp_name(gzip_index):
+    return Path(f'{gzip_index}.stamp')
+
+def _open_source(name, gzip_index=None):
+    """
+    Open the image `name` for reading, using an indexed gzip
+    reader if `gzip_index` is given and `indexed_gzip` is
+    installed.
+
+    The index is only used if it was made from `name` as it is
+    now, so a replaced source is read from the start and its
+    index rebuilt. If the index can't be imported, `name` is read
+    without one.
+    """
+    if gzip_index is None or indexed_gzip is None or not str(name).endswith('.gz'):
+        return _open(name, 'rb')
+    source = indexed_gzip.IndexedGzipFile(str(name))
+    stamp_name = _stamp_name(gzip_index)
+    if (Path(gzip_index).exists() and stamp_name.exists()
+            and stamp_name.read_text() == _source_stamp(name)):
+        try:
+            source.import_index(str(gzip_index))
+        except Exception:
+            # rebuilt by the next extraction
+            source.close()
+            stamp_name.unlink(missing_ok=True)
+            return _open(name, 'rb')
+    return source
+
+def _export_index(source, name, gzip_index):
+    """
+    Save the index of the indexed gzip reader `source` of `name`
+    to `gzip_index`, along with the stamp of `name` it belongs to.
+    """
+    stamp_name = _stamp_name(gzip_index)
+    stamp_name.unlink(missing_ok=True)
+    source.export_index(str(gzip_index))
+    stamp_name.write_text(_source_stamp(name))
+
+def _read_header(source):
+    """
+    Read the NIfTI-1 or NIfTI-2 header and any extensions from
+    the start of `source`, returning the header and the raw
+    bytes up to the start of the image data.
+    """
+    start = source.read(4)
+    sizeof_hdr = struct.unpack('<i', start)[0]
+    if sizeof_hdr not in (348, 540):
+        sizeof_hdr = struct.unpack('>i', start)[0]
+    klass = Nifti2Header if sizeof_hdr == 540 else Nifti1Header
+    raw = start + source.read(sizeof_hdr - 4)
+    header = klass(raw, check=False)
+    vox_offset = int(header['vox_offset'])
+    raw += source.read(vox_offset - len(raw))
+    return header, raw
+
+def _skip(source, nbytes):
+    """
+    Advance `source` by `nbytes`, seeking if possible.
+    """
+    if nbytes <= 0:
+        return
+    if getattr(source, 'seekable', lambda: False)():
+        source.seek(nbytes, 1)
+        return
+    while nbytes > 0:
+        chunk = source.read(min(nbytes, _CHUNK_SIZE))
+        if not chunk:
+            raise EOFError('Image data is shorter than its header describes.')
+        nbytes -= len(chunk)
+
+def image_source(image, cache=False):
+    """
+    Return the header and an array-like of the data of `image`,
+    a filename or fsl.data.image.Image, which can be sliced
+    without loading the whole image.
+
+    If the image is in the image cache, its data there is used.
+    Otherwise, if `cache` is True, e.g. for an image read again
+    by later steps, and the image fits within the cache's limit,
+    it is loaded whole through the cache.
+    """
+    if isinstance(image, Image):
+        return image.header, image.data
+    cached = cached_image(image)
+    if cached is not None:
+        return cached.header, cached.data
+    # keep gzipped files open so chunks are read sequentially
+    img = nb.load(str(image), keep_file_open=True)
+    if cache and fits_in_cache(int(np.prod(img.shape)) * img.get_data_dtype().itemsize):
+        cached = load_image(image)
+        return cached.header, cached.data
+    return img.header, img.dataobj
+
+def open_output(name, header, shape, dtype=np.float32):
+    """
+    Open the image `name` for writing its data in order, e.g.
+    volume by volume, writing a copy of `header` with the given
+    `shape` and `dtype` and without any scaling or extensions.
+
+    Returns the open file object, to which the data should be
+    written as little-endian bytes in Fortran order.
+    """
+    out_header = header.copy()
+    out_header.set_data_shape(shape)
+    out_header.set_data_dtype(dtype)
+    out_header.set_slope_inter(1, 0)
+    out_header['vox_offset'] = len(out_header.binaryblock) + 4
+    if out_header.endianness != '<':
+        out_header = out_header.as_byteswapped('<')
+    outfile = _open(name, 'wb')
+    # an empty extension block
+    outfile.write(out_header.binaryblock + bytes(4))
+    return outfile
+
+def extract_volumes(src_name, outputs, gzip_index=None):
+    """
+    Extract ranges of volumes from the 4D NIfTI `src_name` in a
+    single pass, equivalent to calling `fslroi` for each output.
+
+    Inputs:
+        - `src_name` = name of the 4D image
+        - `outputs` = list of `(name, start, n_volumes)` tuples
+            specifying each output image and the volumes it
+            should contain. Outputs ending in '.gz' are gzipped.
+        - `gzip_index` = name of a file in which to keep an index
+            into the gzipped `src_name` so that later calls can
+            seek to the volumes they need (optional, only used
+            if `indexed_gzip` is installed)
+
+    Returns the names of the outputs.
+    """
+    with _open_source(src_name, gzip_index) as source:
+        header, raw = _read_header(source)
+        shape = [int(d) for d in header['dim'][1:header['dim'][0] + 1]]
+        n_volumes = int(np.prod(shape[3:])) if len(shape) > 3 else 1
+        volume_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
+        for name, start, count in outputs:
+            if start < 0 or count < 1 or start + count > n_volumes:
+                raise ValueError(f'Volumes {start} to {start + count - 1} of {name} are '
+                                 + f'outside the {n_volumes} volumes of {src_name}.')
+
+        # open the outputs, writing the source's header with the
+        # number of volumes changed
+        files = []
+        try:
+            for name, start, count in outputs:
+                out_header = header.copy()
+                dim = out_header['dim'].copy()
+                dim[0] = 4
+                dim[4] = count
+                dim[5:] = 1
+                out_header['dim'] = dim
+                outfile = _open(name, 'wb')
+                files.append((outfile, start, start + count))
+                outfile.write(out_header.binaryblock + raw[len(out_header.binaryblock):])
+
+            # copy each needed volume to all of the outputs containing it
+            first = min(start for _, start, _ in outputs)
+            last = max(start + count for _, start, count in outputs)
+            _skip(source, first * volume_bytes)
+            for volume in range(first, last):
+                targets = [f for f, start, stop in files if start <= volume < stop]
+                if not targets:
+                    _skip(source, volume_bytes)
+                    continue
+                data = source.read(volume_bytes)
+                if len(data) != volume_bytes:
+                    raise EOFError(f'{src_name} is shorter than its header describes.')
+                for outfile in targets:
+                    outfile.write(data)
+        finally:
+            for outfile, _, _ in files:
+                outfile.close()
+        if gzip_index is not None and hasattr(source, 'export_index'):
+            _export_index(source, src_name, gzip_index)
+    return [name for name, _, _ in outputs]
@@ -0,0 +1,376 @@
+"""
+A native, vectorised fit of the Buxton kinetic model for pCASL to
+the differenced ASL data, as an alternative to running
+oxford_asl.
+
+kinetic_model: dM(t) = 2 * f * T1app * exp{-ATT/T1b} * c(t)
+
+    c(t) = 0                                    t < ATT
+         = 1 - exp{-(t - ATT)/T1app}            ATT <= t < ATT + tau
+         = exp{-(t - tau - ATT)/T1app} *
+           (1 - exp{-tau/T1app})                t >= ATT + tau
+
+where tau is the bolus duration, 1/T1app = 1/T1 + 0.01/lambda
+and t = TI + n*slicedt for a voxel in the n-th slice of its band,
+as in BASIL. The model is linear in the perfusion, f, so for each
+arrival time, ATT, on a grid the best perfusion has a closed form.
+The ATT is found by a search of the grid in every voxel at once,
+refined between grid points, with blocks of voxels fitted
+concurrently by worker processes. As in BASIL, the ATT has a
+Gaussian prior, without which it can't be told apart from the
+perfusion in slices imaged only after the bolus has arrived.
+Variances are estimated from the residuals and the Jacobian of
+the model at the fit.
+
+With partial volume correction, each voxel is modelled as the sum
+of GM and WM components weighted by their partial volumes, each
+with its own perfusion and T1. The two can't be told apart without
+BASIL's priors on the arrival times, so the WM arrival time is
+tied to the GM arrival time by the difference of those priors'
+means.
+
+Unlike oxford_asl, the perfusion has no prior and no macrovascular
+component is fitted. The perfusion is calibrated with a single M0
+value of arterial blood, estimated from the calibration image in
+a CSF reference region as with oxford_asl's `--cmethod=single`.
+
+The engine used by the pipeline is set once per process with
+`set_perfusion_engine`.
+"""
+
+from .image_cache import load_image
+from .scheduler import core_budget
+from fsl.data.image import Image
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+
+PERFUSION_ENGINES = ('oxford_asl', 'native')
+
+# kinetic model parameters, as oxford_asl's defaults for pCASL
+T1_GM = 1.3
+T1_WM = 1.1
+T1_BLOOD = 1.65
+PARTITION_COEFF = 0.9
+INVERSION_EFFICIENCY = 0.85
+# BASIL's prior on the GM arrival time, and the difference between
+# the means of its priors on the WM and GM arrival times, in seconds
+ATT_PRIOR_MEAN = 1.3
+ATT_PRIOR_SD = 1.0
+WM_ATT_OFFSET = 0.3
+# arrival times searched, in seconds
+ATT_GRID = np.linspace(0, 3, 301)
+
+# calibration parameters for a CSF reference region, as asl_calib's
+# defaults for a calibration image with a long TR
+TR_CALIB = 3.2
+T1_CSF = 4.3
+T2_CSF = 0.75
+T2_BLOOD = 0.15
+PC_CSF = 1.15
+PC_BLOOD = 0.98
+# smallest CSF partial volume of a voxel in the reference region,
+# and the fewest voxels in the region. if too few voxels are almost
+# pure CSF, e.g. with thin ventricles, the voxels with the most CSF
+# are used instead.
+CSF_THRESHOLD = 0.9
+MIN_REFERENCE_VOXELS = 20
+
+# smallest partial volume of a tissue whose perfusion is estimated
+PV_THRESHOLD = 0.1
+
+# voxels fitted by each worker process at a time
+BLOCK_SIZE = 5000
+
+# 3D parameter maps of a fit. The WM perfusion is zero without
+# partial volume correction.
+PerfusionFit = namedtuple('PerfusionFit', ['perfusion', 'perfusion_var', 'perfusion_wm',
+                                           'perfusion_wm_var', 'arrival', 'arrival_var'])
+
+_PERFUSION_ENGINE = 'oxford_asl'
+
+def set_perfusion_engine(engine):
+    """
+    Set the engine used to estimate perfusion, either 'oxford_asl'
+    or 'native'. If `engine` is None, the default of 'oxford_asl'
+    is used.
+    """
+    global _PERFUSION_ENGINE
+    engine = engine or 'oxford_asl'
+    if engine not in PERFUSION_ENGINES:
+        raise ValueError(f'Unknown perfusion engine {engine}. Engines are: '
+                         + ', '.join(PERFUSION_ENGINES) + '.')
+    _PERFUSION_ENGINE = engine
+
+def perfusion_engine():
+    """
+    Return the engine used to estimate perfusion.
+    """
+    return _PERFUSION_ENGINE
+
+def kinetic_curve(times, att, t1, bolus):
+    """
+    The kinetic model for unit perfusion at `times`, for arrival
+    times `att` and tissue T1 `t1`, broadcast against each other.
+    """
+    t1app = 1 / (1 / t1 + 0.01 / PARTITION_COEFF)
+    times, att = np.broadcast_arrays(times, att)
+    since = np.maximum(times - att, 0)
+    filling = 1 - np.exp(-np.minimum(since, bolus) / t1app)
+    decay = np.exp(-np.maximum(since - bolus, 0) / t1app)
+    return np.where(times > att, 2 * t1app * np.exp(-att / T1_BLOOD) * filling * decay, 0)
+
+def _divide(num, den):
+    num, den = np.broadcast_arrays(num, den)
+    return np.divide(num, den, out=np.zeros(num.shape), where=den != 0)
+
+def _solve(a00, a01, a11, b0, b1, use_gm, use_wm):
+    """
+    Solve the normal equations for the GM and WM perfusion, with
+    either component left out where it isn't used, returning the
+    perfusions and the reduction in the sum of squares.
+    """
+    both = use_gm & use_wm
+    det = a00 * a11 - a01**2
+    f_gm = np.where(both, _divide(a11 * b0 - a01 * b1, det),
+                    np.where(use_gm, _divide(b0, a00), 0))
+    f_wm = np.where(both, _divide(a00 * b1 - a01 * b0, det),
+                    np.where(use_wm, _divide(b1, a11), 0))
+    return f_gm, f_wm, b0 * f_gm + b1 * f_wm
+
+def fit_block(signal, times, pvs, bolus):
+    """
+    Fit the kinetic model to a block of voxels imaged at the same
+    times.
+
+    Inputs:
+        - `signal` = (n_voxels, n_times) array of the voxels'
+            differenced ASL signal
+        - `times` = array of the n_times times at which the
+            voxels were imaged
+        - `pvs` = (n_voxels, 2) array of the voxels' GM and WM
+            partial volumes. A component whose partial volume is
+            below `PV_THRESHOLD` is left out of the voxel's fit.
+        - `bolus` = bolus duration, in seconds
+
+    Returns a tuple of arrays of the GM perfusion, its variance,
+    the WM perfusion, its variance, the arrival time and its
+    variance of each voxel.
+    """
+    signal = signal.astype(np.float64)
+    times = np.asarray(times, dtype=np.float64)
+    use = pvs >= PV_THRESHOLD
+    pv_gm, pv_wm = np.where(use, pvs, 0).T.astype(np.float64)
+    sum_squares = np.sum(signal**2, axis=1)
+
+    def curves(att):
+        return (kinetic_curve(times, att[..., np.newaxis], T1_GM, bolus),
+                kinetic_curve(times, att[..., np.newaxis] + WM_ATT_OFFSET, T1_WM, bolus))
+
+    # sum of squares on the grid of arrival times, with the best
+    # perfusion for each
+    k_gm, k_wm = curves(ATT_GRID)
+    gm, wm = pv_gm[:, np.newaxis], pv_wm[:, np.newaxis]
+    _, _, explained = _solve(
+        gm**2 * np.sum(k_gm * k_gm, axis=1), gm * wm * np.sum(k_gm * k_wm, axis=1),
+        wm**2 * np.sum(k_wm * k_wm, axis=1), gm * (signal @ k_gm.T), wm * (signal @ k_wm.T),
+        use[:, :1], use[:, 1:])
+    cost = sum_squares[:, np.newaxis] - explained
+    # add the prior on the arrival time, scaled by the noise variance
+    # of the best fit without it
+    n_params = use.sum(axis=1) + 1
+    dof = np.maximum(len(times) - n_params, 1)
+    noise_var = np.maximum(cost.min(axis=1), 0) / dof
+    cost = cost + noise_var[:, np.newaxis] * ((ATT_GRID - ATT_PRIOR_MEAN) / ATT_PRIOR_SD)**2
+
+    # refine the best grid point by fitting a parabola through it
+    # and its neighbours
+    best = np.clip(np.argmin(cost, axis=1), 1, len(ATT_GRID) - 2)
+    voxels = np.arange(len(signal))
+    before, at, after = (cost[voxels, best + shift] for shift in (-1, 0, 1))
+    curvature = before - 2 * at + after
+    shift = np.clip(0.5 * _divide(before - after, curvature), -1, 1)
+    shift = np.where(curvature > 0, shift, np.argmin(cost, axis=1) - best)
+    att = ATT_GRID[best] + shift * (ATT_GRID[1] - ATT_GRID[0])
+
+    k_gm, k_wm = curves(att)
+    f_gm, f_wm, explained = _solve(
+        pv_gm**2 * np.sum(k_gm * k_gm, axis=1), pv_gm * pv_wm * np.sum(k_gm * k_wm, axis=1),
+        pv_wm**2 * np.sum(k_wm * k_wm, axis=1), pv_gm * np.sum(signal * k_gm, axis=1),
+        pv_wm * np.sum(signal * k_wm, axis=1), use[:, 0], use[:, 1])
+    residual = np.maximum(sum_squares - explained, 0)
+
+    # variances from the Jacobian of the model at the fit
+    h = 1e-4
+    (k_gm_up, k_wm_up), (k_gm_down, k_wm_down) = curves(att + h), curves(att - h)
+    d_att = (pv_gm[:, np.newaxis] * f_gm[:, np.newaxis] * (k_gm_up - k_gm_down)
+             + pv_wm[:, np.newaxis] * f_wm[:, np.newaxis] * (k_wm_up - k_wm_down)) / (2 * h)
+    jacobian = np.stack([pv_gm[:, np.newaxis] * k_gm, pv_wm[:, np.newaxis] * k_wm, d_att], axis=2)
+    noise_var = residual / dof
+    precision = np.einsum('nti,ntj->nij', jacobian, jacobian)
+    precision[:, 2, 2] += noise_var / ATT_PRIOR_SD**2
+    # pseudo-inverse as a component left out has no information
+    covariance = np.linalg.pinv(precision)
+    variances = noise_var[:, np.newaxis] * np.diagonal(covariance, axis1=1, axis2=2)
+    return tuple(param.astype(np.float32) for param in
+                 (f_gm, variances[:, 0], f_wm, variances[:, 1], att, variances[:, 2]))
+
+def _fit_block(args):
+    return fit_block(*args)
+
+def fit_perfusion(data, tis, rpts, bolus, slicedt, sliceband, mask, pvs=None, workers=None):
+    """
+    Fit the kinetic model to every voxel of the differenced ASL
+    data within a mask.
+
+    Inputs:
+        - `data` = 4D array of the differenced data, ordered by TI
+        - `tis` = list of TIs for the ASL sequence
+        - `rpts` = list of repeats for each TI in the sequence
+        - `bolus` = bolus duration, in seconds
+        - `slicedt` = time taken to acquire each slice of a band
+        - `sliceband` = number of slices per band
+        - `mask` = 3D array of the voxels to fit
+        - `pvs` = 4D array of the GM and WM partial volumes, for
+            partial volume correction (optional)
+        - `workers` = number of worker processes. Default is the
+            scheduler's core budget.
+
+    Returns a `PerfusionFit` of 3D arrays, which are zero outside
+    `mask` and, with partial volume correction, in voxels with
+    too little GM and WM to be fitted.
+    """
+    n_slices = data.shape[2]
+    tis_array = np.repeat(np.array(tis, dtype=np.float64), rpts)
+    fit = np.asarray(mask).reshape(data.shape[:3]) > 0
+    if pvs is None:
+        pvs = np.stack([np.ones(data.shape[:3]), np.zeros(data.shape[:3])], axis=3)
+    else:
+        pvs = np.asarray(pvs, dtype=np.float32).reshape(*data.shape[:3], 2)
+        fit &= np.any(pvs >= PV_THRESHOLD, axis=3)
+    signal = data.reshape(-1, data.shape[3])
+    pvs = pvs.reshape(-1, 2)
+
+    # voxels in the same position within their bands are imaged at
+    # the same times
+    blocks, block_voxels = [], []
+    for band_slice in range(min(sliceband, n_slices)):
+        band_fit = fit.copy()
+        band_fit[:, :, [z for z in range(n_slices) if z % sliceband != band_slice]] = False
+        voxels = np.flatnonzero(band_fit)
+        times = tis_array + slicedt * band_slice
+        for start in range(0, len(voxels), BLOCK_SIZE):
+            chunk = voxels[start:start + BLOCK_SIZE]
+            blocks.append((signal[chunk], times, pvs[chunk], bolus))
+            block_voxels.append(chunk)
+    workers = min(workers or core_budget(), len(blocks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fit_block, blocks))
+    else:
+        results = [_fit_block(block) for block in blocks]
+
+    params = [np.zeros(data.shape[:3], dtype=np.float32) for _ in PerfusionFit._fields]
+    for voxels, result in zip(block_voxels, results):
+        for param, values in zip(params, result):
+            param.flat[voxels] = values
+    return PerfusionFit(*params)
+
+def single_m0(calib, csf_pv, mask, te):
+    """
+    Estimate the M0 of arterial blood from the mean of the
+    calibration image `calib` over the voxels of `mask` which are
+    almost pure CSF, correcting for the CSF's T1 and T2 and the
+    partition coefficients of CSF and blood, as asl_calib does.
+    If fewer than `MIN_REFERENCE_VOXELS` voxels are almost pure
+    CSF, the voxels with the most CSF are used instead.
+
+    Inputs:
+        - `calib` = 3D array of the calibration image
+        - `csf_pv` = 3D array of the CSF partial volumes
+        - `mask` = 3D array of the brain mask
+        - `te` = echo time, in seconds
+    """
+    csf_pv = np.where(np.asarray(mask) > 0, np.asarray(csf_pv, dtype=np.float64), 0)
+    reference = csf_pv >= CSF_THRESHOLD
+    if reference.sum() < MIN_REFERENCE_VOXELS:
+        # the voxels with the most CSF, of those with any
+        n_voxels = min(MIN_REFERENCE_VOXELS, int(np.count_nonzero(csf_pv > 0)))
+        if n_voxels == 0:
+            raise ValueError('No voxels of the brain mask contain CSF to use as the '
+                             + 'reference region.')
+        threshold = np.sort(csf_pv, axis=None)[-n_voxels]
+        reference = csf_pv >= threshold
+        print(f'Only {int(np.count_nonzero(csf_pv >= CSF_THRESHOLD))} voxels have a CSF '
+              + f'partial volume of at least {CSF_THRESHOLD}. Using the {reference.sum()} '
+              + f'voxels with a CSF partial volume of at least {threshold:.2f} as the '
+              + 'reference region.')
+    m0_csf = np.mean(np.asarray(calib, dtype=np.float64)[reference])
+    m0_csf /= 1 - np.exp(-TR_CALIB / T1_CSF)
+    m0_csf *= np.exp(te / T2_CSF)
+    return float(m0_csf / PC_CSF * PC_BLOOD * np.exp(-te / T2_BLOOD))
+
+def native_perfusion(asl_name, calib_name, mask_name, csf_name, out_dir, tis, rpts, bolus,
+                     slicedt, sliceband, te, pvgm_name=None, pvwm_name=None, workers=None):
+    """
+    Fit the kinetic model to the differenced ASL data `asl_name`
+    and calibrate the perfusion, saving the results in
+    `{out_dir}/native_space` with oxford_asl's names.
+
+    Inputs:
+        - `asl_name` = filename or fsl.data.image.Image of the
+            differenced data, ordered by TI
+        - `calib_name` = calibration image
+        - `mask_name` = brain mask
+        - `csf_name` = CSF partial volume estimates, for the
+            calibration's reference region
+        - `out_dir` = directory in which to save the results
+        - `tis` = list of TIs for the ASL sequence
+        - `rpts` = list of repeats for each TI in the sequence
+        - `bolus` = bolus duration, in seconds
+        - `slicedt` = time taken to acquire each slice of a band
+        - `sliceband` = number of slices per band
+        - `te` = echo time of the calibration image, in seconds
+        - `pvgm_name`, `pvwm_name` = GM and WM partial volume
+            estimates. If given, partial volume corrected results
+            are also saved in `{out_dir}/native_space/pvcorr`.
+        - `workers` = number of worker processes. Default is the
+            scheduler's core budget.
+
+    Returns the M0 of arterial blood used for the calibration.
+    """
+    out_dir = Path(out_dir)
+    asl_img = load_image(asl_name)
+    data = np.asarray(asl_img.data, dtype=np.float32)
+    mask = np.asarray(load_image(mask_name).data)
+    m0 = single_m0(load_image(calib_name).data, load_image(csf_name).data, mask, te)
+    # scale to ml/100g/min
+    scale = 6000 / (INVERSION_EFFICIENCY * m0)
+
+    def save(name, param):
+        Image(param, header=asl_img.header).save(str(name))
+
+    fits = [('native_space', fit_perfusion(data, tis, rpts, bolus, slicedt, sliceband, mask,
+                                            workers=workers))]
+    if pvgm_name is not None and pvwm_name is not None:
+        pvs = np.stack([load_image(pvgm_name).data, load_image(pvwm_name).data], axis=3)
+        fits.append(('native_space/pvcorr',
+                     fit_perfusion(data, tis, rpts, bolus, slicedt, sliceband, mask, pvs,
+                                   workers)))
+    for space_dir, fit in fits:
+        space_dir = out_dir / space_dir
+        space_dir.mkdir(parents=True, exist_ok=True)
+        tissues = [('perfusion', fit.perfusion, fit.perfusion_var)]
+        if space_dir.name == 'pvcorr':
+            tissues.append(('perfusion_wm', fit.perfusion_wm, fit.perfusion_wm_var))
+        for name, perfusion, var in tissues:
+            save(space_dir / f'{name}.nii.gz', perfusion)
+            save(space_dir / f'{name}_var.nii.gz', var)
+            save(space_dir / f'{name}_calib.nii.gz', perfusion * scale)
+            save(space_dir / f'{name}_var_calib.nii.gz', var * scale**2)
+        save(space_dir / 'arrival.nii.gz', fit.arrival)
+        save(space_dir / 'arrival_var.nii.gz', fit.arrival_var)
+    (out_dir / 'calib').mkdir(parents=True, exist_ok=True)
+    np.savetxt(out_dir / 'calib/M0.txt', [m0])
+    return m0
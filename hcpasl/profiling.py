@@ -0,0 +1,293 @@
+"""
+Functions for profiling the stages of the pipeline.
+
+Each profiled step records its wall-clock time, the user and
+system CPU time used by the pipeline's own process and by the
+external programs it launched, and peak memory usage. Steps may
+be nested, in which case each record is named by the path of
+steps leading to it, e.g. `hcp_asl_moco/_saturation_recovery`.
+
+Profiling is switched on by `start_profiling()`. Functions
+decorated with `profiled` and blocks wrapped in `profile_step`
+are only timed while a profiler is active, so the library can
+be used as normal without it.
+
+Notes on the memory figures:
+    - `peak_rss_mb` is the peak resident set size of the
+        pipeline's process during the step. On Linux the peak
+        is reset at the start of each step, elsewhere it is the
+        process' high-water mark at the end of the step.
+    - `children_peak_rss_mb` is the high-water mark of the
+        largest child process which had finished by the end of
+        the step, as reported by the operating system.
+    - Steps which run concurrently in different threads share
+        the process' CPU and memory counters, so their figures
+        overlap.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from datetime import datetime
+import threading
+import platform
+import resource
+import time
+import json
+import sys
+
+_ACTIVE = None
+_LOCAL = threading.local()
+
+# ru_maxrss is reported in kilobytes on Linux but in bytes on macOS
+_MAXRSS_TO_MB = 1 / 1024**2 if sys.platform == 'darwin' else 1 / 1024
+
+def _read_hwm():
+    """
+    Peak resident set size of this process in MB since it was
+    last reset, or None if unavailable.
+    """
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_hwm():
+    """
+    Reset the peak resident set size of this process to its
+    current resident set size. Returns whether it succeeded.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    hwm = _read_hwm()
+    if hwm is None:
+        hwm = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_TO_MB
+    return hwm
+
+class _Frame:
+    """
+    A profiled step which is currently running.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.peak_rss = 0
+        self.started = time.time()
+        self.wall = time.perf_counter()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+class Profiler:
+    """
+    Collects the records of profiled steps.
+    """
+    def __init__(self):
+        self.records = []
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stack():
+        if not hasattr(_LOCAL, 'stack'):
+            _LOCAL.stack = []
+        return _LOCAL.stack
+
+    @contextmanager
+    def step(self, name, parent=None):
+        """
+        Context manager which profiles the enclosed block as a
+        step called `name`, nested within any step already
+        running in this thread. Steps run in a new thread can be
+        nested within a step of another thread by passing its
+        path as `parent`.
+        """
+        stack = self._stack()
+        # fold the peak so far into the enclosing steps before
+        # resetting it for this step
+        peak = _peak_rss()
+        for frame in stack:
+            frame.peak_rss = max(frame.peak_rss, peak)
+        _reset_hwm()
+        frame = _Frame(name)
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            frame.peak_rss = max(frame.peak_rss, _peak_rss())
+            for enclosing in stack:
+                enclosing.peak_rss = max(enclosing.peak_rss, frame.peak_rss)
+            self_usage = resource.getrusage(resource.RUSAGE_SELF)
+            child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            path = [f.name for f in stack] + [name]
+            if parent:
+                path.insert(0, parent)
+            record = {
+                'step': '/'.join(path),
+                'name': name,
+                'depth': len(path) - 1,
+                'started': frame.started,
+                'wall_s': time.perf_counter() - frame.wall,
+                'user_s': self_usage.ru_utime - frame.self_usage.ru_utime,
+                'sys_s': self_usage.ru_stime - frame.self_usage.ru_stime,
+                'children_user_s': child_usage.ru_utime - frame.child_usage.ru_utime,
+                'children_sys_s': child_usage.ru_stime - frame.child_usage.ru_stime,
+                'peak_rss_mb': frame.peak_rss,
+                'children_peak_rss_mb': child_usage.ru_maxrss * _MAXRSS_TO_MB
+            }
+            with self._lock:
+                self.records.append(record)
+
+    def include(self, report_name, parent=None):
+        """
+        Add the steps recorded in the report `report_name`,
+        e.g. by a pipeline script run in a separate process,
+        nesting them within the step `parent`.
+        """
+        with open(report_name, 'r') as infile:
+            records = json.load(infile)['steps']
+        for record in records:
+            if parent:
+                record['step'] = f"{parent}/{record['step']}"
+                record['depth'] += parent.count('/') + 1
+        with self._lock:
+            self.records.extend(records)
+
+    def report(self):
+        """
+        Return the recorded steps, in the order they started,
+        along with some details of the machine they ran on.
+        """
+        return {
+            'started': self.started,
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'steps': sorted(self.records, key=lambda r: r['started'])
+        }
+
+    def save(self, report_name):
+        """
+        Save the report to the json `report_name`.
+        """
+        with open(Path(report_name), 'w') as fp:
+            json.dump(self.report(), fp, indent=4)
+
+def start_profiling():
+    """
+    Start recording profiled steps, returning the `Profiler`.
+    """
+    global _ACTIVE
+    _ACTIVE = Profiler()
+    return _ACTIVE
+
+def stop_profiling():
+    """
+    Stop recording profiled steps, returning the `Profiler`
+    which was active.
+    """
+    global _ACTIVE
+    profiler, _ACTIVE = _ACTIVE, None
+    return profiler
+
+def active_profiler():
+    """
+    Return the active `Profiler`, or None if not profiling.
+    """
+    return _ACTIVE
+
+def current_step():
+    """
+    Return the path of the step running in this thread, or None
+    if there isn't one.
+    """
+    stack = Profiler._stack()
+    return '/'.join(f.name for f in stack) if stack else None
+
+@contextmanager
+def profile_step(name, parent=None):
+    """
+    Profile the enclosed block as a step called `name` if a
+    profiler is active. See `Profiler.step`.
+    """
+    if _ACTIVE is None:
+        yield
+    else:
+        with _ACTIVE.step(name, parent):
+            yield
+
+def profiled(func):
+    """
+    Decorator which profiles each call of `func` as a step named
+    after the function.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_step(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+METRICS = (
+    'wall_s',
+    'user_s',
+    'sys_s',
+    'children_user_s',
+    'children_sys_s',
+    'peak_rss_mb',
+    'children_peak_rss_mb'
+)
+
+def summarise_report(report):
+    """
+    Combine the records of a report by step, summing the times
+    of steps which ran more than once and taking the maximum of
+    their peak memory.
+    """
+    summary = {}
+    for record in report['steps']:
+        step = summary.setdefault(record['step'], dict.fromkeys(METRICS, 0))
+        for metric in METRICS:
+            if metric.endswith('_mb'):
+                step[metric] = max(step[metric], record[metric])
+            else:
+                step[metric] += record[metric]
+    return summary
+
+def compare_reports(old_report, new_report, metric='wall_s', threshold=0.1,
+                    min_value=1.0):
+    """
+    Compare `metric` for each step of two profiling reports.
+
+    Inputs:
+        - `old_report` = baseline report dictionary
+        - `new_report` = report dictionary to compare with the
+            baseline
+        - `metric` = the recorded quantity to compare
+        - `threshold` = fractional increase above which a step
+            is considered to have regressed
+        - `min_value` = steps whose baseline value is below this
+            are never flagged, to ignore noise in short steps
+
+    Returns a list of (step, old value, new value, regressed)
+    tuples, with None for values missing from either report.
+    """
+    old_summary = summarise_report(old_report)
+    new_summary = summarise_report(new_report)
+    steps = list(old_summary) + [s for s in new_summary if s not in old_summary]
+    rows = []
+    for step in steps:
+        old = old_summary.get(step, {}).get(metric)
+        new = new_summary.get(step, {}).get(metric)
+        regressed = (old is not None and new is not None and old >= min_value
+                     and new > old * (1 + threshold))
+        rows.append((step, old, new, regressed))
+    return rows
@@ -1,5 +1,7 @@
 from .initial_bookkeeping import create_dirs
-from .m0_mt_correction import load_json, update_json
+from .manifest import read_manifest
+from .scheduler import task, run_tasks
+from functools import partial
 from pathlib import Path
 import subprocess
 from fsl.wrappers.flirt import applyxfm
@@ -7,7 +9,7 @@ from itertools import product
 
 def project_to_surface(subject_dir):
     # load subject's json
-    json_dict = load_json(subject_dir)
+    json_dict = read_manifest(subject_dir)
 
     # perfusion calib and variance calib
     pc_name = Path(json_dict['oxford_asl']) / 'struct_space/perfusion_calib.nii.gz'
@@ -19,6 +21,9 @@ def project_to_surface(subject_dir):
     create_dirs([projection_dir, ])
     sides = ('L', 'R')
 
+    # the projections are independent of one another so run them 
+    # concurrently
+    tasks = []
     for name, side in product(names, sides):
         # surface file names
         mid_name = json_dict[f'{side}_mid']
@@ -40,4 +45,10 @@ def project_to_surface(subject_dir):
             white_name,
             pial_name
         ]
-        subprocess.run(cmd)
\ No newline at end of file
+        tasks.append(task(
+            f'{side}_{stem}',
+            partial(subprocess.run, cmd, check=True),
+            inputs=[name, mid_name, white_name, pial_name],
+            outputs=[savename]
+        ))
+    run_tasks(tasks)
\ No newline at end of file
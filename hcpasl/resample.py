@@ -0,0 +1,158 @@
+"""
+In-process trilinear resampling of a 3D image by a series of FSL
+affine transformations, e.g. aligning a parameter map with each
+frame of the ASL series using mcflirt's motion estimates.
+
+This is equivalent to running `applyxfm` with trilinear
+interpolation once per transformation and merging the results
+with `fslmerge`, but the 4D output is written directly, a volume
+at a time, with the volumes resampled by a pool of threads.
+
+As with `applyxfm`, points which map outside the source image are
+set to zero. `resample_image` resamples an image by a single
+transformation in the same way, like a single `applyxfm` run.
+"""
+
+from .nifti_stream import open_output
+from .image_cache import load_image
+from fsl.data.image import Image
+from .scheduler import core_budget
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import os
+
+# tolerance for points mapping just outside the source image
+_EDGE_TOLERANCE = 1e-4
+
+def voxel_transforms(transforms, src, ref):
+    """
+    Convert FSL transformations, which map the scaled voxel
+    coordinates of `src` to those of `ref`, into transformations
+    from the voxel indices of `ref` to the voxel indices of `src`.
+
+    Inputs:
+        - `transforms` = (N, 4, 4) array of FSL matrices
+        - `src` = fsl.data.image.Image being resampled
+        - `ref` = fsl.data.image.Image whose grid is resampled
+            onto
+
+    Returns an (N, 4, 4) array.
+    """
+    transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 4, 4)
+    ref2fsl = ref.getAffine('voxel', 'fsl')
+    fsl2src = src.getAffine('fsl', 'voxel')
+    return fsl2src @ np.linalg.inv(transforms) @ ref2fsl
+
+def trilinear(data, coords):
+    """
+    Sample the 3D array `data` at the (3, M) array of voxel
+    coordinates `coords` by trilinear interpolation, returning
+    zero for points outside the array.
+    """
+    shape = np.array(data.shape[:3])
+    upper = (shape - 1)[:, np.newaxis]
+    inside = np.all((coords >= -_EDGE_TOLERANCE) & (coords <= upper + _EDGE_TOLERANCE), axis=0)
+    points = np.clip(coords[:, inside], 0, upper)
+    # lower corner of the cell containing each point, keeping the
+    # upper corner inside the array
+    corner = np.minimum(points.astype(np.intp), np.maximum(shape - 2, 0)[:, np.newaxis])
+    wx, wy, wz = (points - corner).astype(np.float32)
+    # index of each corner in the flattened array, with steps to
+    # the upper corner of zero along dimensions of length 1
+    strides = np.array([shape[1] * shape[2], shape[2], 1])
+    base = strides @ corner
+    sx, sy, sz = strides * (shape > 1)
+    flat = np.ascontiguousarray(data, dtype=np.float32).ravel()
+    # interpolate along z, then y, then x
+    c00 = flat[base] + wz * (flat[base + sz] - flat[base])
+    c01 = flat[base + sy] + wz * (flat[base + sy + sz] - flat[base + sy])
+    c10 = flat[base + sx] + wz * (flat[base + sx + sz] - flat[base + sx])
+    c11 = flat[base + sx + sy] + wz * (flat[base + sx + sy + sz] - flat[base + sx + sy])
+    c0 = c00 + wy * (c01 - c00)
+    c1 = c10 + wy * (c11 - c10)
+    values = np.zeros(coords.shape[1], dtype=np.float32)
+    values[inside] = c0 + wx * (c1 - c0)
+    return values
+
+def _grid(shape):
+    """
+    Homogeneous voxel coordinates of a grid of `shape`, as a
+    (4, M) array in the Fortran order of a NIfTI image's data.
+    """
+    grid = np.indices(shape, dtype=np.float32).reshape(3, -1, order='F')
+    return np.vstack([grid, np.ones((1, grid.shape[1]), dtype=np.float32)])
+
+def resample_image(src_name, transform, ref_name, out_name):
+    """
+    Resample the 3D or 4D image `src_name` onto the grid of
+    `ref_name` by a single FSL transformation, like `applyxfm`
+    with trilinear interpolation, saving the result to `out_name`.
+
+    Inputs:
+        - `src_name` = filename or fsl.data.image.Image of the
+            image to resample
+        - `transform` = 4x4 FSL matrix from `src_name` to
+            `ref_name`
+        - `ref_name` = filename or fsl.data.image.Image of the
+            reference image of the transformation
+        - `out_name` = name of the output
+    """
+    src = load_image(src_name)
+    ref = load_image(ref_name)
+    grid_shape = tuple(ref.shape[:3])
+    matrix = voxel_transforms(transform, src, ref)[0]
+    coords = matrix[:3].astype(np.float32) @ _grid(grid_shape)
+    data = np.asarray(src.data, dtype=np.float32)
+    volumes = [data.reshape(src.shape[:3])] if data.ndim == 3 else np.moveaxis(data, 3, 0)
+    out = np.stack([trilinear(volume, coords).reshape(grid_shape, order='F') 
+                    for volume in volumes], axis=-1)
+    if data.ndim == 3:
+        out = out[..., 0]
+    Image(out, xform=ref.voxToWorldMat).save(str(out_name))
+    return out_name
+
+def resample_series(src_name, transforms, ref_name, out_name, workers=None):
+    """
+    Resample the 3D image `src_name` onto the grid of `ref_name`
+    by each of a series of FSL transformations, saving the
+    results as the 4D image `out_name`.
+
+    Inputs:
+        - `src_name` = filename or fsl.data.image.Image of the
+            image to resample
+        - `transforms` = (N, 4, 4) array of FSL matrices, such
+            as those written by mcflirt
+        - `ref_name` = filename or fsl.data.image.Image of the
+            reference image of the transformations
+        - `out_name` = name of the 4D output with N volumes
+        - `workers` = number of threads. Default is the
+            scheduler's core budget.
+    """
+    src = load_image(src_name)
+    ref = load_image(ref_name)
+    data = np.ascontiguousarray(src.data, dtype=np.float32).reshape(src.shape[:3])
+    vox2src = voxel_transforms(transforms, src, ref)
+    grid_shape = tuple(ref.shape[:3])
+    # voxel coordinates of the reference grid, in the order of
+    # the output's data
+    grid = _grid(grid_shape)
+
+    def resample(matrix):
+        coords = (matrix[:3].astype(np.float32) @ grid)
+        return trilinear(data, coords)
+
+    out_name = Path(out_name)
+    tmp_name = out_name.parent / f'.tmp.{out_name.name}'
+    outfile = open_output(tmp_name, ref.header, (*grid_shape, len(vox2src)))
+    try:
+        with ThreadPoolExecutor(max_workers=workers or core_budget()) as executor:
+            for volume in executor.map(resample, vox2src):
+                outfile.write(volume.astype('<f4').tobytes())
+    except BaseException:
+        outfile.close()
+        tmp_name.unlink(missing_ok=True)
+        raise
+    outfile.close()
+    os.replace(tmp_name, out_name)
+    return out_name
@@ -0,0 +1,203 @@
+"""
+A native, vectorised fit of the saturation recovery model to the
+control images of the ASL series, as an alternative to running
+Fabber's `satrecov` model.
+
+satrecov_model: S(t) = M0t * (1 - exp{-t/T1t})
+
+where t = TI + n*slicedt for a voxel in the n-th slice of its
+band, as in Fabber with `fixa` set. M0t and T1t are fitted by
+least squares in every voxel at once with a batched Levenberg-
+Marquardt algorithm, with blocks of voxels fitted concurrently by
+worker processes.
+
+Unlike Fabber's spatial VB, no spatial prior is used. The T1t map
+is median filtered before it is used for the slice-timing
+correction either way.
+
+As with Fabber, the fit can be restricted to a brain mask, in
+which case both parameters are zero outside the mask.
+
+The engine used by the pipeline is set once per process with
+`set_satrecov_engine`.
+"""
+
+from .image_cache import load_image
+from .scheduler import core_budget
+from fsl.data.image import Image
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+
+SATRECOV_ENGINES = ('fabber', 'native')
+
+# T1t used to initialise the fit and for voxels which can't be
+# fitted, e.g. outside the brain, in seconds
+T1_INIT = 1.3
+T1_BOUNDS = (0.01, 10.0)
+
+# voxels fitted by each worker process at a time
+BLOCK_SIZE = 20000
+
+_SATRECOV_ENGINE = 'fabber'
+
+def set_satrecov_engine(engine):
+    """
+    Set the engine used to fit the saturation recovery model,
+    either 'fabber' or 'native'. If `engine` is None, the default
+    of 'fabber' is used.
+    """
+    global _SATRECOV_ENGINE
+    engine = engine or 'fabber'
+    if engine not in SATRECOV_ENGINES:
+        raise ValueError(f'Unknown satrecov engine {engine}. Engines are: '
+                         + ', '.join(SATRECOV_ENGINES) + '.')
+    _SATRECOV_ENGINE = engine
+
+def satrecov_engine():
+    """
+    Return the engine used to fit the saturation recovery model.
+    """
+    return _SATRECOV_ENGINE
+
+def _sum_squares(signal, times, m0, t1):
+    model = m0[:, np.newaxis] * (1 - np.exp(-times / t1[:, np.newaxis]))
+    return np.sum((signal - model)**2, axis=1)
+
+def fit_block(signal, times, n_iter=50, tol=1e-6):
+    """
+    Fit the saturation recovery model to a block of voxels.
+
+    Inputs:
+        - `signal` = (n_voxels, n_times) array of the voxels'
+            control images
+        - `times` = (n_voxels, n_times) array of the times at
+            which each voxel was imaged
+        - `n_iter` = maximum number of iterations
+        - `tol` = relative change in the cost below which a
+            voxel's fit has converged
+
+    Returns arrays of the fitted M0t and T1t of each voxel.
+    """
+    signal = signal.astype(np.float64)
+    times = times.astype(np.float64)
+    t1 = np.full(signal.shape[0], T1_INIT)
+    # M0t which fits the data best given the initial T1t
+    f = 1 - np.exp(-times / t1[:, np.newaxis])
+    m0 = np.sum(signal * f, axis=1) / np.sum(f * f, axis=1)
+    cost = _sum_squares(signal, times, m0, t1)
+    damping = np.full_like(t1, 1e-3)
+    active = np.ones(t1.shape, dtype=bool)
+
+    for _ in range(n_iter):
+        if not active.any():
+            break
+        s, t = signal[active], times[active]
+        m, T = m0[active], t1[active]
+        e = np.exp(-t / T[:, np.newaxis])
+        residual = s - m[:, np.newaxis] * (1 - e)
+        # jacobian with respect to M0t and T1t
+        j0 = 1 - e
+        j1 = -m[:, np.newaxis] * e * t / T[:, np.newaxis]**2
+        a00 = np.sum(j0 * j0, axis=1)
+        a01 = np.sum(j0 * j1, axis=1)
+        a11 = np.sum(j1 * j1, axis=1)
+        g0 = np.sum(j0 * residual, axis=1)
+        g1 = np.sum(j1 * residual, axis=1)
+        # solve the damped 2x2 normal equations in every voxel
+        lam = damping[active]
+        d00, d11 = a00 * (1 + lam), a11 * (1 + lam)
+        det = d00 * d11 - a01**2
+        det = np.where(det == 0, np.finfo(float).tiny, det)
+        new_m = m + (d11 * g0 - a01 * g1) / det
+        new_T = np.clip(T + (d00 * g1 - a01 * g0) / det, *T1_BOUNDS)
+        new_cost = _sum_squares(s, t, new_m, new_T)
+
+        old_cost = cost[active]
+        better = new_cost < old_cost
+        converged = better & (old_cost - new_cost <= tol * old_cost)
+        idx = np.flatnonzero(active)
+        m0[idx[better]] = new_m[better]
+        t1[idx[better]] = new_T[better]
+        cost[idx[better]] = new_cost[better]
+        damping[idx] = np.where(better, lam / 10, lam * 10)
+        active[idx[converged | (lam > 1e10)]] = False
+
+    failed = ~np.isfinite(m0) | ~np.isfinite(t1)
+    m0[failed], t1[failed] = 0, T1_INIT
+    return m0.astype(np.float32), t1.astype(np.float32)
+
+def _fit_block(args):
+    return fit_block(*args)
+
+def fit_satrecov(data, tis, rpts, slicedt, sliceband, workers=None, mask=None):
+    """
+    Fit the saturation recovery model to every voxel of a series
+    of control images.
+
+    Inputs:
+        - `data` = 4D array of the control images, ordered by TI
+        - `tis` = list of TIs for the ASL sequence
+        - `rpts` = list of repeats for each TI in the sequence
+        - `slicedt` = time taken to acquire each slice of a band
+        - `sliceband` = number of slices per band
+        - `workers` = number of worker processes. Default is the
+            scheduler's core budget.
+        - `mask` = 3D array of the voxels to fit (optional)
+
+    Returns 3D arrays of M0t and T1t. Voxels whose signal is zero
+    throughout get an M0t of 0 and a T1t of `T1_INIT`, while
+    voxels outside `mask` are 0 in both.
+    """
+    n_slices = data.shape[2]
+    tis_array = np.repeat(np.array(tis, dtype=np.float32), rpts)
+    slice_offsets = slicedt * (np.arange(n_slices) % sliceband)
+    # times of every volume of each slice
+    slice_times = tis_array[np.newaxis, :] + slice_offsets[:, np.newaxis]
+
+    fit = np.any(data != 0, axis=3)
+    if mask is not None:
+        fit &= mask > 0
+    voxels = np.flatnonzero(fit)
+    signal = data.reshape(-1, data.shape[3])[voxels]
+    _, _, z = np.unravel_index(voxels, data.shape[:3])
+    blocks = [
+        (signal[start:start + BLOCK_SIZE], slice_times[z[start:start + BLOCK_SIZE]])
+        for start in range(0, len(voxels), BLOCK_SIZE)
+    ]
+    workers = min(workers or core_budget(), len(blocks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fit_block, blocks))
+    else:
+        results = [_fit_block(block) for block in blocks]
+
+    m0 = np.zeros(data.shape[:3], dtype=np.float32)
+    t1 = np.full(data.shape[:3], T1_INIT, dtype=np.float32)
+    if mask is not None:
+        t1[mask <= 0] = 0
+    if results:
+        m0.flat[voxels] = np.concatenate([r[0] for r in results])
+        t1.flat[voxels] = np.concatenate([r[1] for r in results])
+    return m0, t1
+
+def native_saturation_recovery(control_name, out_dir, tis, rpts, slicedt, sliceband,
+                               mask_name=None):
+    """
+    Fit the saturation recovery model to the control images
+    `control_name`, a filename or fsl.data.image.Image, within
+    the mask `mask_name` if given, and
+    save the parameter maps as `{out_dir}/mean_M0t.nii.gz` and
+    `{out_dir}/mean_T1t.nii.gz`, as Fabber does.
+
+    Returns the name of the T1t map.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    control_img = load_image(control_name)
+    data = np.asarray(control_img.data, dtype=np.float32)
+    mask = None if mask_name is None else np.asarray(load_image(mask_name).data)
+    m0, t1 = fit_satrecov(data, tis, rpts, slicedt, sliceband, mask=mask)
+    for name, param in (('M0t', m0), ('T1t', t1)):
+        Image(param, header=control_img.header).save(str(out_dir / f'mean_{name}.nii.gz'))
+    return out_dir / 'mean_T1t.nii.gz'
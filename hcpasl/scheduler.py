@@ -0,0 +1,134 @@
+"""
+A simple scheduler for running a set of pipeline tasks which
+depend on one another through the files they read and write.
+
+Each task declares the files it reads (`inputs`) and writes
+(`outputs`). A task is started as soon as every task producing
+one of its inputs has finished, so independent tasks, e.g.
+topup and the partial volume estimation in the distortion
+correction stage, run side by side. The number of tasks run at
+once is limited by a core budget: each task declares how many
+cores it uses and tasks are only started while the cores in use
+stay within the budget.
+"""
+
+from .profiling import profile_step, current_step
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
+from pathlib import Path
+import os
+
+# a scheduled task. `run` is called with no arguments and must
+# create all of `outputs` from `inputs`. `cores` is the number
+# of cores the task is expected to use.
+Task = namedtuple('Task', ['name', 'run', 'inputs', 'outputs', 'cores'])
+
+_CORE_BUDGET = None
+
+def set_core_budget(cores):
+    """
+    Set the number of cores available to scheduled tasks. If
+    `cores` is None, all of the machine's cores are used.
+    """
+    global _CORE_BUDGET
+    _CORE_BUDGET = cores
+
+def core_budget():
+    """
+    Return the number of cores available to scheduled tasks.
+    """
+    return _CORE_BUDGET or os.cpu_count() or 1
+
+def task(name, run, inputs=(), outputs=(), cores=1):
+    """
+    Create a `Task`, normalising the filenames of its inputs and
+    outputs. Inputs which are None, e.g. optional files which
+    weren't provided, are ignored.
+    """
+    inputs = tuple(str(Path(i)) for i in inputs if i is not None)
+    outputs = tuple(str(Path(o)) for o in outputs)
+    return Task(name, run, inputs, outputs, cores)
+
+def _dependencies(tasks):
+    """
+    Return a dictionary mapping each task's name to the set of
+    names of the tasks producing its inputs.
+    """
+    producers = {}
+    for t in tasks:
+        for output in t.outputs:
+            if output in producers:
+                raise ValueError(f'{output} is an output of both '
+                                 + f'{producers[output]} and {t.name}.')
+            producers[output] = t.name
+    dependencies = {}
+    for t in tasks:
+        dependencies[t.name] = {producers[i] for i in t.inputs if i in producers}
+        missing = [i for i in t.inputs if i not in producers and not Path(i).exists()]
+        if missing:
+            raise FileNotFoundError(f'Inputs of task {t.name} do not exist '
+                                    + f'and are not produced by any task: {missing}')
+    return dependencies
+
+def _run_task(t, parent=None):
+    with profile_step(t.name, parent):
+        t.run()
+    missing = [o for o in t.outputs if not Path(o).exists()]
+    if missing:
+        raise RuntimeError(f'Task {t.name} did not produce its outputs: {missing}')
+
+def run_tasks(tasks, cores=None):
+    """
+    Run `tasks` in an order respecting their dependencies,
+    running independent tasks concurrently.
+
+    Inputs:
+        - `tasks` = list of `Task`s
+        - `cores` = number of cores the tasks may use at once.
+            Default is the global core budget.
+
+    If a task fails, no further tasks are started and the error
+    is raised once the running tasks have finished.
+    """
+    cores = cores or core_budget()
+    parent = current_step()
+    dependencies = _dependencies(tasks)
+    if len({t.name for t in tasks}) != len(tasks):
+        raise ValueError('Task names must be unique.')
+    pending = {t.name: t for t in tasks}
+    done = set()
+    running = {}
+    cores_in_use = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, cores)) as executor:
+        while pending or running:
+            # start every ready task which fits within the budget.
+            # a task needing more cores than the budget is run on
+            # its own rather than never being run.
+            if error is None:
+                for name, t in list(pending.items()):
+                    if not dependencies[name] <= done:
+                        continue
+                    needed = min(t.cores, cores)
+                    if running and cores_in_use + needed > cores:
+                        continue
+                    running[executor.submit(_run_task, t, parent)] = t
+                    cores_in_use += needed
+                    del pending[name]
+            elif not running:
+                break
+            if not running:
+                raise RuntimeError('Tasks have circular dependencies: '
+                                   + ', '.join(pending))
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                t = running.pop(future)
+                cores_in_use -= min(t.cores, cores)
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                        print(f'Task {t.name} failed.')
+                else:
+                    done.add(t.name)
+    if error is not None:
+        raise error
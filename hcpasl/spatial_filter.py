@@ -0,0 +1,175 @@
+"""
+In-process spatial filters for 3D and 4D images, in place of
+running `fslmaths -fmedian`, `-s` or `-dilF` on small maps such
+as the T1t estimate of the saturation recovery fit.
+
+Each volume is filtered in slabs of slices by a pool of threads.
+Filters can be given a brain mask, in which case only voxels
+within the mask contribute to the filtered values, so the zero
+background doesn't drag down voxels at the edge of the brain,
+and voxels outside the mask are zero in the result. Voxels
+beyond the edges of the image are ignored in the same way.
+"""
+
+from .scheduler import core_budget
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+
+def _slabs(n_slices, workers):
+    """
+    Split `n_slices` slices into at most `workers` slabs,
+    returning a list of `(start, stop)` pairs.
+    """
+    bounds = np.linspace(0, n_slices, min(workers, n_slices) + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def _volumes(data, mask):
+    """
+    Yield the 3D volumes of `data`, a 3D or 4D array, with the
+    matching 3D mask of the voxels which contribute to filtering.
+    """
+    data = np.asarray(data)
+    if mask is None:
+        mask = np.ones(data.shape[:3], dtype=bool)
+    else:
+        mask = np.asarray(mask).reshape(data.shape[:3]) > 0
+    if data.ndim == 3:
+        yield data, mask
+    else:
+        for volume in range(data.shape[3]):
+            yield data[..., volume], mask
+
+def _filter(data, mask, filter_slab, workers, prepare=None):
+    """
+    Apply `filter_slab(volume, valid, start, stop)`, which
+    returns the filtered slices `start` to `stop` of a volume,
+    to every volume of `data` in slabs run concurrently. If
+    `prepare(volume, valid)` is given, it is called once per
+    volume and its result is passed to `filter_slab` in place of
+    the volume, e.g. to pad the volume once for all of its slabs.
+    """
+    out = np.zeros(np.shape(data), dtype=np.float32)
+    out_volumes = [out] if out.ndim == 3 else [out[..., n] for n in range(out.shape[3])]
+    workers = workers or core_budget()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (volume, valid), out_volume in zip(_volumes(data, mask), out_volumes):
+            volume = np.asarray(volume, dtype=np.float32)
+            if prepare is not None:
+                volume = prepare(volume, valid)
+            slabs = _slabs(volume.shape[2], workers)
+            results = executor.map(lambda slab: filter_slab(volume, valid, *slab), slabs)
+            for (start, stop), filtered in zip(slabs, results):
+                out_volume[:, :, start:stop] = np.where(valid[:, :, start:stop], filtered, 0)
+    return out
+
+def median_filter(data, size=3, mask=None, workers=None):
+    """
+    Median filter a 3D or 4D array over a box of `size` voxels
+    in each spatial dimension, like `fslmaths -fmedian` with its
+    default 3x3x3 kernel.
+
+    Inputs:
+        - `data` = 3D or 4D array
+        - `size` = width of the box, an odd number of voxels
+        - `mask` = 3D array of the voxels to include (optional).
+            Only these voxels contribute to the medians and the
+            others are zero in the result.
+        - `workers` = number of threads. Default is the
+            scheduler's core budget.
+
+    Returns the filtered float32 array.
+    """
+    radius = size // 2
+
+    def pad(volume, valid):
+        # excluded voxels and those beyond the edges as NaN
+        return np.pad(np.where(valid, volume, np.nan), radius, constant_values=np.nan)
+
+    def filter_slab(padded, valid, start, stop):
+        # neighbourhood of the slab, a view of the padded volume
+        windows = sliding_window_view(padded[:, :, start:stop + 2*radius], (size, ) * 3)
+        windows = windows.reshape(*windows.shape[:3], -1)
+        # NaNs are sorted to the end
+        ordered = np.sort(windows, axis=-1)
+        n_valid = np.count_nonzero(~np.isnan(ordered), axis=-1)
+        lower = np.take_along_axis(ordered, np.maximum(n_valid - 1, 0)[..., np.newaxis] // 2, -1)
+        upper = np.take_along_axis(ordered, (n_valid // 2)[..., np.newaxis], -1)
+        median = (lower[..., 0] + upper[..., 0]) / 2
+        return np.where(n_valid > 0, median, 0)
+
+    return _filter(data, mask, filter_slab, workers, prepare=pad)
+
+def gaussian_filter(data, sigma, voxel_size=(1, 1, 1), mask=None, workers=None):
+    """
+    Smooth a 3D or 4D array with a Gaussian kernel of standard
+    deviation `sigma` mm, like `fslmaths -s`, truncated at 3
+    standard deviations.
+
+    Inputs:
+        - `data` = 3D or 4D array
+        - `sigma` = standard deviation of the kernel in mm
+        - `voxel_size` = size of a voxel in mm in each dimension
+        - `mask` = 3D array of the voxels to include (optional).
+            The kernel is renormalised over the voxels within
+            the mask and the others are zero in the result.
+        - `workers` = number of threads. Default is the
+            scheduler's core budget.
+
+    Returns the smoothed float32 array.
+    """
+    kernels = []
+    for size in voxel_size[:3]:
+        radius = int(np.ceil(3 * sigma / size))
+        offsets = np.arange(-radius, radius + 1) * size
+        kernels.append(np.exp(-offsets**2 / (2 * sigma**2)).astype(np.float32))
+    radius_z = len(kernels[2]) // 2
+
+    def convolve(array, kernel, axis):
+        # sum of shifted copies of the zero-padded array
+        radius = len(kernel) // 2
+        pad = [(0, 0)] * 3
+        pad[axis] = (radius, radius)
+        padded = np.pad(array, pad)
+        out = np.zeros_like(array)
+        n = array.shape[axis]
+        for offset, weight in enumerate(kernel):
+            out += weight * np.take(padded, range(offset, offset + n), axis=axis)
+        return out
+
+    def filter_slab(volume, valid, start, stop):
+        # slices either side of the slab which contribute to it
+        low, high = max(start - radius_z, 0), min(stop + radius_z, volume.shape[2])
+        weights = valid[:, :, low:high].astype(np.float32)
+        values = np.where(valid[:, :, low:high], volume[:, :, low:high], 0)
+        for axis, kernel in enumerate(kernels):
+            values = convolve(values, kernel, axis)
+            weights = convolve(weights, kernel, axis)
+        values, weights = values[:, :, start - low:stop - low], weights[:, :, start - low:stop - low]
+        out = np.zeros_like(values)
+        return np.divide(values, weights, out=out, where=weights > 0)
+
+    return _filter(data, mask, filter_slab, workers)
+
+def max_filter(data, size=3, workers=None):
+    """
+    Replace each voxel of a 3D or 4D array with the maximum over
+    a box of `size` voxels in each spatial dimension, like
+    `fslmaths -kernel boxv <size> -dilF`, e.g. to dilate a mask.
+
+    Returns the filtered float32 array.
+    """
+    radius = size // 2
+
+    def filter_slab(volume, valid, start, stop):
+        low, high = max(start - radius, 0), min(stop + radius, volume.shape[2])
+        values = volume[:, :, low:high]
+        # a box maximum is separable into maxima along each axis
+        for axis in range(3):
+            pad = [(0, 0)] * 3
+            pad[axis] = (radius, radius)
+            padded = np.pad(values, pad, constant_values=-np.inf)
+            values = sliding_window_view(padded, size, axis=axis).max(axis=-1)
+        return values[:, :, start - low:stop - low]
+
+    return _filter(data, None, filter_slab, workers)
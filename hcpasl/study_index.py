@@ -0,0 +1,248 @@
+"""
+An index of the scans of each subject in a study directory, so that
+the pipeline can find a subject's mbPCASL sequence, spin echo field
+maps, T1w scan and surfaces without recursively searching their
+XNAT-style directory tree every time it is run.
+
+The index is saved as `hcp_asl_index.json` in the study directory
+by `build_index`. Paths are stored relative to each subject's
+directory, so the index stays valid if the study is moved and can
+be used for working copies of subjects made by `workdir`.
+
+Each subject's entry records the modification times of their
+session and scan directories, so rebuilding the index only
+re-walks subjects whose scans have changed and adds subjects which
+are new to the study.
+
+Lookups fall back to searching the subject's directory, as before,
+if there is no index or the subject isn't in it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import threading
+import json
+import os
+
+INDEX_NAME = 'hcp_asl_index.json'
+INDEX_VERSION = 1
+
+# surfaces used by the pipeline, keyed as they are in ASL.json
+SURFACES = {
+    f'{side}_{key}': f'{side}.{surf}.32k_fs_LR.surf.gii'
+    for side in ('L', 'R')
+    for key, surf in (('mid', 'midthickness'), ('pial', 'pial'), ('white', 'white'))
+}
+
+_LOCK = threading.Lock()
+_INDICES = {}
+
+def _scan_dirs(session_dir):
+    """
+    Return the scan directories in the `scans` directories of
+    `session_dir`, walking the session's tree once and not
+    descending into the scans themselves.
+    """
+    scans = []
+    for root, dirnames, _ in os.walk(session_dir):
+        if Path(root).name == 'scans':
+            scans += [Path(root) / name for name in dirnames]
+            dirnames[:] = []
+    return sorted(scans)
+
+def _stamp(subject_dir):
+    """
+    Return the modification times of the subject's directory, its
+    sessions, their scans directories and the structural
+    directories, which change when scans are added or removed.
+    """
+    paths = [subject_dir / 'T1w', subject_dir / 'T1w/fsaverage_LR32k']
+    for session_dir in sorted(subject_dir.glob(f'{subject_dir.name}_V1_*')):
+        paths += [session_dir, session_dir / 'scans']
+    stamp = {'.': subject_dir.stat().st_mtime_ns}
+    for path in paths:
+        if path.is_dir():
+            stamp[str(path.relative_to(subject_dir))] = path.stat().st_mtime_ns
+    return stamp
+
+def _field_maps(scan_dirs, subject_name):
+    """
+    Return the PA and AP spin echo field maps from the final 2
+    field map directories of the B session, or None if they
+    can't be found.
+    """
+    fm_dirs = [d for d in scan_dirs if d.name.endswith('-FieldMap_SE_EPI')][-2:]
+    files = 'resources/NIFTI/files'
+    prefix = f'{subject_name}_V1_B_PCASLhr_SpinEchoFieldMap'
+    for pa_dir, ap_dir in (fm_dirs, fm_dirs[::-1]):
+        pa_sefm = pa_dir / files / f'{prefix}_PA.nii.gz'
+        ap_sefm = ap_dir / files / f'{prefix}_AP.nii.gz'
+        if pa_sefm.exists():
+            return pa_sefm, ap_sefm
+    return None, None
+
+def index_subject(subject_dir):
+    """
+    Walk the directory of a single subject and return their
+    index entry.
+
+    Inputs:
+        - `subject_dir` = pathlib.Path of the subject's directory
+    """
+    subject_dir = Path(subject_dir)
+    name = subject_dir.name
+    entry = {'stamp': _stamp(subject_dir)}
+
+    def add(key, path):
+        if path is not None and path.exists():
+            entry[key] = str(path.relative_to(subject_dir))
+
+    # mbPCASL sequence and field maps in the B session
+    b_scans = _scan_dirs(subject_dir / f'{name}_V1_B')
+    for scan_dir in b_scans:
+        if scan_dir.name.endswith('mbPCASLhr'):
+            add('mbpcasl', scan_dir / f'resources/NIFTI/files/{name}_V1_B_mbPCASLhr_PA.nii.gz')
+            break
+    if len([d for d in b_scans if d.name.endswith('-FieldMap_SE_EPI')]) >= 2:
+        pa_sefm, ap_sefm = _field_maps(b_scans, name)
+        add('pa_sefm', pa_sefm)
+        add('ap_sefm', ap_sefm)
+
+    # unprocessed T1w scan in the A session
+    for scan_dir in _scan_dirs(subject_dir / f'{name}_V1_A'):
+        if scan_dir.name.endswith('T1w'):
+            add('t1w_files', scan_dir / 'resources/NIFTI/files')
+            t1w_scans = sorted((scan_dir / 'resources/NIFTI/files').glob(f'**/{name}_*.nii.gz'))
+            if t1w_scans:
+                add('t1w_scan', t1w_scans[0])
+            break
+
+    # pre-processed structural data
+    t1w_dir = subject_dir / 'T1w'
+    add('T1w_acpc', t1w_dir / 'T1w_acpc_dc_restore.nii.gz')
+    add('T1w_acpc_brain', t1w_dir / 'T1w_acpc_dc_restore_brain.nii.gz')
+    for key, surf in SURFACES.items():
+        add(key, t1w_dir / f'fsaverage_LR32k/{name}_V1_MR.{surf}')
+    return entry
+
+def _subject_dirs(study_dir):
+    """
+    Return the subject directories in `study_dir`, i.e. those
+    containing a session or T1w directory.
+    """
+    subject_dirs = []
+    with os.scandir(study_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            subject_dir = Path(entry.path)
+            if ((subject_dir / 'T1w').is_dir()
+                    or any(subject_dir.glob(f'{entry.name}_V1_*'))):
+                subject_dirs.append(subject_dir)
+    return sorted(subject_dirs)
+
+def load_index(study_dir):
+    """
+    Load the index of `study_dir`, returning an empty index if
+    it doesn't exist or was made by another version.
+    """
+    index_name = Path(study_dir) / INDEX_NAME
+    if index_name.exists():
+        with open(index_name, 'r') as infile:
+            index = json.load(infile)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    return {'version': INDEX_VERSION, 'subjects': {}}
+
+def build_index(study_dir, workers=8, rebuild=False):
+    """
+    Index the subjects in `study_dir` and save the index in the
+    study directory.
+
+    Inputs:
+        - `study_dir` = pathlib.Path of the study directory
+        - `workers` = number of subjects to walk concurrently
+        - `rebuild` = re-walk every subject rather than only
+            those which are new or whose scans have changed
+
+    Returns the index and the names of the subjects which were
+    (re-)indexed.
+    """
+    study_dir = Path(study_dir)
+    index = {'version': INDEX_VERSION, 'subjects': {}} if rebuild else load_index(study_dir)
+    old_entries = index['subjects']
+    subject_dirs = _subject_dirs(study_dir)
+
+    def needs_update(subject_dir):
+        entry = old_entries.get(subject_dir.name)
+        return entry is None or entry['stamp'] != _stamp(subject_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stale = [d for d, update in zip(subject_dirs, executor.map(needs_update, subject_dirs))
+                 if update]
+        new_entries = dict(zip([d.name for d in stale], executor.map(index_subject, stale)))
+
+    # drop subjects which have been removed from the study
+    index['subjects'] = {
+        d.name: new_entries.get(d.name, old_entries.get(d.name)) for d in subject_dirs
+    }
+    index_name = study_dir / INDEX_NAME
+    tmp_name = study_dir / f'.{INDEX_NAME}.{os.getpid()}.tmp'
+    with open(tmp_name, 'w') as fp:
+        json.dump(index, fp, sort_keys=True, separators=(',', ':'))
+    os.replace(tmp_name, index_name)
+    return index, sorted(new_entries)
+
+def _cached_index(study_dir):
+    """
+    Return the index of `study_dir`, only re-reading it when the
+    file changes, or None if there is no index.
+    """
+    index_name = (Path(study_dir) / INDEX_NAME).resolve()
+    try:
+        stat = index_name.stat()
+    except FileNotFoundError:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        cached = _INDICES.get(index_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    index = load_index(index_name.parent)
+    with _LOCK:
+        _INDICES[index_name] = (key, index)
+    return index
+
+def _subject_entry(subject_dir):
+    """
+    Return the index entry of `subject_dir` from the index of its
+    study directory or, for a working copy of the subject, the
+    index of the original subject's study directory.
+    """
+    name = subject_dir.name
+    study_dirs = [subject_dir.parent]
+    # working copies link to the sessions of the original subject
+    session_dir = subject_dir / f'{name}_V1_B'
+    if session_dir.is_symlink():
+        study_dirs.append(session_dir.resolve().parent.parent)
+    for study_dir in study_dirs:
+        index = _cached_index(study_dir)
+        if index is not None and name in index['subjects']:
+            return index['subjects'][name]
+    return None
+
+def indexed_path(subject_dir, key):
+    """
+    Look up the file `key`, e.g. 'mbpcasl', of the subject in
+    `subject_dir` in their study's index.
+
+    Returns the pathlib.Path of the file, or None if the subject
+    or file isn't indexed or the file no longer exists, in which
+    case the caller should search for it instead.
+    """
+    subject_dir = Path(subject_dir)
+    entry = _subject_entry(subject_dir)
+    if entry is None or key not in entry:
+        return None
+    path = subject_dir / entry[key]
+    return path if path.exists() else None
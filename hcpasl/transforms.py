@@ -0,0 +1,161 @@
+"""
+A series of affine transformations, e.g. mcflirt's motion
+estimates, held as a single (N, 4, 4) array.
+
+mcflirt writes one text file per frame to a `.mat` directory and
+FSL tools such as oxford_asl read a `.cat` file of the matrices
+one after another. A `TransformSeries` can be read from and
+written to either, but is otherwise kept in a single `.npy` file
+and composed, inverted and compared as a whole rather than one
+matrix at a time.
+"""
+
+from pathlib import Path
+import numpy as np
+
+class TransformSeries:
+    """
+    A series of 4x4 affine transformations.
+
+    Series are composed with `@`, like their matrices. Either
+    side can be a single 4x4 matrix, which is applied to every
+    transformation, or a series of the same length, which is
+    applied frame by frame.
+    """
+
+    def __init__(self, matrices):
+        """
+        Inputs:
+            - `matrices` = array of (N, 4, 4) matrices, or a
+                single 4x4 matrix
+        """
+        matrices = np.array(matrices, dtype=np.float64)
+        if matrices.shape[-2:] != (4, 4):
+            raise ValueError(f'Transformations of shape {matrices.shape} are not 4x4.')
+        self.matrices = matrices.reshape(-1, 4, 4)
+
+    @classmethod
+    def identity(cls, n):
+        """
+        A series of `n` identity transformations.
+        """
+        return cls(np.tile(np.eye(4), (n, 1, 1)))
+
+    @classmethod
+    def from_mat_dir(cls, mat_dir):
+        """
+        Load the matrices in the directory `mat_dir`, in order of
+        their names, e.g. the `MAT_0000`, `MAT_0001`... written by
+        mcflirt.
+        """
+        names = sorted(name for name in Path(mat_dir).iterdir() if name.is_file())
+        if not names:
+            raise FileNotFoundError(f'No transformations found in {mat_dir}.')
+        return cls(np.stack([np.loadtxt(name) for name in names]))
+
+    @classmethod
+    def from_cat(cls, cat_name):
+        """
+        Load the matrices from the text file `cat_name`, which
+        contains each matrix's 4 rows one after another.
+        """
+        return cls(np.loadtxt(cat_name).reshape(-1, 4, 4))
+
+    @classmethod
+    def load(cls, name):
+        """
+        Load a series from a `.npy` file, a directory of
+        matrices or a `.cat` file.
+        """
+        name = Path(name)
+        if name.is_dir():
+            return cls.from_mat_dir(name)
+        if name.suffix == '.npy':
+            return cls(np.load(name))
+        return cls.from_cat(name)
+
+    def save(self, name):
+        """
+        Save the series to the `.npy` file `name`.
+        """
+        np.save(name, self.matrices)
+
+    def to_mat_dir(self, mat_dir, prefix='MAT_'):
+        """
+        Save each matrix to its own file in `mat_dir`, named as
+        by mcflirt.
+        """
+        mat_dir = Path(mat_dir)
+        mat_dir.mkdir(parents=True, exist_ok=True)
+        for n, matrix in enumerate(self.matrices):
+            np.savetxt(mat_dir / f'{prefix}{n:04d}', matrix)
+
+    def to_cat(self, cat_name):
+        """
+        Save the matrices one after another to the text file
+        `cat_name`. A series of one matrix gives an ordinary
+        FSL matrix file.
+        """
+        np.savetxt(cat_name, self.matrices.reshape(-1, 4))
+
+    def __len__(self):
+        return len(self.matrices)
+
+    def __getitem__(self, index):
+        """
+        A single matrix for an integer `index`, otherwise a
+        `TransformSeries` of the selected matrices.
+        """
+        if isinstance(index, (int, np.integer)):
+            return self.matrices[index].copy()
+        return TransformSeries(self.matrices[index])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.matrices if dtype is None else self.matrices.astype(dtype)
+
+    def __matmul__(self, other):
+        other = other.matrices if isinstance(other, TransformSeries) else np.asarray(other)
+        return TransformSeries(self.matrices @ other)
+
+    def __rmatmul__(self, other):
+        return TransformSeries(np.asarray(other) @ self.matrices)
+
+    def inverse(self):
+        """
+        The series of the inverse of each transformation.
+        """
+        return TransformSeries(np.linalg.inv(self.matrices))
+
+    def relative_to(self, n=0):
+        """
+        The series of transformations relative to the `n`th, i.e.
+        inv(T_n) @ T_i for each T_i, so the `n`th is the identity.
+        """
+        relative = np.linalg.inv(self.matrices[n]) @ self.matrices
+        relative[n] = np.eye(4)
+        return TransformSeries(relative)
+
+    def rms_deviation(self, other, radius=80.0, centre=(0, 0, 0)):
+        """
+        RMS displacement between this series' transformations and
+        those of `other`, a series of the same length or a single
+        matrix, over a sphere of `radius` mm about `centre` (M.
+        Jenkinson, 1999), as reported by mcflirt.
+        """
+        other = other.matrices if isinstance(other, TransformSeries) else np.asarray(other)
+        # the difference between the transformations
+        difference = self.matrices @ np.linalg.inv(other) - np.eye(4)
+        rotation = difference[:, :3, :3]
+        translation = difference[:, :3, 3] + rotation @ np.asarray(centre, dtype=np.float64)
+        return np.sqrt(radius**2 / 5 * np.einsum('nij,nij->n', rotation, rotation)
+                       + np.einsum('ni,ni->n', translation, translation))
+
+    def framewise_displacement(self, radius=80.0, centre=(0, 0, 0)):
+        """
+        RMS displacement of each frame relative to the previous
+        one, as in mcflirt's `_rel.rms`, with zero for the first.
+        """
+        displacement = np.zeros(len(self))
+        if len(self) > 1:
+            displacement[1:] = self[1:].rms_deviation(self[:-1], radius, centre)
+        return displacement
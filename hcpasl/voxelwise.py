@@ -0,0 +1,200 @@
+"""
+An in-process replacement for chains of voxelwise `fslmaths`
+operations, e.g. dividing the ASL series by the bias field and
+then multiplying it by the MT correction scaling factors.
+
+Each `fslmaths` call in a chain is a separate process which reads
+and writes a whole, usually gzipped, image. A `VoxelChain` instead
+evaluates the whole chain in one pass over its input, a few
+volumes at a time, so each 4D series is only read and written
+once and only the images which are needed are saved:
+
+    voxelwise(asl_name).div(bias_name).mul(mt_factors).run(mtcorr_name)
+
+Arithmetic is done in float32, like `fslmaths`, and division by
+zero gives zero.
+"""
+
+from .nifti_stream import open_output, image_source
+from .image_cache import load_image
+from fsl.data.image import Image
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+import numbers
+import os
+
+# memory used by a chunk of volumes of the input, in bytes
+CHUNK_BYTES = 2**28
+
+# a step of a chain. `operand` is an image name, Image, array or
+# number for arithmetic, a threshold, or the name of the image to
+# save the chain's current value to.
+Op = namedtuple('Op', ['name', 'operand'])
+
+def _divide(a, b):
+    out = np.zeros(np.broadcast_shapes(a.shape, b.shape), dtype=np.float32)
+    return np.divide(a, b, out=out, where=(b != 0))
+
+_ARITHMETIC = {
+    'add': np.add,
+    'sub': np.subtract,
+    'mul': np.multiply,
+    'div': _divide
+}
+
+def _operand(value, shape):
+    """
+    Return `value` as a float32 array, or scalar, which can be
+    sliced by volume if it matches the 4D `shape`.
+    """
+    if isinstance(value, (numbers.Number, np.generic)):
+        return np.float32(value)
+    if isinstance(value, np.ndarray):
+        data = value
+    else:
+        data = load_image(value).data
+    data = np.asarray(data, dtype=np.float32)
+    # a single-volume 4D image applies to every volume
+    if data.ndim == 4 and data.shape[3] == 1:
+        data = data[..., 0]
+    if data.ndim == 4 and len(shape) == 4 and data.shape != tuple(shape):
+        raise ValueError(f'Operand of shape {data.shape} does not match the '
+                         + f'image of shape {tuple(shape)}.')
+    return data
+
+class VoxelChain:
+    """
+    A chain of voxelwise operations on an image, built up like
+    `fsl.wrappers.fslmaths` and evaluated by `run`.
+    """
+
+    def __init__(self, image):
+        """
+        Inputs:
+            - `image` = filename or fsl.data.image.Image to
+                which the operations are applied
+        """
+        self.image = image
+        self.ops = []
+
+    def _add(self, name, operand=None):
+        self.ops.append(Op(name, operand))
+        return self
+
+    def add(self, other):
+        return self._add('add', other)
+
+    def sub(self, other):
+        return self._add('sub', other)
+
+    def mul(self, other):
+        return self._add('mul', other)
+
+    def div(self, other):
+        return self._add('div', other)
+
+    def thr(self, value):
+        """
+        Zero voxels below `value`.
+        """
+        return self._add('thr', value)
+
+    def uthr(self, value):
+        """
+        Zero voxels above `value`.
+        """
+        return self._add('uthr', value)
+
+    def bin(self):
+        return self._add('bin')
+
+    def save(self, name):
+        """
+        Save the result of the operations so far to `name` as
+        well as carrying on with the chain.
+        """
+        return self._add('save', name)
+
+    def _evaluate(self, chunk, operands, volumes):
+        """
+        Apply the chain to `chunk`, the input's `volumes`,
+        returning the result and a list of the values to save.
+        """
+        saved = []
+        for op, operand in zip(self.ops, operands):
+            if op.name in _ARITHMETIC:
+                if isinstance(operand, np.ndarray) and operand.ndim == 4:
+                    operand = operand[..., volumes]
+                elif isinstance(operand, np.ndarray) and chunk.ndim == 4:
+                    operand = operand[..., np.newaxis]
+                chunk = _ARITHMETIC[op.name](chunk, operand)
+            elif op.name == 'thr':
+                chunk = np.where(chunk < op.operand, np.float32(0), chunk)
+            elif op.name == 'uthr':
+                chunk = np.where(chunk > op.operand, np.float32(0), chunk)
+            elif op.name == 'bin':
+                chunk = (chunk > 0).astype(np.float32)
+            elif op.name == 'save':
+                saved.append(chunk)
+        return chunk, saved
+
+    def run(self, output=None):
+        """
+        Evaluate the chain, saving the result to `output`, or
+        returning it as an Image if `output` is None.
+
+        Outputs are written alongside their final names and
+        renamed into place once complete, so an output may also
+        be the chain's input.
+        """
+        header, data = image_source(self.image)
+        shape = data.shape
+        operands = [
+            _operand(op.operand, shape) if op.name in _ARITHMETIC else op.operand
+            for op in self.ops
+        ]
+        names = [op.operand for op in self.ops if op.name == 'save']
+        if output is not None:
+            names.append(output)
+
+        n_volumes = shape[3] if len(shape) == 4 else 1
+        volume_bytes = 4 * int(np.prod(shape[:3]))
+        chunk_size = max(1, CHUNK_BYTES // volume_bytes)
+        result = None if output is not None else np.zeros(shape, dtype=np.float32)
+
+        # keep the extension so that the temporary files are gzipped if needed
+        tmp_names = [Path(name).parent / f'.tmp.{Path(name).name}' for name in names]
+        files = [open_output(tmp_name, header, shape) for tmp_name in tmp_names]
+        try:
+            for start in range(0, n_volumes, chunk_size):
+                volumes = slice(start, min(start + chunk_size, n_volumes))
+                chunk = np.asarray(data[..., volumes] if len(shape) == 4 else data[...],
+                                   dtype=np.float32)
+                chunk, saved = self._evaluate(chunk, operands, volumes)
+                if output is not None:
+                    saved.append(chunk)
+                elif len(shape) == 4:
+                    result[..., volumes] = chunk
+                else:
+                    result = chunk
+                for outfile, values in zip(files, saved):
+                    outfile.write(values.astype('<f4').tobytes(order='F'))
+        except BaseException:
+            for outfile in files:
+                outfile.close()
+            for tmp_name in tmp_names:
+                tmp_name.unlink(missing_ok=True)
+            raise
+        for outfile in files:
+            outfile.close()
+        for tmp_name, name in zip(tmp_names, names):
+            os.replace(tmp_name, name)
+        if output is None:
+            return Image(result, header=header)
+
+def voxelwise(image):
+    """
+    Start a `VoxelChain` of operations on `image`.
+    """
+    return VoxelChain(image)
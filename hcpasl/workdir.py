@@ -0,0 +1,220 @@
+"""
+Functions for processing a subject in a separate working
+directory, e.g. on local scratch or tmpfs, rather than directly
+in the subject's directory on shared storage.
+
+The working copy of the subject's directory links to the
+subject's input data, so that the pipeline can find it as
+normal, while all of the pipeline's outputs are written locally.
+Once the pipeline has finished, the final outputs, i.e. the
+oxford_asl results with their surface projections and the
+profiling report, are copied back to the subject's directory.
+
+So are the outputs recorded by the stages' checkpoints, e.g. the
+split ASL series, the motion- and distortion-corrected series, the
+brain mask and partial volume estimates and `beta_perf`. These are
+the only intermediate files copied back: without them a later run
+couldn't tell that the stages had been completed, so would re-run
+the whole pipeline. They are copied, with the final outputs, into
+any new working copy of the subject's directory so that such a run
+skips those stages.
+Everything else, e.g. the registrations, field maps and each
+step's scratch images, stays in the working directory.
+
+The subject's json is copied last, pruned of entries referring to
+files which weren't copied back.
+"""
+
+from pathlib import Path
+import shutil
+import json
+import os
+
+# final outputs copied back to the subject's directory, relative
+# to it, along with the outputs recorded by the stages'
+# checkpoints. the json is always copied last so that it only
+# ever refers to outputs which have been copied back.
+FINAL_OUTPUTS = (
+    'T1w/ASL/TIs/OxfordASL',
+    'ASL/profile.json'
+)
+MANIFEST = 'ASL/ASL.json'
+
+# directories which contain both inputs and outputs of the
+# pipeline. these are recreated in the working directory with
+# links to their contents rather than being linked themselves.
+MIXED_DIRS = {
+    'T1w': 'ASL',
+}
+
+def _replace_prefix(value, old, new):
+    """
+    Recursively replace the prefix `old` with `new` in the
+    strings in `value`, e.g. the paths in a subject's json.
+    """
+    if isinstance(value, str):
+        if value == old or value.startswith(old + os.sep):
+            return new + value[len(old):]
+        return value
+    if isinstance(value, dict):
+        return {k: _replace_prefix(v, old, new) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_replace_prefix(v, old, new) for v in value]
+    return value
+
+def _prune_missing(json_dict, src_dir, dest_dir):
+    """
+    Remove the entries of the subject's json, `json_dict`, which
+    refer to files in `src_dir` that weren't copied to `dest_dir`,
+    and the checkpoints of stages whose outputs weren't all copied.
+    Directories are recreated in `dest_dir` rather than removed,
+    as stages may write to them when re-run.
+    """
+    def missing(value):
+        if isinstance(value, list):
+            return any(missing(v) for v in value)
+        if not isinstance(value, str):
+            return False
+        moved = _replace_prefix(value, str(src_dir), str(dest_dir))
+        if moved == value:
+            return False
+        if Path(value).is_dir():
+            Path(moved).mkdir(parents=True, exist_ok=True)
+        return not Path(moved).exists()
+
+    def prune(value):
+        return {k: prune(v) if isinstance(v, dict) else v 
+                for k, v in value.items() if isinstance(v, dict) or not missing(v)}
+
+    checkpoints = json_dict.pop('checkpoints', None)
+    json_dict = prune(json_dict)
+    if checkpoints is not None:
+        json_dict['checkpoints'] = {name: checkpoint for name, checkpoint in checkpoints.items()
+                                    if not missing(checkpoint['outputs'])}
+    return json_dict
+
+def _copy_manifest(src_dir, dest_dir):
+    """
+    Copy the json from the subject directory `src_dir` to
+    `dest_dir`, updating the paths it contains and leaving out
+    those which weren't copied, via an atomic rename.
+    """
+    src_name = src_dir / MANIFEST
+    dest_name = dest_dir / MANIFEST
+    with open(src_name, 'r') as infile:
+        json_dict = json.load(infile)
+    json_dict = _prune_missing(json_dict, src_dir, dest_dir)
+    json_dict = _replace_prefix(json_dict, str(src_dir), str(dest_dir))
+    dest_name.parent.mkdir(parents=True, exist_ok=True)
+    tmp_name = dest_name.parent / f'.{dest_name.name}.tmp'
+    with open(tmp_name, 'w') as fp:
+        json.dump(json_dict, fp, sort_keys=True, indent=4)
+    os.replace(tmp_name, dest_name)
+
+def _atomic_copy(src, dest):
+    """
+    Copy the file or directory `src` to `dest`, replacing any
+    existing `dest`. The copy is made alongside `dest` and
+    renamed into place so that `dest` is never left partially
+    written.
+    """
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.parent / f'.{dest.name}.tmp'
+    old = dest.parent / f'.{dest.name}.old'
+    for leftover in (tmp, old):
+        if leftover.is_dir():
+            shutil.rmtree(leftover)
+        elif leftover.exists():
+            leftover.unlink()
+    if src.is_dir():
+        shutil.copytree(src, tmp)
+        # a directory can't be atomically replaced by another so
+        # move the existing one aside for the shortest time possible
+        if dest.exists():
+            os.rename(dest, old)
+        os.rename(tmp, dest)
+        if old.exists():
+            shutil.rmtree(old)
+    else:
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dest)
+
+def _copy_checkpointed(src_dir, dest_dir, skip=()):
+    """
+    Copy the outputs recorded by the checkpoints in the json of
+    the subject directory `src_dir` to the same place in
+    `dest_dir`, except those within the paths in `skip`, relative
+    to `src_dir`.
+    """
+    with open(src_dir / MANIFEST, 'r') as infile:
+        checkpoints = json.load(infile).get('checkpoints', {})
+    for checkpoint in checkpoints.values():
+        for output in checkpoint['outputs']:
+            src = Path(output)
+            try:
+                rel_name = src.relative_to(src_dir)
+            except ValueError:
+                continue
+            if any(rel_name == Path(s) or Path(s) in rel_name.parents for s in skip):
+                continue
+            dest = dest_dir / rel_name
+            # outputs reached through links to the subject's inputs
+            if dest.exists() and dest.resolve() == src.resolve():
+                continue
+            if src.exists():
+                _atomic_copy(src, dest)
+
+def stage_subject(subject_dir, workdir):
+    """
+    Create a working copy of `subject_dir` within `workdir`,
+    linking to the subject's input data. If a previous run left
+    a working copy, it is reused so that completed stages can be
+    skipped. Otherwise the final outputs and the outputs of the
+    stages completed by previous runs are copied into the new
+    working copy, so that syncing it back doesn't replace them
+    with only part of the results of a skipped stage.
+
+    Returns the pathlib.Path of the working copy.
+    """
+    subject_dir = Path(subject_dir).resolve()
+    work_subject_dir = Path(workdir).resolve() / subject_dir.name
+    work_subject_dir.mkdir(parents=True, exist_ok=True)
+    for entry in subject_dir.iterdir():
+        work_entry = work_subject_dir / entry.name
+        if entry.name == 'ASL':
+            continue
+        if entry.name in MIXED_DIRS and entry.is_dir():
+            work_entry.mkdir(exist_ok=True)
+            for child in entry.iterdir():
+                work_child = work_entry / child.name
+                if child.name != MIXED_DIRS[entry.name] and not os.path.lexists(work_child):
+                    work_child.symlink_to(child)
+        elif not os.path.lexists(work_entry):
+            work_entry.symlink_to(entry)
+    # carry over the record of any previous runs
+    if (subject_dir / MANIFEST).exists() and not (work_subject_dir / MANIFEST).exists():
+        for output in FINAL_OUTPUTS:
+            if (subject_dir / output).exists():
+                _atomic_copy(subject_dir / output, work_subject_dir / output)
+        _copy_checkpointed(subject_dir, work_subject_dir, skip=FINAL_OUTPUTS)
+        _copy_manifest(subject_dir, work_subject_dir)
+    return work_subject_dir
+
+def sync_subject(work_subject_dir, subject_dir, cleanup=True):
+    """
+    Copy the final outputs, the outputs of the completed stages
+    and the json from the working copy of a subject's directory,
+    `work_subject_dir`, back to the subject's directory,
+    `subject_dir`. The working copy is removed afterwards if
+    `cleanup` is True.
+    """
+    work_subject_dir = Path(work_subject_dir).resolve()
+    subject_dir = Path(subject_dir).resolve()
+    for output in FINAL_OUTPUTS:
+        src = work_subject_dir / output
+        if src.exists():
+            _atomic_copy(src, subject_dir / output)
+    _copy_checkpointed(work_subject_dir, subject_dir, skip=FINAL_OUTPUTS)
+    _copy_manifest(work_subject_dir, subject_dir)
+    if cleanup:
+        shutil.rmtree(work_subject_dir)
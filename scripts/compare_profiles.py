@@ -0,0 +1,70 @@
+"""
+Compare two profiling reports saved by the pipeline, e.g. from 
+the same subject processed by two releases, to catch performance 
+regressions.
+
+Prints the chosen metric for every step in both reports and 
+flags the steps whose value has increased by more than the 
+threshold. Exits with a non-zero status if any step regressed.
+"""
+
+from hcpasl.profiling import compare_reports, METRICS
+import argparse
+import json
+import sys
+
+def _format(value):
+    return "-" if value is None else f"{value:.2f}"
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "old_report",
+        help="Baseline profiling report."
+    )
+    parser.add_argument(
+        "new_report",
+        help="Profiling report to compare with the baseline."
+    )
+    parser.add_argument(
+        "--metric",
+        choices=METRICS,
+        default="wall_s",
+        help="Recorded quantity to compare. Default is wall_s."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fractional increase above which a step is flagged "
+            + "as a regression. Default is 0.1."
+    )
+    parser.add_argument(
+        "--min-value",
+        type=float,
+        default=1.0,
+        help="Steps with a baseline value below this are never "
+            + "flagged. Default is 1.0."
+    )
+    args = parser.parse_args()
+    with open(args.old_report, 'r') as infile:
+        old_report = json.load(infile)
+    with open(args.new_report, 'r') as infile:
+        new_report = json.load(infile)
+
+    rows = compare_reports(old_report, new_report, args.metric, 
+                           args.threshold, args.min_value)
+    width = max([len(row[0]) for row in rows] + [4])
+    print(f"{'step':<{width}}  {'old':>10}  {'new':>10}  {'change':>8}")
+    for step, old, new, regressed in rows:
+        if old and new is not None:
+            change = f"{100 * (new - old) / old:+.1f}%"
+        else:
+            change = "-"
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{step:<{width}}  {_format(old):>10}  {_format(new):>10}  {change:>8}{flag}")
+    if any(row[3] for row in rows):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
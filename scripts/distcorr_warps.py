@@ -14,6 +14,8 @@ import subprocess as sp
 import sys
 import os.path as op 
 import glob 
+import multiprocessing as mp
+from functools import partial
 
 import regtricks as rt
 import nibabel as nb
@@ -23,10 +25,18 @@ from fsl.wrappers import fslmaths
 sys.path.append("/mnt/hgfs/shared_with_vm/hcp-asl")
 
 from hcpasl.extract_fs_pvs import extract_fs_pvs
+from hcpasl.manifest import Manifest
+from hcpasl.study_index import indexed_path
+from hcpasl.profiling import profiled, start_profiling, stop_profiling
+from hcpasl.scheduler import task, run_tasks, core_budget
+from hcpasl.image_format import intermediate_name, fsl_env
+from hcpasl.voxelwise import voxelwise
+from hcpasl.transforms import TransformSeries
 from pathlib import Path
 import argparse
 
 # Generate gradient distortion correction warp
+@profiled
 def calc_gdc_warp(asldata_vol1, coeffs_loc, oph):
     """
     Generate warp for gradient distortion correction using siemens 
@@ -37,7 +47,8 @@ def calc_gdc_warp(asldata_vol1, coeffs_loc, oph):
                     "siemens -g " + coeffs_loc)
 
     # print(gdc_call)
-    sp.run(gdc_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
+    # gradient_unwarp.py writes its outputs to the working directory
+    sp.run(gdc_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE, cwd=oph)
 
     gdc_warp_call = ("convertwarp --abs --ref=" + oph + "/gdc_corr_vol1.nii.gz " +
                     "--warp1=" + oph + "/fullWarp_abs.nii.gz --relout --out=" + 
@@ -59,6 +70,7 @@ def produce_topup_params(pars_filepath):
         t_pars.write("0 1 0 0.04845" + "\n")
         t_pars.write("0 -1 0 0.04845")
     
+@profiled
 def calc_fmaps(pa_sefm, ap_sefm, pa_ap_sefms, pars_filepath, cnf_file, distcorr_dir, out_basename, topup_fmap, 
                 fmap_rads, fmapmag, fmapmagbrain):
 
@@ -95,6 +107,7 @@ def calc_fmaps(pa_sefm, ap_sefm, pa_ap_sefms, pars_filepath, cnf_file, distcorr_
     # print(bet_fmapmag_call)
     sp.run(bet_fmapmag_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
 
+@profiled
 def gen_initial_trans(regfrom, outdir, struct, struct_brain):
     """
     Generate the initial linear transformation between ASL-space and T1w-space
@@ -106,6 +119,7 @@ def gen_initial_trans(regfrom, outdir, struct, struct_brain):
     # print(reg_call)
     sp.run(reg_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
 
+@profiled
 def gen_asl_mask(struct_brain, struct_bet_mask, regfrom, asl2struct, asl_mask,
                 struct2asl):
     """
@@ -133,7 +147,8 @@ def gen_asl_mask(struct_brain, struct_bet_mask, regfrom, asl2struct, asl_mask,
     sp.run(fill_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
     sp.run(hdr_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
 
-def gen_pves(t1w_dir, asl, fileroot):
+@profiled
+def gen_pves(t1w_dir, asl, fileroot, cores=mp.cpu_count()):
     """
     Generate partial volume estimates from freesurfer segmentations of the cortex
     and subcortical structures.
@@ -144,6 +159,7 @@ def gen_pves(t1w_dir, asl, fileroot):
             fsaverage_32k surface directory
         asl: path to ASL image, used for setting resolution of output 
         fileroot: path basename for output, will add suffix GM/WM/CSF
+        cores: number CPU cores to use
     """    
 
     # Load the t1 image, aparc+aseg and surfaces from their expected 
@@ -161,7 +177,7 @@ def gen_pves(t1w_dir, asl, fileroot):
         surf_dict[k] = paths[0]
 
     # Generate a single 4D volume of PV estimates, stacked GM/WM/CSF
-    pvs_stacked = extract_fs_pvs(aparcseg, surf_dict, t1, asl)
+    pvs_stacked = extract_fs_pvs(aparcseg, surf_dict, t1, asl, cores=cores)
 
     # Save output with tissue suffix 
     hdr = pvs_stacked.header 
@@ -171,6 +187,7 @@ def gen_pves(t1w_dir, asl, fileroot):
         nii = nb.Nifti2Image(pvs_stacked.dataobj[...,idx], aff, header=hdr)
         nb.save(nii, p)
 
+@profiled
 def gen_wm_mask(pvwm, tissseg):
     """
     Generate a white matter mask from the WM partial volume estimate for use in
@@ -182,6 +199,7 @@ def gen_wm_mask(pvwm, tissseg):
     sp.run(maths_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
     
 
+@profiled
 def calc_distcorr_warp(regfrom, distcorr_dir, struct, struct_brain, mask, tissseg,
                         asl2struct_trans, fmap_rads, fmapmag, fmapmagbrain, asl_grid_T1,
                         gdc_warp):
@@ -215,6 +233,7 @@ def calc_distcorr_warp(regfrom, distcorr_dir, struct, struct_brain, mask, tissse
         sp.run(cp_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
 
 # calculate the jacobian of the warp for intensity correction
+@profiled
 def calc_warp_jacobian(distcorr_dir):
     """
     Calculation of the Jacobian of the combined distortion correction for subsequent 
@@ -236,6 +255,7 @@ def calc_warp_jacobian(distcorr_dir):
     sp.run(hdr_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
 
 # apply the combined distortion correction warp
+@profiled
 def apply_distcorr_warp(asldata_orig, T1space_ref, asldata_T1space, distcorr_dir,
                         moco_xfms, calib_orig, calib_T1space, calib_xfms, sfacs_orig,
                         sfacs_T1space):
@@ -250,37 +270,27 @@ def apply_distcorr_warp(asldata_orig, T1space_ref, asldata_T1space, distcorr_dir
                     distcorr_dir + "/distcorr_warp" + " --rel --interp=trilinear" +
                     " --paddingsize=1 --super --superlevel=a")
 
-    asl_jaco_call = ("fslmaths " + asldata_T1space + " -mul " + distcorr_dir + 
-                    "/distcorr_jacobian " + asldata_T1space)
-
     calib_apply_call = ("applywarp -i " + calib_orig + " -r " + T1space_ref + " -o " +
                     calib_T1space + " --premat=" + calib_xfms + " -w " + 
                     distcorr_dir + "/distcorr_warp" + " --rel --interp=trilinear" +
                     " --paddingsize=1 --super --superlevel=a")
 
-    calib_jaco_call = ("fslmaths " + calib_T1space + " -mul " + distcorr_dir + 
-                    "/distcorr_jacobian " + calib_T1space)
-
     sfacs_apply_call = ("applywarp -i " + sfacs_orig + " -r " + T1space_ref + " -o " +
                     sfacs_T1space + " --premat=" + moco_xfms + " -w " + 
                     distcorr_dir + "/distcorr_warp" + " --rel --interp=trilinear" +
                     " --paddingsize=1 --super --superlevel=a")
 
-    sfacs_jaco_call = ("fslmaths " + sfacs_T1space + " -mul " + distcorr_dir + 
-                    "/distcorr_jacobian " + sfacs_T1space)
     # print(asl_apply_call)
-    # print(asl_jaco_call)
     # print(calib_apply_call)
-    # print(calib_jaco_call)
     # print(sfacs_apply_call)
-    # print(sfacs_jaco_call)
 
-    sp.run(asl_apply_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-    sp.run(asl_jaco_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-    sp.run(calib_apply_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-    sp.run(calib_jaco_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-    sp.run(sfacs_apply_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-    sp.run(sfacs_jaco_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
+    # Jacobian intensity scaling of each output, in place
+    jacobian = distcorr_dir + "/distcorr_jacobian.nii.gz"
+    for apply_call, T1space_name in ((asl_apply_call, asldata_T1space), 
+                                     (calib_apply_call, calib_T1space), 
+                                     (sfacs_apply_call, sfacs_T1space)):
+        sp.run(apply_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE, env=fsl_env())
+        voxelwise(T1space_name).mul(jacobian).run(T1space_name)
 
 def find_field_maps(study_dir, subject_number):
     """
@@ -289,7 +299,15 @@ def find_field_maps(study_dir, subject_number):
     Multiple pairs of field maps are taken in the B session; this 
     function assumes that the mbPCASL field maps are the final 2 
     field map directories in the session.
+
+    The field maps are looked up in the study's index if there 
+    is one.
     """
+    subject_dir = Path(study_dir) / subject_number
+    pa_sefm = indexed_path(subject_dir, 'pa_sefm')
+    ap_sefm = indexed_path(subject_dir, 'ap_sefm')
+    if pa_sefm is not None and ap_sefm is not None:
+        return str(pa_sefm), str(ap_sefm)
     scan_dir = Path(study_dir) / subject_number / f'{subject_number}_V1_B/scans'
     fm_dirs = sorted(scan_dir.glob('**/*-FieldMap_SE_EPI'))[-2:]
     if (fm_dirs[0] / f'resources/NIFTI/files/{subject_number}_V1_B_PCASLhr_SpinEchoFieldMap_PA.nii.gz').exists():
@@ -300,77 +318,59 @@ def find_field_maps(study_dir, subject_number):
     ap_sefm = ap_dir / f'resources/NIFTI/files/{subject_number}_V1_B_PCASLhr_SpinEchoFieldMap_AP.nii.gz'
     return str(pa_sefm), str(ap_sefm)
     
-def main():
-    # argument handling
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "study_dir",
-        help="Path of the base study directory."
-    )
-    parser.add_argument(
-        "sub_number",
-        help="Subject number."
-    )
-    parser.add_argument(
-        "-g",
-        "--grads",
-        help="Filename of the gradient coefficients for gradient"
-            + "distortion correction (optional)."
-    )
-    args = parser.parse_args()
-    study_dir = args.study_dir
-    sub_num = args.sub_number
-    grad_coeffs = args.grads
-
-    oph = (study_dir + "/" + sub_num + "/ASL/TIs/DistCorr")
-    outdir = (study_dir + "/" + sub_num + "/T1w/ASL/reg")
-    pve_path = (study_dir + "/" + sub_num + "/T1w/ASL/PVEs")
-    T1w_oph = (study_dir + "/" + sub_num + "/T1w/ASL/TIs/DistCorr")
-    T1w_cal_oph  = (study_dir + "/" + sub_num + "/T1w/ASL/Calib/Calib0/DistCorr")
+def run_distcorr(subject_dir, json_dict, grad_coeffs=None):
+    """
+    Generate the gradient and EPI distortion correction warps for 
+    the subject in `subject_dir` and apply them, along with the 
+    motion correction, to the ASL series, calibration image and 
+    scaling factors, leaving them in ASL-gridded T1w-space.
+
+    The steps are run as a graph of tasks so that independent 
+    steps, such as topup, gradient_unwarp and the partial volume 
+    estimation, run concurrently within the core budget.
+
+    Inputs:
+        - `subject_dir` = pathlib.Path object specifying the 
+            subject's base directory
+        - `json_dict` = the subject's `Manifest`, which is 
+            updated with the locations of the outputs
+        - `grad_coeffs` = filename of the gradient coefficients 
+            for gradient distortion correction (optional)
+    """
+    subject_dir = Path(subject_dir)
+    study_dir = str(subject_dir.parent)
+    sub_num = subject_dir.name
+    sub_dir = str(subject_dir)
+
+    oph = (sub_dir + "/ASL/TIs/DistCorr")
+    outdir = (sub_dir + "/T1w/ASL/reg")
+    pve_path = (sub_dir + "/T1w/ASL/PVEs")
+    T1w_oph = (sub_dir + "/T1w/ASL/TIs/DistCorr")
+    T1w_cal_oph  = (sub_dir + "/T1w/ASL/Calib/Calib0/DistCorr")
     need_dirs = [oph, outdir, pve_path, T1w_oph, T1w_cal_oph]
     for req_dir in need_dirs:
         Path(req_dir).mkdir(parents=True, exist_ok=True)
 
-    initial_wd = os.getcwd()
-    print("Pre-distortion correction working directory was: " + initial_wd)
-    print("Changing working directory to: " + oph)
-    os.chdir(oph)
-
-    # Generate ASL-gridded T1-aligned T1w image for use as a reg reference
-    t1 = (study_dir + "/" + sub_num + "/T1w/T1w_acpc_dc_restore.nii.gz")
-    t1_brain = (study_dir + "/" + sub_num + "/T1w/T1w_acpc_dc_restore_brain.nii.gz")
-
-    asl = (study_dir + "/" + sub_num + "/ASL/TIs/STCorr/SecondPass/tis_stcorr.nii.gz") 
-    t1_asl_res = (study_dir + "/" + sub_num + "/T1w/ASL/reg/ASL_grid_T1w_acpc_dc_restore.nii.gz")
-
-    asl_v1 = (study_dir + "/" + sub_num + "/ASL/TIs/STCorr/SecondPass/tis_stcorr_vol1.nii.gz")
-    first_asl_call = ("fslroi " + asl + " " + asl_v1 + " 0 1")
-    # print(first_asl_call)
-    sp.run(first_asl_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-
-    print("Running regtricks bit")
-    t1_spc = rt.ImageSpace(t1)
-    asl_spc = rt.ImageSpace(asl_v1)
-    t1_spc_asl = t1_spc.resize_voxels(asl_spc.vox_size / t1_spc.vox_size)
-    r = rt.Registration.identity()
-    t1_asl = r.apply_to_image(t1, t1_spc_asl)
-    nb.save(t1_asl, t1_asl_res)
-    # Check .grad coefficients are available and call function to generate 
-    # GDC warp if they are:
-    if os.path.isfile(grad_coeffs):
-        calc_gdc_warp(asl_v1, grad_coeffs, oph)
-    else:
+    # inputs
+    t1 = json_dict['T1w_acpc']
+    t1_brain = json_dict['T1w_acpc_brain']
+    asl = json_dict['ASL_stcorr']
+    calib_orig = json_dict['calib0_mc']
+    sfacs_orig = json_dict['scaling_factors']
+    moco_dir = Path(json_dict['TIs_dir']) / 'MoCo'
+    moco_xfms = str(moco_dir / "asln2asl0.npy")
+    calib_inv_xfms = str(moco_dir / "asln2m0.npy")
+    pa_sefm, ap_sefm = find_field_maps(study_dir, sub_num)
+    use_gdc = bool(grad_coeffs) and os.path.isfile(grad_coeffs)
+    if not use_gdc:
         print("Gradient coefficients not available")
 
-    print("Changing back to original working directory: " + initial_wd)
-    os.chdir(initial_wd)
-
-    # output file of topup parameters to subject's distortion correction dir
+    # intermediate and output names
+    t1_asl_res = (outdir + "/ASL_grid_T1w_acpc_dc_restore.nii.gz")
+    asl_v1 = str(intermediate_name(Path(asl).parent, "tis_stcorr_vol1"))
+    asl_v1_brain = str(intermediate_name(Path(asl).parent, "tis_stcorr_vol1_brain"))
+    gdc_warp = (oph + "/gdc_warp.nii.gz")
     pars_filepath = (oph + "/topup_params.txt")
-    produce_topup_params(pars_filepath)
-
-    # generate EPI distortion correction fieldmaps for use in asl_reg
-    pa_sefm, ap_sefm = find_field_maps(study_dir, sub_num)
     pa_ap_sefms = (oph + "/merged_sefms.nii.gz")
     cnf_file = "b02b0.cnf"
     out_basename = (oph + "/topup_result")
@@ -378,85 +378,167 @@ def main():
     fmap_rads = (oph + "/fmap_rads.nii.gz")
     fmapmag = (oph + "/fmapmag.nii.gz")
     fmapmagbrain = (oph + "/fmapmag_brain.nii.gz")
-    calc_fmaps(pa_sefm, ap_sefm, pa_ap_sefms, pars_filepath, cnf_file, oph, out_basename, topup_fmap, 
-                fmap_rads, fmapmag, fmapmagbrain)
-    
-    # Calculate initial linear transformation from ASL-space to T1w-space
-    asl_v1_brain = (study_dir + "/" + sub_num + "/ASL/TIs/STCorr/SecondPass/tis_stcorr_vol1_brain.nii.gz")
-    bet_regfrom_call = ("bet " + asl_v1 + " " + asl_v1_brain)
-    # print(bet_regfrom_call)
-    sp.run(bet_regfrom_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-
-    gen_initial_trans(asl_v1_brain, outdir, t1, t1_brain)
-
-    # Generate a brain mask in the space of the 1st ASL volume
     asl2struct = (outdir + "/asl2struct.mat")
     t1_brain_mask = (outdir + "/T1w_acpc_dc_restore_brain_mask.nii.gz")
     asl_mask = (outdir + "/asl_vol1_mask.nii.gz")
     struct2asl = (outdir + "/struct2asl.mat")
-
-    gen_asl_mask(t1_brain, t1_brain_mask, asl_v1_brain, asl2struct, asl_mask,
-                struct2asl)
-
-    # brain mask
-    t1_mask = (study_dir + "/" + sub_num + "/T1w/ASL/reg/T1w_acpc_dc_restore_brain_mask.nii.gz")
-    t1_asl_mask_name = (study_dir + "/" + sub_num + "/T1w/ASL/reg/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz")
-    t1_mask_spc = rt.ImageSpace(t1_mask)
-    t1_mask_spc_asl = t1_mask_spc.resize_voxels(asl_spc.vox_size / t1_mask_spc.vox_size)
-    r = rt.Registration.identity()
-    t1_mask_asl = r.apply_to_image(t1_mask, t1_mask_spc_asl)
-    fslmaths(t1_mask_asl).thr(0.5).bin().run(t1_asl_mask_name)
-    
-    # Generate PVEs
-    aparc_aseg = (study_dir + "/" + sub_num + "/T1w/aparc+aseg.nii.gz")
-    pve_files = (study_dir + "/" + sub_num + "/T1w/ASL/PVEs/pve")
-    gen_pves(Path(t1).parent, asl, pve_files)
-
-    # Generate WM mask
-    pvwm = (pve_files + "_WM.nii.gz")
-    tissseg = (study_dir + "/" + sub_num + "/T1w/ASL/PVEs/wm_mask.nii.gz")
-    gen_wm_mask(pvwm, tissseg)
-    
-
-    # Calculate the overall distortion correction warp
-    asl2str_trans = (outdir + "/asl2struct.mat")
-    gdc_warp = (oph + "/gdc_warp.nii.gz")
-    calc_distcorr_warp(asl_v1_brain, oph, t1, t1_brain, asl_mask, tissseg,
-                        asl2str_trans, fmap_rads, fmapmag, fmapmagbrain, t1_asl_res,
-                        gdc_warp)
-
-    # Calculate the Jacobian of the distortion correction warp 
-    calc_warp_jacobian(oph)
-
-    # apply the combined distortion correction warp with motion correction
-    # to move asl data, calibrationn images, and scaling factors into 
-    # ASL-gridded T1w-aligned space
-    
-    asl_distcorr = (T1w_oph + "/tis_distcorr.nii.gz")
-    moco_xfms = (study_dir + "/" + sub_num + "/ASL/TIs/MoCo/asln2asl0.mat") #will this work?
-    concat_xfms = str(Path(moco_xfms).parent / f'{Path(moco_xfms).stem}.cat')
-    # concatenate xfms like in oxford_asl
-    concat_call = f'cat {moco_xfms}/MAT* > {concat_xfms}'
-    sp.run(concat_call, shell=True)
+    t1_asl_mask_name = (outdir + "/ASL_grid_T1w_acpc_dc_restore_brain_mask.nii.gz")
+    pve_files = (pve_path + "/pve")
+    pve_names = [pve_files + f"_{suffix}.nii.gz" for suffix in ('GM', 'WM', 'CSF')]
+    tissseg = (pve_path + "/wm_mask.nii.gz")
+    distcorr_warp = (oph + "/distcorr_warp.nii.gz")
+    distcorr_jacobian = (oph + "/distcorr_jacobian.nii.gz")
+    concat_xfms = str(moco_dir / "asln2asl0.cat")
+    calib_xfm = str(moco_dir / "calibTOasl1.mat")
+    asl_distcorr = str(intermediate_name(T1w_oph, "tis_distcorr"))
     # only correcting and transforming the 1st of the calibration images at the moment
-    calib_orig = (study_dir + "/" + sub_num + "/ASL/Calib/Calib0/MTCorr/calib0_mtcorr.nii.gz")
-    calib_distcorr = (study_dir + "/" + sub_num + "/T1w/ASL/Calib/Calib0/DistCorr/calib0_dcorr.nii.gz")
-    calib_inv_xfm = (study_dir + "/" + sub_num + "/ASL/TIs/MoCo/asln2m0.mat/MAT_0000")
-    calib_xfm = (study_dir + "/" + sub_num + "/ASL/TIs/MoCo/calibTOasl1.mat")
-
-    sfacs_orig = (study_dir + "/" + sub_num + "/ASL/TIs/STCorr/SecondPass/combined_scaling_factors.nii.gz")
-    sfacs_distcorr = (T1w_oph + "/combined_scaling_factors.nii.gz")
-
-    invert_call = ("convert_xfm -omat " + calib_xfm + " -inverse " + calib_inv_xfm)
-    # print(invert_call)
-    sp.run(invert_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE)
-
-    apply_distcorr_warp(asl, t1_asl_res, asl_distcorr, oph,
-                        concat_xfms, calib_orig, calib_distcorr, calib_xfm, sfacs_orig,
-                        sfacs_distcorr)
-
-    
+    calib_distcorr = str(intermediate_name(T1w_cal_oph, "calib0_dcorr"))
+    sfacs_distcorr = str(intermediate_name(T1w_oph, "combined_scaling_factors"))
+    t1w_dir = Path(t1).parent
+    pve_inputs = [t1w_dir / 'T1w_acpc_dc.nii.gz', t1w_dir / 'aparc+aseg.nii.gz', asl]
+
+    def first_asl_volume():
+        first_asl_call = ("fslroi " + asl + " " + asl_v1 + " 0 1")
+        # print(first_asl_call)
+        sp.run(first_asl_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE, env=fsl_env())
+
+    def asl_gridded_t1():
+        # Generate ASL-gridded T1-aligned T1w image for use as a reg reference
+        print("Running regtricks bit")
+        t1_spc = rt.ImageSpace(t1)
+        asl_spc = rt.ImageSpace(asl_v1)
+        t1_spc_asl = t1_spc.resize_voxels(asl_spc.vox_size / t1_spc.vox_size)
+        r = rt.Registration.identity()
+        t1_asl = r.apply_to_image(t1, t1_spc_asl)
+        nb.save(t1_asl, t1_asl_res)
+
+    def topup_fieldmaps():
+        # output file of topup parameters to subject's distortion correction dir
+        produce_topup_params(pars_filepath)
+        # generate EPI distortion correction fieldmaps for use in asl_reg
+        calc_fmaps(pa_sefm, ap_sefm, pa_ap_sefms, pars_filepath, cnf_file, oph, 
+                    out_basename, topup_fmap, fmap_rads, fmapmag, fmapmagbrain)
+
+    def bet_first_volume():
+        bet_regfrom_call = ("bet " + asl_v1 + " " + asl_v1_brain)
+        # print(bet_regfrom_call)
+        sp.run(bet_regfrom_call.split(), check=True, stderr=sp.PIPE, stdout=sp.PIPE, env=fsl_env())
+
+    def asl_gridded_brain_mask():
+        asl_spc = rt.ImageSpace(asl_v1)
+        t1_mask_spc = rt.ImageSpace(t1_brain_mask)
+        t1_mask_spc_asl = t1_mask_spc.resize_voxels(asl_spc.vox_size / t1_mask_spc.vox_size)
+        r = rt.Registration.identity()
+        t1_mask_asl = r.apply_to_image(t1_brain_mask, t1_mask_spc_asl)
+        fslmaths(t1_mask_asl).thr(0.5).bin().run(t1_asl_mask_name)
+
+    def moco_transforms():
+        # concatenate xfms like in oxford_asl
+        TransformSeries.load(moco_xfms).to_cat(concat_xfms)
+        # calibration image to the first ASL volume
+        TransformSeries.load(calib_inv_xfms)[:1].inverse().to_cat(calib_xfm)
+
+    pve_cores = max(1, core_budget() - 2)
+    tasks = [
+        task("first_asl_volume", first_asl_volume, [asl], [asl_v1]),
+        task("asl_gridded_t1", asl_gridded_t1, [t1, asl_v1], [t1_asl_res]),
+        task("topup_fieldmaps", topup_fieldmaps, [pa_sefm, ap_sefm], 
+             [fmap_rads, fmapmag, fmapmagbrain]),
+        task("bet_first_volume", bet_first_volume, [asl_v1], [asl_v1_brain]),
+        # Calculate initial linear transformation from ASL-space to T1w-space
+        task("gen_initial_trans", 
+             partial(gen_initial_trans, asl_v1_brain, outdir, t1, t1_brain),
+             [asl_v1_brain, t1, t1_brain], [asl2struct]),
+        # Generate a brain mask in the space of the 1st ASL volume
+        task("gen_asl_mask", 
+             partial(gen_asl_mask, t1_brain, t1_brain_mask, asl_v1_brain, 
+                     asl2struct, asl_mask, struct2asl),
+             [t1_brain, asl_v1_brain, asl2struct], 
+             [t1_brain_mask, asl_mask, struct2asl]),
+        task("asl_gridded_brain_mask", asl_gridded_brain_mask, 
+             [t1_brain_mask, asl_v1], [t1_asl_mask_name]),
+        # Generate PVEs
+        task("gen_pves", 
+             partial(gen_pves, t1w_dir, asl, pve_files, cores=pve_cores),
+             pve_inputs, pve_names, cores=pve_cores),
+        # Generate WM mask
+        task("gen_wm_mask", partial(gen_wm_mask, pve_names[1], tissseg), 
+             [pve_names[1]], [tissseg]),
+        # Calculate the overall distortion correction warp
+        task("calc_distcorr_warp", 
+             partial(calc_distcorr_warp, asl_v1_brain, oph, t1, t1_brain, asl_mask, 
+                     tissseg, asl2struct, fmap_rads, fmapmag, fmapmagbrain, 
+                     t1_asl_res, gdc_warp),
+             [asl_v1_brain, t1, t1_brain, asl_mask, tissseg, asl2struct, fmap_rads, 
+              fmapmag, fmapmagbrain, t1_asl_res, gdc_warp if use_gdc else None],
+             [distcorr_warp]),
+        # Calculate the Jacobian of the distortion correction warp 
+        task("calc_warp_jacobian", partial(calc_warp_jacobian, oph), 
+             [distcorr_warp], [distcorr_jacobian]),
+        task("moco_transforms", moco_transforms, 
+             [moco_xfms, calib_inv_xfms], [concat_xfms, calib_xfm]),
+        # apply the combined distortion correction warp with motion correction
+        # to move asl data, calibrationn images, and scaling factors into 
+        # ASL-gridded T1w-aligned space
+        task("apply_distcorr_warp",
+             partial(apply_distcorr_warp, asl, t1_asl_res, asl_distcorr, oph,
+                     concat_xfms, calib_orig, calib_distcorr, calib_xfm, sfacs_orig,
+                     sfacs_distcorr),
+             [asl, t1_asl_res, distcorr_warp, distcorr_jacobian, concat_xfms, 
+              calib_orig, calib_xfm, sfacs_orig],
+             [asl_distcorr, calib_distcorr, sfacs_distcorr])
+    ]
+    # Check .grad coefficients are available and generate GDC warp if they are
+    if use_gdc:
+        tasks.append(task("calc_gdc_warp", partial(calc_gdc_warp, asl_v1, grad_coeffs, oph), 
+                          [asl_v1, grad_coeffs], [gdc_warp]))
+    run_tasks(tasks)
+
+    # save locations of important files in the json
+    important_names = {
+        'ASL_distcorr': asl_distcorr,
+        'scaling_factors_distcorr': sfacs_distcorr,
+        'calib0_dcorr': calib_distcorr,
+        'brain_mask': t1_asl_mask_name,
+        'pve_GM': pve_names[0],
+        'pve_WM': pve_names[1],
+        'pve_CSF': pve_names[2]
+    }
+    json_dict.update(important_names)
+    json_dict.flush()
 
+def main():
+    # argument handling
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "study_dir",
+        help="Path of the base study directory."
+    )
+    parser.add_argument(
+        "sub_number",
+        help="Subject number."
+    )
+    parser.add_argument(
+        "-g",
+        "--grads",
+        help="Filename of the gradient coefficients for gradient"
+            + "distortion correction (optional)."
+    )
+    parser.add_argument(
+        "--profile",
+        help="Filename of a json in which to save a report of the "
+            + "time and memory used by each step (optional)."
+    )
+    args = parser.parse_args()
+    subject_dir = Path(args.study_dir) / args.sub_number
+    json_dict = Manifest.for_subject(subject_dir)
+    if args.profile:
+        start_profiling()
+    try:
+        run_distcorr(subject_dir, json_dict, args.grads)
+    finally:
+        if args.profile:
+            stop_profiling().save(args.profile)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,54 @@
+"""
+Index the scans of the subjects in a study directory so that the
+pipeline can look up each subject's mbPCASL sequence, field maps,
+T1w scan and surfaces rather than searching for them on every run.
+
+Re-running the command only walks subjects which are new or whose
+scans have changed since the index was last built.
+"""
+
+from hcpasl.study_index import build_index, INDEX_NAME
+from pathlib import Path
+import argparse
+import time
+
+# keys of the files every subject needs for the pipeline
+REQUIRED = ("mbpcasl", "pa_sefm", "ap_sefm", "T1w_acpc")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "study_dir",
+        help="The study directory containing the subjects' directories."
+    )
+    parser.add_argument(
+        "-n",
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of subject directories to walk concurrently. "
+            + "Default is 8."
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Re-index every subject rather than only new subjects "
+            + "and those whose scans have changed."
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    study_dir = Path(args.study_dir).resolve()
+    start = time.perf_counter()
+    index, updated = build_index(study_dir, args.workers, args.rebuild)
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {len(updated)} of {len(index['subjects'])} subjects in "
+          + f"{elapsed:.1f}s. Saved index to {study_dir / INDEX_NAME}.")
+    for subject, entry in sorted(index['subjects'].items()):
+        missing = [key for key in REQUIRED if key not in entry]
+        if missing:
+            print(f"    {subject}: missing {', '.join(missing)}")
+
+if __name__ == '__main__':
+    main()
@@ -4,51 +4,337 @@ for the Human Connectome Project (HCP) ASL data.
 
 This currently requires that the script is called followed by 
 the directories of the subjects of interest and finally the 
-name of the MT correction scaling factors image.
+name of the MT correction scaling factors image. Subject 
+directories may alternatively be listed in a text file, one 
+per line, passed with `--subject-list`. When more than one 
+subject is given, subjects are processed concurrently by a 
+pool of worker processes.
 """
 
 import sys
 import os
 
-from hcpasl.initial_bookkeeping import initial_processing
+from hcpasl.initial_bookkeeping import initial_processing, find_mbpcasl
 from hcpasl.m0_mt_correction import correct_M0
 from hcpasl.asl_correction import hcp_asl_moco
 from hcpasl.asl_differencing import tag_control_differencing
 from hcpasl.asl_perfusion import run_oxford_asl
 from hcpasl.projection import project_to_surface
+from hcpasl.checkpoints import Stage, run_stages
+from hcpasl.manifest import Manifest, set_file_locking
+from hcpasl.satrecov import SATRECOV_ENGINES, satrecov_engine, set_satrecov_engine
+from hcpasl.perfusion import PERFUSION_ENGINES, perfusion_engine, set_perfusion_engine
+from hcpasl.profiling import start_profiling, stop_profiling
+from hcpasl.scheduler import set_core_budget
+from hcpasl.workdir import stage_subject, sync_subject
+from hcpasl.image_cache import set_cache_limit, clear_cache
+from hcpasl.image_format import (INTERMEDIATE_FORMATS, intermediate_ext, 
+                                 set_intermediate_format)
+from scripts.distcorr_warps import find_field_maps, run_distcorr
 from pathlib import Path
-import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import multiprocessing as mp
+import traceback
 import argparse
 
-def process_subject(subject_dir, mt_factors, gradients=None):
+# environment variables used by FSL, ITK and the numerical 
+# libraries to decide how many threads to spawn
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "FSL_NUM_THREADS"
+)
+
+# names of the pipeline's stages, in the order they are run
+STAGE_NAMES = (
+    "initial_processing",
+    "correct_M0",
+    "hcp_asl_moco",
+    "distcorr",
+    "tag_control_differencing",
+    "run_oxford_asl",
+    "project_to_surface"
+)
+
+# manifest entries written by the distortion correction stage
+DISTCORR_OUTPUTS = (
+    "ASL_distcorr",
+    "scaling_factors_distcorr",
+    "calib0_dcorr",
+    "brain_mask",
+    "pve_GM",
+    "pve_WM",
+    "pve_CSF"
+)
+
+def pipeline_stages(subject_dir, mt_factors, gradients=None):
+    """
+    Return the list of `Stage`s making up the pipeline for the 
+    subject in `subject_dir`, along with the files each stage 
+    reads and writes.
+
+    The stages before oxford_asl write intermediate images, so 
+    are re-run if the intermediate image format changes. The 
+    motion correction is also re-run if the satrecov engine 
+    changes, and the perfusion estimation if the perfusion 
+    engine changes.
+    """
+    intermediates = {'intermediate_ext': intermediate_ext()}
+    moco_params = dict(intermediates)
+    # only recorded when not the default so existing checkpoints stay valid
+    if satrecov_engine() != 'fabber':
+        moco_params['satrecov_engine'] = satrecov_engine()
+    perfusion_params = {'fabberdir': os.environ.get('FSLDEVDIR')}
+    perfusion_keys = ['beta_perf', 'calib0_dcorr', 'pve_GM', 'pve_WM', 
+                      'brain_mask', 'T1w_acpc', 'T1w_acpc_brain']
+    if perfusion_engine() != 'oxford_asl':
+        perfusion_params['perfusion_engine'] = perfusion_engine()
+        perfusion_keys.append('pve_CSF')
+    oxford_dir = subject_dir / 'T1w/ASL/TIs/OxfordASL'
+    perfusion_names = [
+        oxford_dir / 'struct_space/perfusion_calib.nii.gz',
+        oxford_dir / 'struct_space/perfusion_var_calib.nii.gz'
+    ]
+
+    def distcorr_inputs(json_dict):
+        pa_sefm, ap_sefm = find_field_maps(subject_dir.parent, subject_dir.stem)
+        return [
+            json_dict.get('ASL_stcorr'),
+            json_dict.get('scaling_factors'),
+            json_dict.get('calib0_mc'),
+            Path(json_dict['TIs_dir']) / 'MoCo/asln2asl0.npy',
+            Path(json_dict['TIs_dir']) / 'MoCo/asln2m0.npy',
+            json_dict.get('T1w_acpc'),
+            json_dict.get('T1w_acpc_brain'),
+            subject_dir / 'T1w/aparc+aseg.nii.gz',
+            pa_sefm,
+            ap_sefm,
+            gradients
+        ]
+
+    def surfaces(json_dict):
+        return [json_dict.get(f'{side}_{surf}') for side in ('L', 'R') 
+                for surf in ('mid', 'pial', 'white')]
+
+    def projections(json_dict):
+        projection_dir = oxford_dir / 'SurfaceResults32k'
+        return [projection_dir / f'{side}_{name.stem.split(".")[0]}.func.gii' 
+                for name in perfusion_names for side in ('L', 'R')]
+
+    return [
+        Stage(
+            "initial_processing",
+            partial(initial_processing, subject_dir),
+            lambda json_dict: [find_mbpcasl(subject_dir)],
+            lambda json_dict: [json_dict['ASL_seq'], json_dict['calib0_img'], 
+                               json_dict['calib1_img']],
+            intermediates
+        ),
+        Stage(
+            "correct_M0",
+            partial(correct_M0, subject_dir, mt_factors),
+            lambda json_dict: [json_dict.get('calib0_img'), 
+                               json_dict.get('calib1_img'), mt_factors],
+            lambda json_dict: [json_dict[f'calib{n}_{key}'] for n in (0, 1) 
+                               for key in ('bias', 'bc', 'mc', 'mask')],
+            intermediates
+        ),
+        Stage(
+            "hcp_asl_moco",
+            partial(hcp_asl_moco, subject_dir, mt_factors),
+            lambda json_dict: [json_dict.get('ASL_seq'), json_dict.get('calib0_bias'), 
+                               json_dict.get('calib0_mc'), json_dict.get('calib0_mask'), 
+                               mt_factors],
+            lambda json_dict: [json_dict['ASL_stcorr'], json_dict['scaling_factors'], 
+                               Path(json_dict['TIs_dir']) / 'MoCo/asln2asl0.npy',
+                               Path(json_dict['TIs_dir']) / 'MoCo/asln2m0.npy'],
+            moco_params
+        ),
+        Stage(
+            "distcorr",
+            lambda: run_distcorr(subject_dir, Manifest.for_subject(subject_dir), gradients),
+            distcorr_inputs,
+            lambda json_dict: [json_dict[key] for key in DISTCORR_OUTPUTS],
+            {'gradients': bool(gradients), **intermediates}
+        ),
+        Stage(
+            "tag_control_differencing",
+            partial(tag_control_differencing, subject_dir),
+            lambda json_dict: [json_dict.get('ASL_distcorr'), 
+                               json_dict.get('scaling_factors_distcorr')],
+            lambda json_dict: [json_dict['beta_perf']],
+            intermediates
+        ),
+        Stage(
+            "run_oxford_asl",
+            partial(run_oxford_asl, subject_dir),
+            lambda json_dict: [json_dict.get(key) for key in perfusion_keys],
+            lambda json_dict: perfusion_names,
+            perfusion_params
+        ),
+        Stage(
+            "project_to_surface",
+            partial(project_to_surface, subject_dir),
+            lambda json_dict: perfusion_names + surfaces(json_dict),
+            projections,
+            {}
+        )
+    ]
+
+def process_subject(subject_dir, mt_factors, gradients=None, force_from=None,
+                    workdir=None, intermediate_format=None, cache_limit=None,
+                    lock_manifest=False, satrecov_engine=None, perfusion_engine=None):
     """
     Run pipeline for individual subject specified by 
     `subject_dir`.
+
+    Stages which have already been completed with the same 
+    inputs are skipped, unless they come after `force_from`, 
+    the name of the first stage to re-run.
+
+    If `workdir` is given, the subject is processed in a copy of 
+    their directory within `workdir` and only the final outputs 
+    and those of the completed stages are copied back to 
+    `subject_dir` once the pipeline has finished. If the pipeline 
+    fails, the working copy is kept so that a re-run can resume 
+    from it.
+
+    `intermediate_format` is the format, 'nii.gz' (default) or 
+    'nii', of the intermediate images written by the pipeline.
+
+    Images read by several steps are kept in memory, using up to 
+    `cache_limit` bytes (default 4GB, 0 to disable).
+
+    If `lock_manifest` is True, the subject's json is locked 
+    while it's updated, for when other processes may update it 
+    at the same time.
+
+    `satrecov_engine` is the engine, 'fabber' (default) or 
+    'native', used to fit the saturation recovery model during 
+    the motion correction.
+
+    `perfusion_engine` is the engine, 'oxford_asl' (default) or 
+    'native', used to estimate perfusion from the differenced 
+    data.
+
+    The time and memory used by each stage are saved in the 
+    report `ASL/profile.json`.
     """
     subject_dir = Path(subject_dir)
-    mt_factors = Path(mt_factors)
-    initial_processing(subject_dir)
-    correct_M0(subject_dir, mt_factors)
-    hcp_asl_moco(subject_dir, mt_factors)
-    dist_corr_call = [
-        "hcp_asl_distcorr",
-        str(subject_dir.parent),
-        subject_dir.stem
-    ]
-    if gradients:
-        dist_corr_call.append('--grads')
-        dist_corr_call.append(gradients)
-    subprocess.run(dist_corr_call, check=True)
-    tag_control_differencing(subject_dir)
-    run_oxford_asl(subject_dir)
-    project_to_surface(subject_dir)
+    mt_factors = Path(mt_factors).resolve()
+    set_intermediate_format(intermediate_format)
+    set_cache_limit(cache_limit)
+    set_file_locking(lock_manifest)
+    set_satrecov_engine(satrecov_engine)
+    set_perfusion_engine(perfusion_engine)
+    if workdir:
+        work_subject_dir = stage_subject(subject_dir, workdir)
+        print(f"Processing subject {subject_dir} in {work_subject_dir}.")
+    else:
+        work_subject_dir = subject_dir
+    stages = pipeline_stages(work_subject_dir, mt_factors, gradients)
+    start_profiling()
+    try:
+        run_stages(work_subject_dir, stages, force_from)
+    finally:
+        clear_cache()
+        profiler = stop_profiling()
+        report_name = work_subject_dir / 'ASL/profile.json'
+        if report_name.parent.exists():
+            profiler.save(report_name)
+            print(f"Saved profiling report to {report_name}.")
+    if workdir:
+        sync_subject(work_subject_dir, subject_dir)
+        print(f"Copied final outputs back to {subject_dir}.")
+
+def read_subject_list(list_name):
+    """
+    Read subject directories from a text file, one per line. 
+    Blank lines and lines starting with '#' are ignored.
+    """
+    with open(list_name, 'r') as infile:
+        lines = [line.strip() for line in infile]
+    return [line for line in lines if line and not line.startswith('#')]
+
+def _limit_threads(threads):
+    """
+    Restrict the number of threads used by each subject's 
+    processing to `threads`. Used as the initializer of the 
+    batch worker processes, and called before processing a 
+    single subject, so that every external tool launched 
+    inherits the limit and concurrently scheduled steps share 
+    `threads` cores.
+    """
+    for env_var in THREAD_ENV_VARS:
+        os.environ[env_var] = str(threads)
+    set_core_budget(threads)
+
+def _batch_worker(subject_dir, mt_factors, **kwargs):
+    """
+    Run `process_subject` for a single subject of a batch, 
+    returning the traceback as a string instead of raising so 
+    that one failing subject doesn't bring down the batch.
+    """
+    print(f"Processing subject {subject_dir}.")
+    try:
+        process_subject(subject_dir, mt_factors, **kwargs)
+    except Exception:
+        return subject_dir, traceback.format_exc()
+    return subject_dir, None
+
+def process_subjects(subject_dirs, mt_factors, workers=1, threads=1, **kwargs):
+    """
+    Run the pipeline for each of `subject_dirs`, processing up 
+    to `workers` subjects concurrently, each restricted to 
+    `threads` threads. Any further keyword arguments are passed 
+    on to `process_subject`.
+
+    Returns a dictionary mapping each subject directory to 
+    `None` if it was processed successfully or to the 
+    traceback of the error which stopped it otherwise.
+    """
+    worker = partial(_batch_worker, mt_factors=mt_factors, **kwargs)
+    results = {}
+    with ProcessPoolExecutor(
+        max_workers=workers, 
+        initializer=_limit_threads, 
+        initargs=(threads, )
+    ) as executor:
+        futures = [executor.submit(worker, subject_dir) for subject_dir in subject_dirs]
+        for future in as_completed(futures):
+            subject_dir, error = future.result()
+            if error:
+                print(f"Subject {subject_dir} failed:\n{error}")
+            else:
+                print(f"Subject {subject_dir} finished.")
+            results[subject_dir] = error
+    return results
+
+def print_summary(results):
+    """
+    Print a summary of the successes and failures of a batch 
+    run given the output of `process_subjects`.
+    """
+    succeeded = [s for s, error in results.items() if error is None]
+    failed = [s for s, error in results.items() if error is not None]
+    print(f"\n{len(succeeded)} of {len(results)} subjects processed successfully.")
+    for subject_dir in succeeded:
+        print(f"    OK      {subject_dir}")
+    for subject_dir in failed:
+        last_line = results[subject_dir].strip().splitlines()[-1]
+        print(f"    FAILED  {subject_dir}: {last_line}")
 
 def main():
     # argument handling
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "subject_dir",
-        help="The directory of the subject you wish to process."
+        nargs="*",
+        help="The directories of the subjects you wish to process."
     )
     parser.add_argument(
         "scaling_factors",
@@ -66,10 +352,92 @@ def main():
         help="User Fabber executable in <fabberdir>/bin/ for users"
             + "with FSL < 6.0.4"
     )
+    parser.add_argument(
+        "--subject-list",
+        help="Text file listing the directories of subjects to "
+            + "process, one per line. Processed along with any "
+            + "subject directories given on the command line."
+    )
+    parser.add_argument(
+        "-n",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of subjects to process concurrently. "
+            + "Default is 1. Ignored for a single subject."
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads each subject may use, shared by "
+            + "the steps of the pipeline which run concurrently. "
+            + "Default is the number of CPUs divided by the number "
+            + "of workers."
+    )
+    parser.add_argument(
+        "--force-from",
+        choices=STAGE_NAMES,
+        help="Re-run the pipeline from this stage onwards even if "
+            + "the stages have previously been completed."
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Directory, e.g. on local scratch or tmpfs, in which to "
+            + "process subjects. Only the final outputs, i.e. the "
+            + "oxford_asl results and surface projections, and the "
+            + "outputs recorded by each stage's checkpoint are copied "
+            + "back to the subject directories. The latter let later "
+            + "runs skip the stages already completed."
+    )
+    parser.add_argument(
+        "--intermediate-format",
+        choices=INTERMEDIATE_FORMATS,
+        default="nii.gz",
+        help="Format of the intermediate images. Uncompressed 'nii' "
+            + "images are quicker to write and read but use more disk "
+            + "space. The final outputs are always gzipped."
+    )
+    parser.add_argument(
+        "--image-cache",
+        type=float,
+        help="Memory, in GB, used to keep images which are read by "
+            + "several steps of the pipeline in memory. Default is 4GB "
+            + "per subject; 0 disables the cache."
+    )
+    parser.add_argument(
+        "--satrecov-engine",
+        choices=SATRECOV_ENGINES,
+        default="fabber",
+        help="Engine used to fit the saturation recovery model to the "
+            + "control images. 'native' fits it in Python, much more "
+            + "quickly, without Fabber's spatial prior. Default is fabber."
+    )
+    parser.add_argument(
+        "--perfusion-engine",
+        choices=PERFUSION_ENGINES,
+        default="oxford_asl",
+        help="Engine used to estimate perfusion from the differenced "
+            + "data. 'native' fits the kinetic model in Python, much more "
+            + "quickly, without oxford_asl's macrovascular component or "
+            + "prior on perfusion. Default is oxford_asl."
+    )
+    parser.add_argument(
+        "--lock-json",
+        action="store_true",
+        help="Lock each subject's ASL.json while it is updated, for "
+            + "when other processes may be updating it at the same "
+            + "time. Requires a filesystem which supports locking."
+    )
     # assign arguments to variables
     args = parser.parse_args()
     mt_name = args.scaling_factors
-    subject_dir = args.subject_dir
+    subject_dirs = list(args.subject_dir)
+    if args.subject_list:
+        subject_dirs += read_subject_list(args.subject_list)
+    if not subject_dirs:
+        parser.error("no subject directories given")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
     if args.fabberdir:
         if not os.path.isfile(os.path.join(args.fabberdir, "bin", "fabber_asl")):
             print("ERROR: specified Fabber in %s, but no fabber_asl executable found in %s/bin" % (args.fabberdir, args.fabberdir))
@@ -83,13 +451,40 @@ def main():
         print("Using Fabber-ASL executable %s/bin/fabber_asl" % args.fabberdir)
         os.environ["FSLDEVDIR"] = os.path.abspath(args.fabberdir)
 
-    print(f"Processing subject {subject_dir}.")
     if args.grads:
         print("Including gradient distortion correction step.")
-        process_subject(subject_dir, mt_name, args.grads)
     else:
         print("Not including gradient distortion correction step.")
-        process_subject(subject_dir, mt_name)
+
+    options = {
+        "gradients": args.grads,
+        "force_from": args.force_from,
+        "workdir": args.workdir,
+        "intermediate_format": args.intermediate_format,
+        "cache_limit": None if args.image_cache is None else int(args.image_cache * 2**30),
+        "lock_manifest": args.lock_json,
+        "satrecov_engine": args.satrecov_engine,
+        "perfusion_engine": args.perfusion_engine
+    }
+    if len(subject_dirs) == 1:
+        subject_dir = subject_dirs[0]
+        if args.workers > 1:
+            print("Warning: --workers is ignored when only one subject is given. "
+                  + "Use --threads to set the number of threads it may use.")
+        # limit the subject's threads as a batch worker's would be
+        threads = args.threads or mp.cpu_count()
+        _limit_threads(threads)
+        print(f"Processing subject {subject_dir} with {threads} threads.")
+        process_subject(subject_dir, mt_name, **options)
+    else:
+        workers = min(args.workers, len(subject_dirs))
+        threads = args.threads or max(1, mp.cpu_count() // workers)
+        print(f"Processing {len(subject_dirs)} subjects with {workers} "
+              + f"workers of {threads} threads each.")
+        results = process_subjects(subject_dirs, mt_name, workers, threads, **options)
+        print_summary(results)
+        if any(error is not None for error in results.values()):
+            sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
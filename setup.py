@@ -11,10 +11,10 @@ setup(
     description='Minimal ASL processing pipeline for the HCP.',
     long_description=long_description,
     url='https://github.com/ibme-qubic/hcp-asl',
-    packages=find_packages(),
-    python_requires='>=3.6',
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
+    python_requires='>=3.8',
     install_requires=[
-        'numpy',
+        'numpy>=1.20',
         'fslpy',
         'pyfab',
         'nibabel',
@@ -27,6 +27,8 @@ setup(
             'hcp_asl = scripts.run_pipeline:main',
             'hcp_asl_distcorr = scripts.distcorr_warps:main',
             'get_updated_fabber = scripts.get_updated_fabber:main',
+            'hcp_asl_compare_profiles = scripts.compare_profiles:main',
+            'hcp_asl_index = scripts.index_study:main',
         ]
     }
 )
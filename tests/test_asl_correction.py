@@ -0,0 +1,39 @@
+"""
+Tests of splitting the ASL series into its control and tag images.
+"""
+
+from hcpasl.asl_correction import _split_tag_control
+import nibabel as nb
+import numpy as np
+import pytest
+
+RPTS = [1, 2, 1, 1, 1]
+
+def _make_series(asl_name, iaf):
+    """
+    A series of tag-control pairs in the order `iaf` where each tag
+    volume is -1 - its pair's index and each control volume is
+    1 + its pair's index.
+    """
+    pairs = np.arange(sum(RPTS), dtype=np.float32)
+    tags = -1 - pairs
+    controls = 1 + pairs
+    first, second = (tags, controls) if iaf == 'tc' else (controls, tags)
+    volumes = np.stack([first, second], axis=1).ravel()
+    data = np.broadcast_to(volumes, (4, 4, 3, volumes.size))
+    nb.save(nb.Nifti1Image(np.ascontiguousarray(data), np.eye(4)), str(asl_name))
+    return tags, controls
+
+@pytest.mark.parametrize('iaf', ['tc', 'ct'])
+def test_split_tag_control(tmp_path, iaf):
+    asl_name = tmp_path / f'asl_{iaf}.nii.gz'
+    tags, controls = _make_series(asl_name, iaf)
+    control_img, tag_img = _split_tag_control(asl_name, len(RPTS), iaf, 'tis', RPTS)
+    assert np.array_equal(control_img.data[0, 0, 0], controls)
+    assert np.array_equal(tag_img.data[0, 0, 0], tags)
+
+def test_split_tag_control_unknown_order(tmp_path):
+    asl_name = tmp_path / 'asl.nii.gz'
+    _make_series(asl_name, 'tc')
+    with pytest.raises(ValueError):
+        _split_tag_control(asl_name, len(RPTS), 'diff', 'tis', RPTS)
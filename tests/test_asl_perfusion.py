@@ -0,0 +1,125 @@
+"""
+Tests of the perfusion estimation with oxford_asl, using the
+stand-in executables of `benchmarks.stub_tools`.
+"""
+
+from benchmarks.stub_tools import install_stubs
+from hcpasl.manifest import manifest_name
+import hcpasl.asl_perfusion as asl_perfusion
+import nibabel as nb
+import numpy as np
+import subprocess
+import pytest
+import json
+import os
+
+@pytest.fixture
+def stub_env(tmp_path, monkeypatch):
+    """
+    Put the stand-ins on the PATH and point fslpy at them.
+    """
+    from fsl.utils.platform import platform as fslplatform
+    stub_dir = tmp_path / 'stubs'
+    install_stubs(stub_dir / 'bin')
+    monkeypatch.setenv('FSLDIR', str(stub_dir))
+    monkeypatch.setenv('FSLOUTPUTTYPE', 'NIFTI_GZ')
+    monkeypatch.setenv('PATH', str(stub_dir / 'bin') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('HCPASL_STUB_DELAY', '0')
+    monkeypatch.setenv('HCPASL_STUB_LOG', str(tmp_path / 'calls.jsonl'))
+    monkeypatch.delenv('FSLDEVDIR', raising=False)
+    monkeypatch.setattr(fslplatform, 'fsldir', str(stub_dir))
+
+def _make_subject(subject_dir):
+    """
+    A subject with random differenced data, calibration image and
+    partial volumes within a box-shaped brain mask, large enough to
+    be split into two chunks.
+    """
+    rng = np.random.default_rng(0)
+    asl_affine = np.diag([2.5, 2.5, 2.5, 1])
+    asl_affine[:3, 3] = [-40, -40, -30]
+    struct_affine = np.eye(4)
+    struct_affine[:3, 3] = [-40, -40, -30]
+    mask = np.zeros((32, 32, 24))
+    mask[4:28, 4:28, 3:21] = 1
+    images = {
+        'beta_perf': (rng.random((32, 32, 24, 5)), asl_affine),
+        'brain_mask': (mask, asl_affine),
+        'calib0_dcorr': (rng.random((32, 32, 24)), asl_affine),
+        'pve_GM': (rng.random((32, 32, 24)), asl_affine),
+        'pve_WM': (rng.random((32, 32, 24)), asl_affine),
+        'T1w_acpc': (rng.random((80, 80, 60)), struct_affine),
+        'T1w_acpc_brain': (rng.random((80, 80, 60)), struct_affine)
+    }
+    (subject_dir / 'ASL').mkdir(parents=True)
+    json_dict = {'structasl': str(subject_dir / 'T1w/ASL')}
+    for key, (data, affine) in images.items():
+        name = subject_dir / f'{key}.nii.gz'
+        nb.save(nb.Nifti1Image(data.astype(np.float32), affine), str(name))
+        json_dict[key] = str(name)
+    with open(manifest_name(subject_dir), 'w') as outfile:
+        json.dump(json_dict, outfile)
+
+def _results(oxford_dir):
+    """
+    The contents of each of the oxford_asl results in `oxford_dir`.
+    The Fabber runs' images are compared by their data, since the
+    merged ones are written by fslpy, and their logs are skipped.
+    """
+    results = {}
+    for name in sorted(oxford_dir.rglob('*')):
+        key = str(name.relative_to(oxford_dir))
+        if not name.is_file():
+            continue
+        elif key.startswith('basil'):
+            if name.name.endswith('.nii.gz'):
+                results[key] = nb.load(str(name)).get_fdata().tobytes()
+            elif name.name != 'logfile':
+                results[key] = name.read_bytes()
+        else:
+            results[key] = name.read_bytes()
+    return results
+
+def _fabber_calls(tmp_path):
+    """
+    The number of runs of the stand-in Fabber logged so far.
+    """
+    with open(tmp_path / 'calls.jsonl', 'r') as infile:
+        return sum(json.loads(line)['tool'] == 'fabber_asl' for line in infile)
+
+def _baseline_command(subject_dir, oxford_dir):
+    """
+    The single oxford_asl command over the whole brain mask, with
+    its own calibration and registration, as originally run.
+    """
+    def s(key):
+        return str(subject_dir / f'{key}.nii.gz')
+
+    return [
+        'oxford_asl', '-i', s('beta_perf'), '-o', str(oxford_dir), '--casl',
+        '--ibf=tis', '--iaf=diff', '--tis=1.7,2.2,2.7,3.2,3.7', '--rpts=6,6,6,10,15',
+        '--fixbolus', '--bolus=1.5', '--pvcorr', '-c', s('calib0_dcorr'),
+        '--cmethod=single', '-m', s('brain_mask'), f"--pvgm={s('pve_GM')}",
+        f"--pvwm={s('pve_WM')}", '--te=19', '--debug', '--spatial=off',
+        '--slicedt=0.059', '-s', s('T1w_acpc'), f"--sbrain={s('T1w_acpc_brain')}",
+        '--sliceband=10'
+    ]
+
+def test_results_match_baseline_command(tmp_path, stub_env):
+    subject_dir = tmp_path / 'subject'
+    _make_subject(subject_dir)
+    baseline_dir = tmp_path / 'baseline'
+    subprocess.run(_baseline_command(subject_dir, baseline_dir), check=True)
+    baseline = _results(baseline_dir)
+    # one run without and one with partial volume correction
+    assert _fabber_calls(tmp_path) == 2
+    asl_perfusion.run_oxford_asl(subject_dir, workers=4)
+    # each run split into two chunks
+    assert _fabber_calls(tmp_path) == 2 + 4
+    results = _results(subject_dir / 'T1w/ASL/TIs/OxfordASL')
+    assert 'struct_space/perfusion_calib.nii.gz' in baseline
+    assert 'native_space/pvcorr/perfusion_var_calib.nii.gz' in baseline
+    assert 'calib/M0.txt' in baseline
+    assert results.keys() == baseline.keys()
+    for name in baseline:
+        assert results[name] == baseline[name], name
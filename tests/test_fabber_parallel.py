@@ -0,0 +1,31 @@
+"""
+Tests of merging the results of runs over blocks of voxels with
+`hcpasl.fabber_parallel`.
+"""
+
+from hcpasl.fabber_parallel import split_mask, merge_blocks
+import nibabel as nb
+import numpy as np
+
+def test_merge_blocks(tmp_path):
+    mask = np.zeros((6, 6, 4), dtype=bool)
+    mask[1:5, 1:5, :] = True
+    blocks = split_mask(mask, 2)
+    block_dirs = []
+    for n, block in enumerate(blocks):
+        block_dir = tmp_path / f'block{n}'
+        (block_dir / 'sub').mkdir(parents=True)
+        data = np.where(block, n + 1, 0).astype(np.float32)
+        nb.save(nb.Nifti1Image(data, np.eye(4)), str(block_dir / 'sub/mean_ftiss.nii.gz'))
+        (block_dir / 'paramnames.txt').write_text('ftiss\n')
+        (block_dir / 'sub/summary.txt').write_text(f'mean over block {n}\n')
+        (block_dir / 'logfile').write_text(f'block {n}\n')
+        block_dirs.append(block_dir)
+    out_dir = tmp_path / 'merged'
+    merge_blocks(block_dirs, blocks, out_dir)
+    merged = nb.load(str(out_dir / 'sub/mean_ftiss.nii.gz')).get_fdata()
+    assert np.array_equal(merged, np.where(blocks[0], 1, np.where(blocks[1], 2, 0)))
+    assert (out_dir / 'paramnames.txt').read_text() == 'ftiss\n'
+    # summaries which differ between blocks only describe their own block
+    assert not (out_dir / 'sub/summary.txt').exists()
+    assert 'block 1' in (out_dir / 'logfile').read_text()
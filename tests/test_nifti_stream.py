@@ -0,0 +1,45 @@
+"""
+Tests of extracting volumes from a 4D NIfTI in a single pass with
+`hcpasl.nifti_stream`.
+"""
+
+from hcpasl.nifti_stream import extract_volumes
+import nibabel as nb
+import numpy as np
+import pytest
+
+def _make_source(name, offset):
+    data = np.arange(480, dtype=np.float32).reshape((4, 4, 3, 10)) + offset
+    nb.save(nb.Nifti1Image(data, np.eye(4)), str(name))
+    return data
+
+def _extract(src_name, out_dir, gzip_index):
+    outputs = [(out_dir / 'series.nii.gz', 0, 8), (out_dir / 'calib.nii.gz', 9, 1)]
+    extract_volumes(src_name, outputs, gzip_index=gzip_index)
+    return [nb.load(str(name)).get_fdata() for name, _, _ in outputs]
+
+def test_extract_volumes(tmp_path):
+    src_name = tmp_path / 'source.nii.gz'
+    data = _make_source(src_name, 0)
+    series, calib = _extract(src_name, tmp_path, None)
+    assert np.array_equal(series, data[..., :8])
+    assert np.array_equal(calib, data[..., 9])
+
+def test_stale_gzip_index(tmp_path):
+    pytest.importorskip('indexed_gzip')
+    src_name = tmp_path / 'source.nii.gz'
+    gzip_index = tmp_path / 'source.gzidx'
+    _make_source(src_name, 0)
+    _extract(src_name, tmp_path, gzip_index)
+    assert gzip_index.exists()
+    # a replaced source isn't read at the old index's seek points
+    data = _make_source(src_name, 1000)
+    series, calib = _extract(src_name, tmp_path, gzip_index)
+    assert np.array_equal(series, data[..., :8])
+    assert np.array_equal(calib, data[..., 9])
+    # nor is a source whose index can't be imported
+    gzip_index.write_bytes(b'not an index')
+    (tmp_path / 'source.gzidx.stamp').write_text(
+        f'{src_name.stat().st_size} {src_name.stat().st_mtime_ns}\n')
+    series, calib = _extract(src_name, tmp_path, gzip_index)
+    assert np.array_equal(calib, data[..., 9])
@@ -0,0 +1,104 @@
+"""
+Tests of processing a subject in a working directory with
+`hcpasl.workdir`, using stand-in stages which only write text
+files.
+"""
+
+from hcpasl.workdir import stage_subject, sync_subject
+from hcpasl.checkpoints import Stage, run_stages
+from hcpasl.manifest import Manifest
+import json
+
+def _make_subject(study_dir):
+    subject_dir = study_dir / 'subject'
+    (subject_dir / 'T1w').mkdir(parents=True)
+    (subject_dir / 'T1w/T1w_acpc.txt').write_text('structural')
+    (subject_dir / 'mbPCASL.txt').write_text('asl')
+    return subject_dir
+
+def _stages(subject_dir, calls):
+    """
+    An intermediate stage writing to `ASL`, with a scratch file
+    which isn't one of its outputs, and a final stage writing to
+    the oxford_asl results directory, with a registration which
+    isn't one of its outputs. The stages' names are appended to
+    `calls` when run.
+    """
+    def intermediate():
+        calls.append('intermediate')
+        tis_dir = subject_dir / 'ASL/TIs'
+        (tis_dir / 'tmp').mkdir(parents=True, exist_ok=True)
+        (tis_dir / 'ASL_seq.txt').write_text((subject_dir / 'mbPCASL.txt').read_text())
+        (tis_dir / 'tmp/scratch.txt').write_text('scratch')
+        manifest = Manifest.for_subject(subject_dir, create=True)
+        manifest.update({
+            'TIs_dir': str(tis_dir),
+            'ASL_seq': str(tis_dir / 'ASL_seq.txt'),
+            'scratch': str(tis_dir / 'tmp/scratch.txt'),
+            'T1w_acpc': str(subject_dir / 'T1w/T1w_acpc.txt')
+        })
+        manifest.flush()
+
+    def final():
+        calls.append('final')
+        manifest = Manifest.for_subject(subject_dir)
+        result_name = subject_dir / 'T1w/ASL/TIs/OxfordASL/result.txt'
+        result_name.parent.mkdir(parents=True, exist_ok=True)
+        result_name.write_text(open(manifest['ASL_seq']).read() + ' result')
+        (result_name.parent / 'logfile').write_text('log')
+        reg_name = subject_dir / 'T1w/ASL/reg/asl2struct.mat'
+        reg_name.parent.mkdir(parents=True, exist_ok=True)
+        reg_name.write_text('registration')
+        manifest['result'] = str(result_name)
+        manifest.flush()
+
+    return [
+        Stage('intermediate', intermediate,
+              lambda json_dict: [subject_dir / 'mbPCASL.txt'],
+              lambda json_dict: [json_dict['ASL_seq']], {}),
+        Stage('final', final,
+              lambda json_dict: [json_dict.get('ASL_seq'), json_dict.get('T1w_acpc')],
+              lambda json_dict: [json_dict['result']], {})
+    ]
+
+def _process(subject_dir, workdir, calls):
+    work_subject_dir = stage_subject(subject_dir, workdir)
+    run_stages(work_subject_dir, _stages(work_subject_dir, calls))
+    sync_subject(work_subject_dir, subject_dir)
+
+def test_sync_prunes_manifest(tmp_path):
+    subject_dir = _make_subject(tmp_path)
+    _process(subject_dir, tmp_path / 'work', [])
+
+    with open(subject_dir / 'ASL/ASL.json', 'r') as infile:
+        json_dict = json.load(infile)
+    # intermediate files which aren't outputs of a stage aren't
+    # copied back, so the scratch file isn't in the json
+    assert 'scratch' not in json_dict
+    assert not (subject_dir / 'ASL/TIs/tmp').exists()
+    assert not (subject_dir / 'T1w/ASL/reg').exists()
+    assert set(json_dict['checkpoints']) == {'intermediate', 'final'}
+    assert (subject_dir / 'T1w/ASL/TIs/OxfordASL/result.txt').read_text() == 'asl result'
+    for key in ('TIs_dir', 'ASL_seq', 'T1w_acpc', 'result'):
+        assert json_dict[key].startswith(str(subject_dir.resolve()))
+        assert (subject_dir / json_dict[key]).exists()
+    assert not (tmp_path / 'work/subject').exists()
+
+def test_rerun_skips_completed_stages(tmp_path):
+    subject_dir = _make_subject(tmp_path)
+    calls = []
+    _process(subject_dir, tmp_path / 'work', calls)
+    assert calls == ['intermediate', 'final']
+
+    calls.clear()
+    _process(subject_dir, tmp_path / 'work', calls)
+    assert calls == []
+    assert (subject_dir / 'T1w/ASL/TIs/OxfordASL/result.txt').read_text() == 'asl result'
+    # final outputs which aren't recorded by a checkpoint are kept
+    assert (subject_dir / 'T1w/ASL/TIs/OxfordASL/logfile').read_text() == 'log'
+
+    # a changed input still re-runs the stages
+    (subject_dir / 'mbPCASL.txt').write_text('new asl')
+    _process(subject_dir, tmp_path / 'work', calls)
+    assert calls == ['intermediate', 'final']
+    assert (subject_dir / 'T1w/ASL/TIs/OxfordASL/result.txt').read_text() == 'new asl result'